@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Docking throughput of the compute node backends
+
+Docks the same ligands with each backend and reports ligands/s. The task
+directory has the layout of an uploaded task ZIP: receptor.pdbqt,
+parameter.txt and ligands/*.pdbqt. The vina_python backend needs the Vina
+Python bindings (pip install vina); the subprocess backend needs the vina
+binary in compute_node/. subprocess_maps runs the binary against grid maps
+computed once beforehand (vina 1.2 --write_maps / --maps).
+
+Usage:
+    cd benchmarks
+    python bench_backends.py TASK_DIR [--ligands N] [--cpu N] [--backends subprocess,subprocess_maps,vina_python]
+"""
+
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.append('..')
+sys.path.append('../compute_node')
+from docking_backends import SubprocessBackend, VinaPythonBackend
+
+def load_params(parameter_file, cpu):
+    params = {'num_modes': 9, 'energy_range': 3, 'cpu': cpu}
+    with open(parameter_file, 'r') as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.strip().split('=', 1)
+                params[key.strip()] = value.strip()
+    if cpu:
+        params['cpu'] = cpu
+    return params
+
+def run(backend, receptor_file, ligand_files, params, with_maps=False):
+    """Return (seconds for the first ligand, including map computation, ligands/s over the rest, failures)"""
+    out_dir = Path(tempfile.mkdtemp(prefix=f'vortexdock_bench_{backend.name}_'))
+    timings = []
+    failures = 0
+    maps = None
+    try:
+        start = time.perf_counter()
+        if with_maps:
+            maps = out_dir / 'receptor'
+            if not backend.write_maps(receptor_file, params, maps):
+                raise RuntimeError('vina --write_maps failed')
+        maps_seconds = time.perf_counter() - start
+        for ligand_file in ligand_files:
+            start = time.perf_counter()
+            output_path, _ = backend.dock('bench', ligand_file.stem, receptor_file, ligand_file, params,
+                                          out_dir / f'{ligand_file.stem}_out.pdbqt', maps=maps)
+            timings.append(time.perf_counter() - start)
+            if output_path is None:
+                failures += 1
+    finally:
+        backend.close()
+        shutil.rmtree(out_dir, ignore_errors=True)
+    rest = timings[1:] or timings
+    return maps_seconds + timings[0], len(rest) / sum(rest), failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark docking backends')
+    parser.add_argument('task_dir', help='Directory with receptor.pdbqt, parameter.txt and ligands/')
+    parser.add_argument('--ligands', type=int, default=20)
+    parser.add_argument('--cpu', type=int, default=0, help='Override the cpu parameter')
+    parser.add_argument('--backends', default='subprocess,subprocess_maps,vina_python')
+    args = parser.parse_args()
+
+    task_dir = Path(args.task_dir)
+    receptor_file = task_dir / 'receptor.pdbqt'
+    params = load_params(task_dir / 'parameter.txt', args.cpu)
+    ligand_files = sorted((task_dir / 'ligands').glob('*.pdbqt'))[:args.ligands]
+    if not ligand_files:
+        sys.exit(f"No ligands found in {task_dir / 'ligands'}")
+
+    factories = {'subprocess': SubprocessBackend, 'subprocess_maps': SubprocessBackend, 'vina_python': VinaPythonBackend}
+    print(f"{len(ligand_files)} ligands, cpu={params['cpu']}")
+    print(f"{'Backend':<16} {'first (s)':>10} {'ligands/s':>10} {'failed':>7}")
+    for name in args.backends.split(','):
+        try:
+            backend = factories[name]()
+        except ImportError:
+            print(f"{name:<16} skipped, Vina Python bindings are not installed")
+            continue
+        if name == 'subprocess_maps' and not backend.supports_maps:
+            print(f"{name:<16} skipped, grid maps need vina 1.2 or later")
+            continue
+        first, rate, failures = run(backend, receptor_file, ligand_files, params, with_maps=(name == 'subprocess_maps'))
+        print(f"{name:<16} {first:>10.2f} {rate:>10.3f} {failures:>7}")
+
+if __name__ == '__main__':
+    main()
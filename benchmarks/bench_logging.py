@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Logging overhead per dispatched ligand, as seen by the dispatching thread
+
+Each dispatched ligand logs what handle_get_task and handle_submit_result log:
+a DEBUG request line, an INFO assignment line and a DEBUG duplicate check.
+
+Usage:
+    cd benchmarks
+    python bench_logging.py [--ligands N] [--threads N]
+"""
+
+import os
+import sys
+import time
+import queue
+import logging
+import argparse
+import tempfile
+import threading
+from logging.handlers import RotatingFileHandler, QueueListener
+
+sys.path.append('..')
+from utils.logger import ComponentLogger, DeferredQueueHandler, TextFormatter, JsonFormatter
+
+def build_handlers(log_dir, formatter):
+    file_handler = RotatingFileHandler(os.path.join(log_dir, 'bench.log'), maxBytes=10*1024*1024, backupCount=1, encoding='utf-8')
+    console_handler = logging.StreamHandler(open(os.devnull, 'w'))
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+    return [file_handler, console_handler]
+
+def build_logger(name, log_dir, asynchronous, level, formatter):
+    """Return (logger, listener) configured like utils.logger.Logger"""
+    base = logging.getLogger(f'bench.{name}')
+    base.propagate = False
+    base.setLevel(level)
+    handlers = build_handlers(log_dir, formatter)
+    if not asynchronous:
+        for handler in handlers:
+            base.addHandler(handler)
+        return base, None
+    log_queue = queue.SimpleQueue()
+    base.addHandler(DeferredQueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return base, listener
+
+def dispatch_eager(log, task_id, ligand_ids, addr):
+    """The previous call sites: f-strings built on every call"""
+    log.debug(f"Client {addr} requesting task")
+    log.info(f"Assigning task {task_id} ligands {', '.join(ligand_ids)} to client {addr}")
+    log.debug(f"Duplicate result for task {task_id} ligand {ligand_ids[0]} from {addr}")
+
+def dispatch_lazy(log, task_id, ligand_ids, addr):
+    log.debug("Client %s requesting task", addr)
+    log.info("Assigning task %s ligands %s to client %s", task_id, ligand_ids, addr)
+    log.debug("Duplicate result for task %s ligand %s from %s", task_id, ligand_ids[0], addr)
+
+def run(name, dispatch, wrap, asynchronous, level, formatter, ligands, threads):
+    log_dir = tempfile.mkdtemp(prefix='vortexdock_bench_log_')
+    base, listener = build_logger(name, log_dir, asynchronous, level, formatter)
+    log = ComponentLogger(base) if wrap else base
+    per_thread = ligands // threads
+    addr = ('192.168.1.20', 51234)
+
+    def worker(worker_id):
+        for i in range(per_thread):
+            dispatch(log, f'task{worker_id}', [f'ligand_{i}'], addr)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if listener is not None:
+        listener.stop()
+    return elapsed / (per_thread * threads) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark logging overhead per dispatched ligand')
+    parser.add_argument('--ligands', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    text = TextFormatter('[%(asctime)s] [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    scenarios = [
+        ('sync, eager f-strings, DEBUG (previous)', dispatch_eager, False, False, logging.DEBUG, text),
+        ('sync, lazy args, DEBUG', dispatch_lazy, True, False, logging.DEBUG, text),
+        ('async queue, lazy args, DEBUG', dispatch_lazy, True, True, logging.DEBUG, text),
+        ('async queue, lazy args, INFO', dispatch_lazy, True, True, logging.INFO, text),
+        ('async queue, lazy args, INFO, JSON', dispatch_lazy, True, True, logging.INFO, JsonFormatter()),
+        ('sync, eager f-strings, INFO', dispatch_eager, False, False, logging.INFO, text),
+    ]
+    print(f"{args.ligands} ligands, {args.threads} dispatching threads")
+    print(f"{'Scenario':<42} {'us/ligand':>10}")
+    for index, (name, dispatch, wrap, asynchronous, level, formatter) in enumerate(scenarios):
+        cost = run(f's{index}', dispatch, wrap, asynchronous, level, formatter, args.ligands, args.threads)
+        print(f"{name:<42} {cost:>10.1f}")
+
+if __name__ == '__main__':
+    main()
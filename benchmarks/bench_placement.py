@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Docking throughput of the CPU placement strategies
+
+Runs SLOTS concurrent docking workers, each docking its share of the ligands
+with the vina binary and --cpu CPUS, and reports ligands/hour with the workers
+unpinned (none) and pinned per NUMA node (compact, spread). The task directory
+has the layout of an uploaded task ZIP: receptor.pdbqt, parameter.txt and
+ligands/*.pdbqt.
+
+Usage:
+    cd benchmarks
+    python bench_placement.py TASK_DIR [--slots N] [--cpus N] [--ligands N] [--strategies none,compact,spread]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+sys.path.append('..')
+sys.path.append('../compute_node')
+from docking_backends import SubprocessBackend
+from placement import Topology, plan_slots, format_cpu_list
+from bench_backends import load_params
+
+def worker(cpus, receptor_file, ligand_files, params, out_dir, failures):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    backend = SubprocessBackend()
+    for ligand_file in ligand_files:
+        output_path, _ = backend.dock('bench', ligand_file.stem, receptor_file, ligand_file, params,
+                                      out_dir / f'{ligand_file.stem}_out.pdbqt')
+        if output_path is None:
+            with failures.get_lock():
+                failures.value += 1
+
+def run(strategy, topology, slots, receptor_file, ligand_files, params):
+    """Return (ligands/hour, failures, CPU sets used)"""
+    plan = plan_slots(topology, slots, params['cpu'], strategy)
+    out_dir = Path(tempfile.mkdtemp(prefix=f'vortexdock_bench_{strategy}_'))
+    failures = multiprocessing.Value('i', 0)
+    workers = [
+        multiprocessing.Process(target=worker, args=(plan[slot], receptor_file, ligand_files[slot::slots], params, out_dir, failures))
+        for slot in range(slots)
+    ]
+    start = time.perf_counter()
+    try:
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    elapsed = time.perf_counter() - start
+    return len(ligand_files) / elapsed * 3600, failures.value, plan
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark CPU placement strategies')
+    parser.add_argument('task_dir', help='Directory with receptor.pdbqt, parameter.txt and ligands/')
+    parser.add_argument('--slots', type=int, default=4, help='Concurrent docking workers')
+    parser.add_argument('--cpus', type=int, default=8, help='CPUs per worker (vina --cpu)')
+    parser.add_argument('--ligands', type=int, default=64)
+    parser.add_argument('--strategies', default='none,compact,spread')
+    args = parser.parse_args()
+
+    task_dir = Path(args.task_dir)
+    receptor_file = task_dir / 'receptor.pdbqt'
+    params = load_params(task_dir / 'parameter.txt', args.cpus)
+    ligand_files = sorted((task_dir / 'ligands').glob('*.pdbqt'))[:args.ligands]
+    if not ligand_files:
+        sys.exit(f"No ligands found in {task_dir / 'ligands'}")
+
+    topology = Topology.detect()
+    print(f"{len(ligand_files)} ligands, {args.slots} workers x {args.cpus} CPUs, "
+          f"{topology.cpu_count} usable CPUs on NUMA nodes {list(topology.nodes)}")
+    print(f"{'Strategy':<10} {'ligands/h':>10} {'failed':>7}  CPU sets")
+    for strategy in args.strategies.split(','):
+        rate, failures, plan = run(strategy, topology, args.slots, receptor_file, ligand_files, params)
+        cpu_sets = ' '.join(format_cpu_list(cpus) for cpus in plan if cpus) or '-'
+        print(f"{strategy:<10} {rate:>10.1f} {failures:>7}  {cpu_sets}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmark for SecureSocket.receive_message
+
+Usage:
+    cd benchmarks
+    python bench_recv.py [--rounds N]
+"""
+
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+
+sys.path.append('..')
+from utils.network import SSLContextManager, SecureSocket
+
+FRAME_SIZES = [
+    ('1 KB', 1024),
+    ('1 MB', 1024 * 1024),
+    ('32 MB', 32 * 1024 * 1024),
+]
+
+def build_frame(size):
+    """Build a length-prefixed JSON frame whose payload is roughly `size` bytes"""
+    message = json.dumps({'type': 'bench', 'payload': 'x' * size}).encode('utf-8')
+    return len(message).to_bytes(4, byteorder='big') + message
+
+def legacy_recv_exactly(sock, state, n):
+    """The previous receive loop, kept here as a baseline"""
+    while len(state['buffer']) < n:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return None
+        state['buffer'] += chunk
+    result = state['buffer'][:n]
+    state['buffer'] = state['buffer'][n:]
+    return result
+
+def legacy_receive_message(sock, state):
+    header = legacy_recv_exactly(sock, state, 4)
+    length = int.from_bytes(header, byteorder='big')
+    return json.loads(legacy_recv_exactly(sock, state, length).decode('utf-8'))
+
+def run(frame, rounds, legacy):
+    cert_dir = tempfile.mkdtemp(prefix='vortexdock_bench_')
+    ssl_manager = SSLContextManager(cert_dir)
+    server_context = ssl_manager.get_server_context()
+    client_context = ssl_manager.get_client_context()
+    server_raw, client_raw = socket.socketpair()
+
+    def sender():
+        client = SecureSocket(client_raw, client_context)
+        for _ in range(rounds):
+            client.sock.sendall(frame)
+
+    thread = threading.Thread(target=sender, daemon=True)
+    thread.start()
+    receiver = SecureSocket(server_raw, server_context, max_frame_size=len(frame))
+    state = {'buffer': b''}
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        if legacy:
+            legacy_receive_message(receiver.sock, state)
+        else:
+            receiver.receive_message()
+    elapsed = time.perf_counter() - start
+
+    thread.join()
+    receiver.close()
+    return elapsed / rounds
+
+def main():
+    parser = argparse.ArgumentParser(description='SecureSocket receive path benchmark')
+    parser.add_argument('--rounds', type=int, default=20, help='Frames received per size')
+    args = parser.parse_args()
+
+    print("Frame\tcurrent (ms)\tlegacy (ms)\tthroughput (MB/s)")
+    for label, size in FRAME_SIZES:
+        frame = build_frame(size)
+        # Fewer rounds for large frames, the legacy path is quadratic
+        rounds = max(1, args.rounds if size < 1024 * 1024 else args.rounds // 10)
+        current = run(frame, rounds, legacy=False)
+        legacy = run(frame, rounds, legacy=True)
+        throughput = len(frame) / current / (1024 * 1024)
+        print(f"{label}\t{current * 1000:.2f}\t\t{legacy * 1000:.2f}\t\t{throughput:.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import socket
+import threading
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+
+sys.path.append('..')
+from utils.logger import logger
+from utils.network import SSLContextManager, SecureSocket, FramedSocket, MultiplexedConnection, enable_keepalive
+from receptor_cache import list_cached_receptors
+
+# Set by the daemon for the client.py workers it starts when the agent is enabled
+AGENT_SOCKET_ENV = 'VORTEXDOCK_AGENT_SOCKET'
+
+def split_lease(ligands, limits):
+    """Share the ligands of one lease among waiting workers
+
+    Ligands are handed out in order, evenly first, then to workers with room
+    left; no worker gets more than its limit. Returns (parts, unassigned).
+    """
+    parts = [[] for _ in limits]
+    if not limits:
+        return parts, list(ligands)
+    share = -(-len(ligands) // len(limits))
+    index = 0
+    for i, limit in enumerate(limits):
+        take = max(min(limit, share, len(ligands) - index), 0)
+        parts[i] = list(ligands[index:index + take])
+        index += take
+    for i, limit in enumerate(limits):
+        take = max(min(limit - len(parts[i]), len(ligands) - index), 0)
+        parts[i].extend(ligands[index:index + take])
+        index += take
+    return parts, list(ligands[index:])
+
+class LocalWorker:
+    """A client.py process connected to the agent"""
+    def __init__(self, framed_sock):
+        self.sock = framed_sock
+        self.send_lock = threading.Lock()
+
+    def send(self, message):
+        with self.send_lock:
+            self.sock.send_message(message)
+
+class NodeAgent:
+    """One upstream connection to the distribution server, shared by the workers of a host
+
+    Workers connect over a Unix socket and speak the same framed protocol as
+    with the server. get_task requests arriving within lease_wait seconds of
+    each other are coalesced into one lease that is split among the workers;
+    every other command is relayed unchanged. Cancellations pushed by the
+    server are forwarded to every worker, which ignore ligands they do not hold.
+    """
+    def __init__(self, socket_path, lease_wait=0.05):
+        import config
+        self.socket_path = str(socket_path)
+        self.lease_wait = lease_wait
+        self.server_host = config.SERVER_CONFIG['host']
+        self.tcp_port = config.SERVER_CONFIG['tcp_port']
+        self.server_password = config.SERVER_CONFIG['password']
+        self.max_retries = config.TASK_CONFIG['max_retries']
+        self.retry_delay = config.TASK_CONFIG['retry_delay']
+        self.request_timeout = config.TASK_CONFIG.get('request_timeout', 60)
+        self.node_id = f"{socket.gethostname()}-agent"
+        self.receptor_cache_dir = Path('receptor_cache')
+
+        # Upstream connection, reused TLS session and token as in DockingClient
+        self.ssl_context = SSLContextManager().get_client_context()
+        self.connection = None
+        self.connect_lock = threading.Lock()
+        self.tls_session = None
+        self.session_token = None
+
+        # Connected workers, and get_task requests waiting to be coalesced
+        self.workers_lock = threading.Lock()
+        self.workers = set()
+        self.lease_cond = threading.Condition()
+        self.lease_waiters = []
+        self.executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='agent')
+        self.listen_sock = None
+
+    def connect(self):
+        """Connect and authenticate to the distribution server"""
+        retries = 0
+        while retries < self.max_retries:
+            try:
+                if self.connection:
+                    self.connection.close()
+                raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                raw_sock.connect((self.server_host, self.tcp_port))
+                enable_keepalive(raw_sock)
+                secure_sock = SecureSocket(raw_sock, self.ssl_context, session=self.tls_session)
+                auth_data = {
+                    'type': 'auth',
+                    'password': self.server_password,
+                    'node_id': self.node_id,
+                    'receptor_hashes': list_cached_receptors(self.receptor_cache_dir)
+                }
+                if self.session_token:
+                    auth_data['token'] = self.session_token
+                secure_sock.send_message(auth_data)
+                response = secure_sock.receive_message()
+                if not response or response.get('status') != 'ok':
+                    logger.error("Agent authentication failed")
+                    secure_sock.close()
+                    return False
+                self.connection = MultiplexedConnection(secure_sock, push_handler=self.handle_push)
+                self.session_token = response.get('token')
+                self.tls_session = secure_sock.session
+                logger.info(f"Agent connected to TCP server (TLS session reused: {secure_sock.session_reused})")
+                return True
+            except Exception as e:
+                retries += 1
+                logger.warning(f"Agent connection attempt {retries} failed: {e}")
+                if retries < self.max_retries:
+                    time.sleep(self.retry_delay)
+        return False
+
+    def upstream(self, data):
+        """Relay a request to the server, reconnecting once if the connection was lost
+
+        A request the server does not answer in time is not sent again, the
+        worker gets an error response instead.
+        """
+        connection = self.connection
+        if connection is not None:
+            try:
+                response = connection.request(data, timeout=self.request_timeout)
+                if response is not None:
+                    return response
+            except TimeoutError as e:
+                if not connection.closed:
+                    logger.warning(f"Agent upstream: {e}")
+                    return {'status': 'error', 'message': 'timeout'}
+            except Exception as e:
+                logger.error(f"Agent upstream error: {e}")
+        with self.connect_lock:
+            if self.connection is connection and not self.connect():
+                return None
+        try:
+            return self.connection.request(data, timeout=self.request_timeout)
+        except Exception as e:
+            logger.error(f"Agent upstream error after reconnect: {e}")
+            return None
+
+    def handle_push(self, message):
+        """Forward a message pushed by the server to every worker"""
+        with self.workers_lock:
+            workers = list(self.workers)
+        for worker in workers:
+            try:
+                worker.send(message)
+            except Exception as e:
+                logger.debug(f"Failed to forward pushed message: {e}")
+
+    def start(self):
+        """Connect upstream and start serving workers in background threads"""
+        if not self.connect():
+            logger.warning("Agent could not connect to the server, retrying on the first request")
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listen_sock.bind(self.socket_path)
+        # Only the user running the workers may connect
+        os.chmod(self.socket_path, 0o600)
+        self.listen_sock.listen(64)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        threading.Thread(target=self._lease_loop, daemon=True).start()
+        logger.info(f"Node agent listening on {self.socket_path}")
+
+    def close(self):
+        if self.listen_sock is not None:
+            self.listen_sock.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        if self.connection is not None:
+            self.connection.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.listen_sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve_worker, args=(conn,), daemon=True).start()
+
+    def _serve_worker(self, conn):
+        worker = LocalWorker(FramedSocket(conn))
+        with self.workers_lock:
+            self.workers.add(worker)
+        try:
+            while True:
+                message = worker.sock.receive_message()
+                if message is None:
+                    break
+                # Requests are answered as they complete, a waiting get_task does not hold up the others
+                self.executor.submit(self._handle_request, worker, message)
+        except Exception as e:
+            logger.debug(f"Worker connection closed: {e}")
+        finally:
+            with self.workers_lock:
+                self.workers.discard(worker)
+            worker.sock.close()
+
+    def _handle_request(self, worker, message):
+        request_id = message.pop('request_id', None)
+        if message.get('type') == 'auth':
+            # The socket is only reachable by local workers, the agent authenticates upstream
+            response = {'status': 'ok'}
+        elif message.get('type') == 'get_task':
+            response = self._lease(message)
+        elif message.get('type') in ('release', 'renew'):
+            # Leases were taken in the agent's name
+            response = self.upstream(dict(message, node_id=self.node_id))
+        else:
+            response = self.upstream(message)
+        if response is None:
+            # Lost upstream: the worker sees the same as a dropped connection
+            worker.sock.close()
+            return
+        if request_id is not None:
+            response = dict(response, request_id=request_id)
+        try:
+            worker.send(response)
+        except Exception as e:
+            logger.debug(f"Failed to answer worker: {e}")
+
+    def _lease(self, command):
+        """Queue a get_task for the next coalesced lease and wait for its share"""
+        future = Future()
+        with self.lease_cond:
+            self.lease_waiters.append((command, future))
+            self.lease_cond.notify()
+        return future.result()
+
+    def _lease_loop(self):
+        while True:
+            with self.lease_cond:
+                while not self.lease_waiters:
+                    self.lease_cond.wait()
+            # Let requests from other workers arrive before asking the server
+            time.sleep(self.lease_wait)
+            with self.lease_cond:
+                waiters, self.lease_waiters = self.lease_waiters, []
+            try:
+                self._serve_leases(waiters)
+            except Exception as e:
+                logger.error(f"Error coalescing leases: {e}")
+                for _, future in waiters:
+                    if not future.done():
+                        future.set_result(None)
+
+    def _serve_leases(self, waiters):
+        # Traces of all waiting workers ride on the first upstream request
+        traces = [trace for command, _ in waiters for trace in command.get('traces', [])]
+        while waiters:
+            limits = [max(int(command.get('max_batch', 1)), 1) for command, _ in waiters]
+            request = {'type': 'get_task', 'max_batch': sum(limits)}
+            if traces:
+                request['traces'], traces = traces, []
+            response = self.upstream(request)
+            if not response or response.get('task_id') is None or response.get('status') == 'error':
+                for _, future in waiters:
+                    future.set_result(response)
+                return
+
+            ligands = response.get('ligands') or [{'ligand_id': response['ligand_id'], 'ligand_file': response['ligand_file']}]
+            parts, unassigned = split_lease(ligands, limits)
+            if unassigned:
+                logger.warning(f"Server leased {len(ligands)} ligands for {sum(limits)} requested, "
+                               f"{len(unassigned)} left to time out")
+            logger.debug("Split lease of task %s into %d parts", response['task_id'], sum(1 for part in parts if part))
+            remaining = []
+            for (command, future), part in zip(waiters, parts):
+                if not part:
+                    remaining.append((command, future))
+                    continue
+                future.set_result(dict(
+                    response,
+                    ligands=part,
+                    ligand_id=part[0]['ligand_id'],
+                    ligand_file=part[0]['ligand_file']
+                ))
+            waiters = remaining
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+if __name__ == '__main__':
+    import config
+    agent_socket = getattr(config, 'PROCESS_CONFIG', {}).get('agent_socket', 'agent.sock')
+    NodeAgent(os.path.abspath(agent_socket), getattr(config, 'PROCESS_CONFIG', {}).get('agent_lease_wait', 0.05)).serve_forever()
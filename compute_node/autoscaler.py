@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import subprocess
+from collections import namedtuple
+
+import psutil
+
+# One measurement of the host, taken every autoscale_interval seconds
+ResourceSample = namedtuple('ResourceSample', [
+    'cpu_count',         # logical CPUs
+    'foreign_cpus',      # CPUs busy with work other than our workers and their vina children
+    'available_memory',  # MB
+    'load_average',      # 1 minute load average
+    'pending_ligands',   # ligands waiting on the server, None if unknown
+    'user_idle',         # seconds since the last keyboard/mouse input, None if nobody is logged in
+])
+
+class Autoscaler:
+    """Decides how many docking workers a shared host can run
+
+    The capacity is what is left after other users' CPU and memory use, the
+    load average and the server's queue depth. Scaling up needs capacity to be
+    above the current count for scale_up_delay seconds and adds one worker at a
+    time; scaling down waits scale_down_delay seconds, except under memory
+    pressure or user activity, which take effect at once.
+    """
+    def __init__(self, min_workers, max_workers, cpus_per_worker=1, memory_per_worker=100,
+                 reserve_cpus=0, reserve_memory=512, max_load_per_cpu=1.25,
+                 scale_up_delay=30, scale_down_delay=60,
+                 user_idle_threshold=300, user_active_workers=0):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.cpus_per_worker = max(cpus_per_worker, 0.1)
+        self.memory_per_worker = max(memory_per_worker, 1)
+        self.reserve_cpus = reserve_cpus
+        self.reserve_memory = reserve_memory
+        self.max_load_per_cpu = max_load_per_cpu
+        self.scale_up_delay = scale_up_delay
+        self.scale_down_delay = scale_down_delay
+        self.user_idle_threshold = user_idle_threshold
+        self.user_active_workers = user_active_workers
+        self.above_since = None
+        self.below_since = None
+
+    def capacity(self, current, sample):
+        """Return (workers the host can take, reason, urgent)"""
+        if sample.user_idle is not None and sample.user_idle < self.user_idle_threshold:
+            return min(self.user_active_workers, self.max_workers), 'user active', True
+
+        # Our workers' memory is already counted as used
+        memory_room = (sample.available_memory - self.reserve_memory) / self.memory_per_worker
+        if memory_room < 0:
+            return max(current + int(memory_room) - 1, 0), 'memory pressure', True
+        by_memory = current + int(memory_room)
+
+        by_cpu = int((sample.cpu_count - sample.foreign_cpus - self.reserve_cpus) / self.cpus_per_worker)
+        target, reason = min((by_memory, 'memory'), (by_cpu, 'cpu'))
+
+        # The load average also counts processes waiting on I/O or a saturated scheduler
+        if sample.load_average > sample.cpu_count * self.max_load_per_cpu and target >= current:
+            target, reason = current - 1, 'load average'
+        if sample.pending_ligands is not None and sample.pending_ligands < target:
+            target, reason = sample.pending_ligands, 'server queue'
+        return min(max(target, self.min_workers, 0), self.max_workers), reason, False
+
+    def decide(self, current, sample, now=None):
+        """Return (worker count to run now, reason)"""
+        now = time.monotonic() if now is None else now
+        target, reason, urgent = self.capacity(current, sample)
+        if target > current:
+            self.below_since = None
+            if self.above_since is None:
+                self.above_since = now
+            if now - self.above_since >= self.scale_up_delay:
+                self.above_since = now
+                return current + 1, reason
+        elif target < current:
+            self.above_since = None
+            if urgent:
+                self.below_since = None
+                return target, reason
+            if self.below_since is None:
+                self.below_since = now
+            if now - self.below_since >= self.scale_down_delay:
+                self.below_since = now
+                return current - 1, reason
+        else:
+            self.above_since = None
+            self.below_since = None
+        return current, reason
+
+class ResourceMonitor:
+    """Measures the host for the autoscaler, separating our workers' CPU from everyone else's"""
+    def __init__(self):
+        self.cpu_count = psutil.cpu_count() or 1
+        self.last_time = None
+        self.last_worker_cpu = {}
+        # Host CPU usage of the last sample, also shown in the daemon status
+        self.cpu_percent = None
+        # Our own baseline: psutil.cpu_percent(interval=None) measures since whichever
+        # caller in the process asked last, such as the heartbeat thread
+        self.last_cpu_times = self._host_cpu_times()
+
+    @staticmethod
+    def _host_cpu_times():
+        """(busy, total) CPU seconds of the host since boot"""
+        times = psutil.cpu_times()
+        # Guest time is already included in user and nice time on Linux
+        total = sum(times) - getattr(times, 'guest', 0) - getattr(times, 'guest_nice', 0)
+        idle = times.idle + getattr(times, 'iowait', 0)
+        return total - idle, total
+
+    @staticmethod
+    def _tree_cpu_seconds(pid):
+        """CPU seconds of a worker, its running children and the children it has reaped"""
+        process = psutil.Process(pid)
+        times = process.cpu_times()
+        total = times.user + times.system + times.children_user + times.children_system
+        for child in process.children(recursive=True):
+            try:
+                child_times = child.cpu_times()
+                total += child_times.user + child_times.system
+            except psutil.Error:
+                pass
+        return total
+
+    def sample(self, worker_pids, pending_ligands=None):
+        now = time.monotonic()
+        busy, total = self._host_cpu_times()
+        last_busy, last_total = self.last_cpu_times
+        self.last_cpu_times = (busy, total)
+        busy_fraction = min(max((busy - last_busy) / (total - last_total), 0.0), 1.0) if total > last_total else 0.0
+        self.cpu_percent = busy_fraction * 100
+        busy_cpus = busy_fraction * self.cpu_count
+
+        worker_cpu = {}
+        for pid in worker_pids:
+            try:
+                worker_cpu[pid] = self._tree_cpu_seconds(pid)
+            except psutil.Error:
+                pass
+        own_cpus = 0.0
+        if self.last_time is not None and now > self.last_time:
+            elapsed = now - self.last_time
+            own_cpus = sum(max(seconds - self.last_worker_cpu.get(pid, seconds), 0)
+                           for pid, seconds in worker_cpu.items()) / elapsed
+        self.last_time = now
+        self.last_worker_cpu = worker_cpu
+
+        return ResourceSample(
+            cpu_count=self.cpu_count,
+            foreign_cpus=max(busy_cpus - own_cpus, 0),
+            available_memory=psutil.virtual_memory().available / (1024 * 1024),
+            load_average=psutil.getloadavg()[0],
+            pending_ligands=pending_ligands,
+            user_idle=user_idle_seconds()
+        )
+
+def user_idle_seconds():
+    """Seconds since the last input from a logged-in user, None if nobody is logged in
+
+    Terminal sessions are judged by the access time of their tty, desktop
+    sessions by xprintidle when it is installed.
+    """
+    idle_times = []
+    now = time.time()
+    for user in psutil.users():
+        terminal = user.terminal or ''
+        device = os.path.join('/dev', terminal)
+        if terminal and os.path.exists(device):
+            try:
+                idle_times.append(max(now - os.stat(device).st_atime, 0))
+            except OSError:
+                pass
+    if os.environ.get('DISPLAY') and shutil.which('xprintidle'):
+        try:
+            output = subprocess.run(['xprintidle'], capture_output=True, text=True, timeout=2).stdout
+            idle_times.append(int(output.strip()) / 1000)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            pass
+    return min(idle_times) if idle_times else None
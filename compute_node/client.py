@@ -5,16 +5,30 @@ import json
 import time
 import socket
 import requests
-import subprocess
 import threading
 import shutil
-from datetime import datetime
+import tarfile
+import tempfile
+from collections import deque
 from pathlib import Path
 
 import sys
 sys.path.append('..')
 from utils.logger import logger
-from utils.network import SSLContextManager, SecureSocket
+from utils.network import SSLContextManager, SecureSocket, FramedSocket, MultiplexedConnection, enable_keepalive
+from receptor_cache import (cached_receptor_path, list_cached_receptors, grid_maps_key, cached_grid_maps_dir,
+                            pack_grid_maps, unpack_grid_maps, cache_file_lock, GRID_MAPS_ARCHIVE, GRID_MAPS_PREFIX)
+from docking_backends import create_backend
+from status import StatusReporter
+from placement import apply_worker_affinity
+from agent import AGENT_SOCKET_ENV
+from journal import WorkJournal
+from workdir import WorkDirIndex, remove_legacy_task_dirs
+from scratch import ScratchSpace
+from vina_output import read_output_modes
+
+# Vina progress output, its level is configured with LOG_CONFIG['components']['vina']
+vina_logger = logger.get_component('vina')
 
 class DockingClient:
     def __init__(self):
@@ -31,12 +45,66 @@ class DockingClient:
         self.max_retries = config.TASK_CONFIG['max_retries']
         self.retry_delay = config.TASK_CONFIG['retry_delay']
         self.task_timeout = config.TASK_CONFIG['task_timeout']
+        # The server's lease timeout, updated from each lease; held ligands are renewed three times per timeout
+        self.lease_timeout = 300
         self.cleanup_interval = config.TASK_CONFIG['cleanup_interval']
         self.cleanup_age = config.TASK_CONFIG['cleanup_age']
+        self.max_batch = config.TASK_CONFIG.get('max_batch', 32)
+        # 'subprocess' runs the vina binary per ligand, 'vina_python' keeps engines and maps in child processes
+        self.backend = create_backend(
+            config.TASK_CONFIG.get('docking_backend', 'subprocess'),
+            timeout=self.task_timeout,
+            max_engines=config.TASK_CONFIG.get('docking_max_engines', 2)
+        )
+        logger.info(f"Using docking backend: {self.backend.name}")
+        # Dock a whole lease in one vina run (requires vina 1.2 --batch)
+        self.batch_docking = config.TASK_CONFIG.get('batch_docking', False)
+        if self.batch_docking and not self.backend.supports_batch:
+            logger.warning("Batch docking needs vina 1.2 or later, docking ligands one at a time")
+            self.batch_docking = False
+        # Load precomputed grid maps instead of recomputing them in every vina run (requires vina 1.2)
+        self.grid_maps = config.TASK_CONFIG.get('grid_maps', False)
+        if self.grid_maps and not self.backend.supports_maps:
+            logger.warning("Grid maps are not available with the %s backend and this vina, docking against the receptor",
+                           self.backend.name)
+            self.grid_maps = False
+        self.maps_lock = threading.Lock()
+        self.failed_maps = set()
+        # CPUs of the docking slot assigned by the daemon, vina's --cpu follows the slot size
+        try:
+            self.cpus = apply_worker_affinity()
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to apply CPU placement: {e}")
+            self.cpus = None
+        if self.cpus:
+            logger.info(f"Pinned to CPUs {self.cpus}")
+        # State shown by the daemon, sent only when started by daemon.py
+        self.status = StatusReporter()
+        # Stable identity for the server's per-node throughput statistics
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}"
         
-        # Create necessary directories
-        self.work_dir = Path('work_dir')
-        self.work_dir.mkdir(exist_ok=True)
+        # Leases and results survive a crash or reboot, replayed once connected
+        self.journal = WorkJournal()
+        self.recovered_tasks = deque()
+        
+        # Each worker has its own work directory, named like its journal, so a
+        # restarted worker finds the outputs its journal refers to
+        work_root = Path('work_dir')
+        self.work_dir = work_root / self.journal.path.stem
+        self.workdir = WorkDirIndex(
+            self.work_dir,
+            max_bytes=config.TASK_CONFIG.get('work_dir_max_size', 0) * 1024 * 1024,
+            min_free_bytes=config.TASK_CONFIG.get('work_dir_min_free', 0) * 1024 * 1024
+        )
+        remove_legacy_task_dirs(work_root, self.cleanup_age)
+        # Ligands and vina's outputs go to tmpfs when scratch_dir is set and memory allows,
+        # outputs are moved to disk only when their submit fails
+        self.scratch = ScratchSpace(
+            self.work_dir,
+            config.TASK_CONFIG.get('scratch_dir'),
+            self.journal.path.stem,
+            min_free_bytes=config.TASK_CONFIG.get('scratch_min_free', 1024) * 1024 * 1024
+        )
         
         # Create receptor cache directory
         self.receptor_cache_dir = Path('receptor_cache')
@@ -46,6 +114,14 @@ class DockingClient:
         self.ssl_context = SSLContextManager().get_client_context()
         self.sock = None
         self.secure_sock = None
+        # Shared by the main loop and the precache thread, responses are matched by request ID
+        self.connection = None
+        # Reused on reconnect to skip the full TLS handshake and the server-side bcrypt check
+        self.tls_session = None
+        self.session_token = None
+        self.request_timeout = config.TASK_CONFIG.get('request_timeout', 60)
+        # Set when the host runs a node agent: talk to it instead of the server
+        self.agent_socket = os.environ.get(AGENT_SOCKET_ENV)
         
         # Initialize cache-related variables
         self.cache_lock = threading.Lock()
@@ -53,12 +129,25 @@ class DockingClient:
         self.next_task = None
         self.next_task_files = {}
         
+        # Running vina processes by (task_id, ligand_id), so the server can cancel duplicates
+        self.process_lock = threading.Lock()
+        self.active_processes = {}
+        self.cancelled_ligands = set()
+        self.cancelled_tasks = set()
+        
+        # Lifecycle traces of finished ligands, reported with the next request
+        self.trace_lock = threading.Lock()
+        self.pending_traces = []
+        self.max_pending_traces = 1000
+        
         # Connect and authenticate
         if not self.connect_tcp():
             raise ConnectionError("Unable to connect to server")
+        self._recover_journal()
         
-        # Start cleanup thread
+        # Start cleanup and lease renewal threads
         self._start_cleanup_thread()
+        self._start_renewal_thread()
         logger.info("DockingClient initialized successfully")
     
     def connect_tcp(self):
@@ -67,23 +156,32 @@ class DockingClient:
         retries = 0
         while retries < self.max_retries:
             try:
-                if self.secure_sock:
+                if self.connection:
                     try:
-                        self.secure_sock.close()
+                        self.connection.close()
                         logger.debug("Closed existing secure socket connection")
                     except Exception as e:
                         logger.debug(f"Error closing existing secure socket: {e}")
                 
+                if self.agent_socket:
+                    return self._connect_agent()
+                
                 # Create a new socket and establish a TLS connection
                 raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 raw_sock.connect((self.server_host, self.tcp_port))
-                self.secure_sock = SecureSocket(raw_sock, self.ssl_context)
+                enable_keepalive(raw_sock)
+                self.secure_sock = SecureSocket(raw_sock, self.ssl_context, session=self.tls_session)
                 
                 # Send authentication information
                 auth_data = {
                     'type': 'auth',
-                    'password': self.server_password
+                    'password': self.server_password,
+                    'node_id': self.node_id
                 }
+                if self.session_token:
+                    auth_data['token'] = self.session_token
+                # Report cached receptors so the server can prefer tasks we already hold
+                auth_data['receptor_hashes'] = list_cached_receptors(self.receptor_cache_dir)
                 self.secure_sock.send_message(auth_data)
                 
                 # Wait for authentication result
@@ -92,7 +190,10 @@ class DockingClient:
                     logger.error("Authentication failed")
                     return False
                 
-                logger.info("Successfully connected and authenticated to TCP server")
+                self.connection = MultiplexedConnection(self.secure_sock, push_handler=self.handle_push)
+                self.session_token = response.get('token')
+                self.tls_session = self.secure_sock.session
+                logger.info(f"Successfully connected and authenticated to TCP server (TLS session reused: {self.secure_sock.session_reused})")
                 return True
             except Exception as e:
                 retries += 1
@@ -104,34 +205,152 @@ class DockingClient:
         logger.error("Failed to connect to TCP server after maximum retries")
         return False
     
-    def get_task(self):
-        """Get task from server, supporting automatic reconnection"""
+    def _connect_agent(self):
+        """Connect to the host's node agent, which holds the authenticated server connection"""
+        raw_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        raw_sock.connect(self.agent_socket)
+        self.secure_sock = FramedSocket(raw_sock)
+        self.secure_sock.send_message({'type': 'auth', 'node_id': self.node_id})
+        response = self.secure_sock.receive_message()
+        if not response or response.get('status') != 'ok':
+            logger.error("Node agent refused the connection")
+            return False
+        self.connection = MultiplexedConnection(self.secure_sock, push_handler=self.handle_push)
+        logger.info(f"Connected to node agent at {self.agent_socket}")
+        return True
+    
+    def request(self, data):
+        """Send a request over the shared connection, reconnecting once if it was lost
+
+        Returns None if the connection could not be restored, or if the server
+        did not answer within request_timeout; a command that timed out is not
+        sent again.
+
+        Traces of finished ligands are attached to the request and kept for
+        the next one if the request fails.
+        """
+        with self.trace_lock:
+            traces, self.pending_traces = self.pending_traces, []
+        if traces:
+            data = dict(data, traces=traces)
+        response = self._request(data)
+        if response is None and traces:
+            with self.trace_lock:
+                self.pending_traces = (traces + self.pending_traces)[-self.max_pending_traces:]
+        return response
+    
+    def _request(self, data):
+        connection = self.connection
         try:
-            # Check connection status and try to send data
-            self.secure_sock.send_message({'type': 'get_task'})
-            response = self.secure_sock.receive_message()
-            if not response:
-                # Only reconnect if the connection is actually lost
-                if self.connect_tcp():
-                    return self.get_task()
-                return {'task_id': None}
-            return response
+            response = connection.request(data, timeout=self.request_timeout)
+            if response is not None:
+                return response
+        except TimeoutError as e:
+            if not connection.closed:
+                # The server is slow, not gone: it may still act on the command, so sending
+                # it again could lease the same ligands twice. The late response is dropped.
+                logger.warning(f"{e}, giving up on this request")
+                return None
         except Exception as e:
-            logger.error(f"Error getting task: {e}")
-            # Only attempt to reconnect if there is a connection error
-            if self.connect_tcp():
-                return self.get_task()
+            logger.error(f"TCP communication error: {e}")
+        
+        # Only reconnect if no other thread has already replaced the connection
+        with self.sock_lock:
+            if self.connection is connection and not self.connect_tcp():
+                return None
+        try:
+            return self.connection.request(data, timeout=self.request_timeout)
+        except Exception as e:
+            logger.error(f"TCP communication error after reconnect: {e}")
+            return None
+    
+    def handle_push(self, message):
+        """Handle a message pushed by the server outside of any request"""
+        if message.get('type') == 'cancel':
+            self.cancel_ligands(message.get('task_id'), message.get('ligand_ids'))
+        else:
+            logger.debug(f"Ignoring pushed message: {message.get('type')}")
+    
+    def cancel_ligands(self, task_id, ligand_ids=None):
+        """Stop docking ligands the server no longer needs
+
+        Without ligand_ids the whole task was paused or removed: every running
+        ligand of the task is killed and a prefetched lease for it is dropped.
+        """
+        with self.process_lock:
+            if ligand_ids is None:
+                self.cancelled_tasks.add(task_id)
+            else:
+                # Only ligands this worker holds: the agent forwards every cancel to every
+                # worker, and a cancel for a finished ligand would never be cleared
+                self.cancelled_ligands.update(
+                    (task_id, ligand_id) for ligand_id in ligand_ids
+                    if (task_id, ligand_id) in self.active_processes or self.journal.holds(task_id, ligand_id)
+                )
+            for (running_task, ligand_id), process in self.active_processes.items():
+                if running_task != task_id or (ligand_ids is not None and ligand_id not in ligand_ids):
+                    continue
+                if process.poll() is None:
+                    logger.info(f"Cancelling task {task_id} ligand {ligand_id}")
+                    process.kill()
+        
+        if ligand_ids is None:
+            with self.cache_lock:
+                if self.next_task is not None and self.next_task.get('task_id') == task_id:
+                    logger.info(f"Dropping prefetched lease for cancelled task {task_id}")
+                    for ligand in self._lease_ligands(self.next_task):
+                        self._finish_ligand(task_id, ligand['ligand_id'], 'cancelled')
+                    self.next_task = None
+                    self.next_task_files = {}
+    
+    def _is_cancelled(self, task_id, ligand_id=None):
+        with self.process_lock:
+            return task_id in self.cancelled_tasks or (task_id, ligand_id) in self.cancelled_ligands
+    
+    def _pop_cancelled(self, task_id, ligand_id):
+        with self.process_lock:
+            if (task_id, ligand_id) in self.cancelled_ligands:
+                self.cancelled_ligands.discard((task_id, ligand_id))
+                return True
+            return task_id in self.cancelled_tasks
+    
+    def get_task(self):
+        """Get task from server, supporting automatic reconnection"""
+        requested_at = time.time()
+        response = self.request({'type': 'get_task', 'max_batch': self.max_batch})
+        if not response or response.get('status') == 'error':
             return {'task_id': None}
+        if response.get('task_id') is not None:
+            response['requested_at'] = requested_at
+            response['leased_at'] = time.time()
+            self.lease_timeout = response.get('lease_timeout') or self.lease_timeout
+            if self.cpus and response.get('params'):
+                response['params']['cpu'] = len(self.cpus)
+            # A new lease after a cancellation means the task was resumed
+            with self.process_lock:
+                self.cancelled_tasks.discard(response['task_id'])
+            self.journal.lease(response, self.node_id)
+        return response
 
-    def download_input(self, task_id, filename):
-        """Download input file, supporting automatic retry"""
+    def download_input(self, task_id, filename, receptor_hash=None, ligand_id=None):
+        """Download input file, supporting automatic retry
+
+        The file is registered in the work directory index, owned by ligand_id
+        if given so that it is deleted once the ligand's result is acknowledged.
+        """
+        input_path = self._fetch_input(task_id, filename, receptor_hash)
+        if input_path:
+            self.workdir.add(task_id, input_path, ligand_id)
+        return input_path
+    
+    def _fetch_input(self, task_id, filename, receptor_hash=None):
         logger.info(f"Downloading input file: {filename} for task {task_id}")
-        retries = 0
         
-        # If it is a receptor file, check the cache first
+        # If it is a receptor file, check the cache first. The cache is shared by the
+        # workers of the host: one of them downloads a receptor, the others wait for it
         if filename == 'receptor.pdbqt':
-            with self.receptor_cache_lock:  # Lock
-                cached_receptor = self.receptor_cache_dir / f"{task_id}_receptor.pdbqt"
+            cached_receptor = cached_receptor_path(self.receptor_cache_dir, task_id, receptor_hash)
+            with self.receptor_cache_lock, cache_file_lock(self.receptor_cache_dir, cached_receptor.name):
                 if cached_receptor.exists():
                     logger.info(f"Using cached receptor file (Task ID: {task_id})")
                     task_dir = self.work_dir / str(task_id)
@@ -139,19 +358,23 @@ class DockingClient:
                     receptor_dest = task_dir / filename
                     shutil.copy2(cached_receptor, receptor_dest)
                     return receptor_dest
-        
+                return self._download_file(task_id, filename, cached_receptor)
+        return self._download_file(task_id, filename)
+    
+    def _download_file(self, task_id, filename, cache_path=None):
+        """Download a task file with retries, copying it to cache_path if given"""
+        retries = 0
         while retries < self.max_retries:
             try:
                 task_dir = self.work_dir / str(task_id)
                 task_dir.mkdir(exist_ok=True)
-                logger.debug(f"Created task directory: {task_dir}")
+                logger.debug("Created task directory: %s", task_dir)
                 
                 if filename == 'receptor.pdbqt':
                     file_dir = task_dir
                 else:
-                    ligand_dir = task_dir / 'ligands'
-                    ligand_dir.mkdir(exist_ok=True)
-                    file_dir = ligand_dir
+                    # Streamed straight into the scratch directory
+                    file_dir = self.scratch.ligand_dir(task_id)
                 
                 url = f'{self.http_base_url}/download/{task_id}/{filename}'
                 input_path = file_dir / filename
@@ -164,68 +387,138 @@ class DockingClient:
                         if chunk:
                             f.write(chunk)
                 
-                # If it is a receptor file, save it to the cache
-                if filename == 'receptor.pdbqt':
-                    with self.receptor_cache_lock:  # Lock
-                        cached_receptor = self.receptor_cache_dir / f"{task_id}_receptor.pdbqt"
-                        shutil.copy2(input_path, cached_receptor)
-                        logger.info(f"Cached receptor file (Task ID: {task_id})")
+                # If it is a receptor file, save it to the cache, renamed into place once complete
+                if cache_path is not None:
+                    temp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+                    shutil.copy2(input_path, temp_path)
+                    os.replace(temp_path, cache_path)
+                    logger.info("Cached receptor file (Task ID: %s)", task_id)
                 return input_path
             
             except (requests.exceptions.RequestException, IOError) as e:
                 retries += 1
-                logger.warning(f"Download attempt {retries} failed: {e}")
+                logger.warning("Download attempt %s failed: %s", retries, e)
                 if retries < self.max_retries:
-                    logger.debug(f"Retrying download in {self.retry_delay} seconds")
+                    logger.debug("Retrying download in %s seconds", self.retry_delay)
                     time.sleep(self.retry_delay)
                 elif input_path.exists():
-                    logger.debug(f"Cleaning up failed download: {input_path}")
+                    logger.debug("Cleaning up failed download: %s", input_path)
                     input_path.unlink()
         
         return None
     
-    def submit_result(self, task_id, ligand_id, output_file):
+    def get_grid_maps(self, task, receptor_file):
+        """Prefix of the grid maps for the task's receptor and search box, None to dock without maps
+
+        Maps are cached next to the receptors, so tasks with the same receptor
+        and box reuse them on this node. The server keeps maps per task: on a
+        miss they are downloaded for this task, or computed here and uploaded
+        for the other nodes if no node has done so yet.
+        """
+        if not self.grid_maps or not receptor_file:
+            return None
+        task_id = task['task_id']
+        key = grid_maps_key(task_id, task.get('receptor_hash'), task['params'])
+        map_dir = cached_grid_maps_dir(self.receptor_cache_dir, key)
+        map_dir.parent.mkdir(parents=True, exist_ok=True)
+        with self.maps_lock, cache_file_lock(map_dir.parent, key):
+            if map_dir.is_dir():
+                return map_dir / GRID_MAPS_PREFIX
+            if key in self.failed_maps:
+                return None
+            # Maps are assembled in a staging directory and renamed into place once complete
+            staging = Path(tempfile.mkdtemp(prefix=f'{key}.', dir=map_dir.parent))
+            try:
+                if not self._download_grid_maps(task_id, staging) and \
+                        not self._compute_grid_maps(task_id, receptor_file, task['params'], staging):
+                    logger.warning(f"Grid maps unavailable for task {task_id}, docking against the receptor")
+                    self.failed_maps.add(key)
+                    return None
+                try:
+                    os.replace(staging, map_dir)
+                except OSError:
+                    # Installed by a worker that does not share this lock, e.g. another cache mount
+                    if not map_dir.is_dir():
+                        raise
+                return map_dir / GRID_MAPS_PREFIX
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+    
+    def _download_grid_maps(self, task_id, map_dir):
+        """Fetch maps another node uploaded for the task, False if there are none yet"""
+        archive_path = map_dir / GRID_MAPS_ARCHIVE
+        try:
+            response = requests.get(f'{self.http_base_url}/download/{task_id}/{GRID_MAPS_ARCHIVE}', stream=True)
+            if response.status_code == 404:
+                return False
+            response.raise_for_status()
+            with open(archive_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=65536):
+                    f.write(chunk)
+            unpack_grid_maps(archive_path, map_dir)
+            logger.info(f"Downloaded grid maps for task {task_id}")
+            return True
+        except (requests.exceptions.RequestException, OSError, ValueError, tarfile.TarError) as e:
+            logger.warning(f"Failed to download grid maps for task {task_id}: {e}")
+            for path in map_dir.iterdir():
+                path.unlink()
+            return False
+        finally:
+            if archive_path.exists():
+                archive_path.unlink()
+    
+    def _compute_grid_maps(self, task_id, receptor_file, params, map_dir):
+        """Compute the maps locally and share them through the server"""
+        logger.info(f"Computing grid maps for task {task_id}")
+        if not self.backend.write_maps(receptor_file, params, map_dir / GRID_MAPS_PREFIX):
+            return False
+        archive_path = map_dir.parent / f'{map_dir.name}.tar.gz'
+        try:
+            pack_grid_maps(map_dir, archive_path)
+            with open(archive_path, 'rb') as f:
+                response = requests.post(f'{self.http_base_url}/upload/maps/{task_id}', files={'file': f})
+            response.raise_for_status()
+            logger.info(f"Uploaded grid maps for task {task_id}")
+        except (requests.exceptions.RequestException, OSError) as e:
+            # The maps are still used locally, other nodes compute their own
+            logger.warning(f"Failed to upload grid maps for task {task_id}: {e}")
+        finally:
+            if archive_path.exists():
+                archive_path.unlink()
+        return True
+    
+    def submit_result(self, task_id, ligand_id, output_file, trace=None, modes=None):
         """Submit task result, supporting automatic retry"""
+        trace = trace if trace is not None else {}
+        # Read once and upload from memory, retries do not touch the file again
+        try:
+            data = output_file.read_bytes()
+        except OSError as e:
+            logger.error(f"Error: Output file {output_file} cannot be read: {e}")
+            return False
         retries = 0
         while retries < self.max_retries:
             try:
-                if not output_file.exists():
-                    logger.error(f"Error: Output file {output_file} does not exist")
-                    return False
-                
                 # Upload result file
-                with open(output_file, 'rb') as f:
-                    files = {'file': f}
-                    url = f'{self.http_base_url}/upload/result/{task_id}/{output_file.name}'
-                    response = requests.post(url, files=files)
-                    response.raise_for_status()
+                trace['upload_start'] = time.time()
+                url = f'{self.http_base_url}/upload/result/{task_id}/{output_file.name}'
+                response = requests.post(url, files={'file': (output_file.name, data)}, data={'ligand_id': ligand_id})
+                if response.status_code == 410:
+                    logger.info(f"Task {task_id} was removed on the server, discarding result")
+                    return False
+                response.raise_for_status()
+                trace['upload_end'] = time.time()
                 
                 # Update task status
-                data = {
+                response = self.request({
                     'type': 'submit_result',
                     'task_id': task_id,
                     'ligand_id': ligand_id,
-                    'output_file': output_file.name
-                }
-                try:
-                    self.secure_sock.send_message(data)
-                    response = self.secure_sock.receive_message()
-                    if response and response.get('status') == 'ok':
-                        return True
-                    # Only reconnect if the connection is actually lost
-                    if not response and self.connect_tcp():
-                        self.secure_sock.send_message(data)
-                        response = self.secure_sock.receive_message()
-                        return response and response.get('status') == 'ok'
-                    return False
-                except Exception as e:
-                    logger.error(f"TCP communication error: {e}")
-                    # Only attempt to reconnect if there is a connection error
-                    if self.connect_tcp():
-                        self.secure_sock.send_message(data)
-                        response = self.secure_sock.receive_message()
-                        return response and response.get('status') == 'ok'
-                    return False
+                    'output_file': output_file.name,
+                    'modes': modes or []
+                })
+                trace['acked_at'] = time.time()
+                return bool(response and response.get('status') == 'ok')
             
             except requests.exceptions.RequestException as e:
                 retries += 1
@@ -236,83 +529,62 @@ class DockingClient:
         
         return False
     
-    def run_vina(self, task_id, ligand_id, receptor_file, ligand_file, params):
-        """Execute vina molecular docking command"""
+    def run_vina(self, task_id, ligand_id, receptor_file, ligand_file, params, maps=None):
+        """Dock one ligand with the configured backend
+
+        Returns (output_path, modes), where modes is the parsed result table
+        (mode, affinity, rmsd_lb, rmsd_ub per pose); output_path is None on failure.
+        """
         logger.info(f"Starting Vina docking for task {task_id}, ligand {ligand_id}")
-        task_dir = self.work_dir / str(task_id)
+        # The output is written next to the ligand, on scratch space if the ligand is
         output_file = f"{ligand_id}_out.pdbqt"
-        output_path = task_dir / output_file
+        output_path = Path(ligand_file).parent / output_file
         logger.debug(f"Output will be saved to: {output_path}")
         
-        vina_path = os.path.join(os.path.dirname(__file__), 'vina')
-        cmd = [
-            vina_path,
-            '--receptor', str(receptor_file),
-            '--ligand', str(ligand_file),
-            '--center_x', str(params['center_x']),
-            '--center_y', str(params['center_y']),
-            '--center_z', str(params['center_z']),
-            '--size_x', str(params['size_x']),
-            '--size_y', str(params['size_y']),
-            '--size_z', str(params['size_z']),
-            '--num_modes', str(params['num_modes']),
-            '--energy_range', str(params['energy_range']),
-            '--cpu', str(params['cpu']),
-            '--out', str(output_path)
-        ]
+        def register_process(process):
+            with self.process_lock:
+                self.active_processes[(task_id, ligand_id)] = process
+                if task_id in self.cancelled_tasks or (task_id, ligand_id) in self.cancelled_ligands:
+                    process.kill()
         
+        if self._is_cancelled(task_id, ligand_id):
+            return None, []
+        self.status.update(state='docking', task_id=task_id, ligand_id=ligand_id)
         try:
-            # Use Popen to get real-time output
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-            
-            # Process output in real-time
-            while True:
-                output = process.stdout.readline()
-                if output == '' and process.poll() is not None:
-                    break
-                if output:
-                    # Parse progress information from output
-                    if 'Writing output' in output:
-                        logger.info(f"Task {task_id} ligand {ligand_id}: Docking completed, writing results")
-                    elif 'Reading input' in output:
-                        logger.info(f"Task {task_id} ligand {ligand_id}: Reading input files")
-                    elif 'Performing search' in output:
-                        logger.info(f"Task {task_id} ligand {ligand_id}: Performing docking search")
-                    else:
-                        logger.debug(output.strip())
-            
-            # Check process return value
-            if process.returncode == 0:
-                return output_path if output_path.exists() else None
-            else:
-                logger.error(f"Vina process failed with return code {process.returncode}")
-                return None
-                
-        except subprocess.TimeoutExpired:
-            logger.error(f"Task {task_id} ligand {ligand_id} timed out after {self.task_timeout} seconds")
-            return None
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Vina execution failed: {e}")
-            return None
+            output_path, modes = self.backend.dock(task_id, ligand_id, receptor_file, ligand_file, params,
+                                                   output_path, on_process=register_process, maps=maps)
+            if output_path and modes:
+                vina_logger.info("Task %s ligand %s: best affinity %.2f kcal/mol over %d modes",
+                                 task_id, ligand_id, modes[0]['affinity'], len(modes))
+            return output_path, modes
+        finally:
+            with self.process_lock:
+                self.active_processes.pop((task_id, ligand_id), None)
     
     def _start_precache_thread(self):
         """Start precache thread to prefetch and download files for the next task"""
         def precache_worker():
             while True:
                 try:
-                    # Get the next task
                     with self.cache_lock:
-                        if self.next_task is None:
-                            next_task = self.get_task()
-                            if next_task.get('task_id') is not None:
+                        has_next_task = self.next_task is not None
+                    # Fetch and download outside the lock so the main loop is never blocked on the network
+                    if not has_next_task:
+                        next_task = self.get_task()
+                        if next_task.get('task_id') is not None:
+                            # Pre-download files
+                            receptor_file = self.download_input(next_task['task_id'], 'receptor.pdbqt', next_task.get('receptor_hash'))
+                            ligand_files = {
+                                ligand['ligand_id']: self.download_input(next_task['task_id'], ligand['ligand_file'], ligand_id=ligand['ligand_id'])
+                                for ligand in self._lease_ligands(next_task)
+                            }
+                            next_task['maps'] = self.get_grid_maps(next_task, receptor_file)
+                            with self.cache_lock:
                                 self.next_task = next_task
-                                # Pre-download files
-                                receptor_file = self.download_input(next_task['task_id'], 'receptor.pdbqt')
-                                ligand_file = self.download_input(next_task['task_id'], next_task['ligand_file'])
-                                if receptor_file and ligand_file:
+                                if receptor_file:
                                     self.next_task_files = {
                                         'receptor_file': receptor_file,
-                                        'ligand_file': ligand_file
+                                        'ligand_files': ligand_files
                                     }
                                     logger.info(f"Precached files for next task {next_task['task_id']}")
                 except Exception as e:
@@ -337,75 +609,290 @@ class DockingClient:
         while True:
             try:
                 # Check if there is a precached task
+                task = None
+                files = {}
                 with self.cache_lock:
-                    if self.next_task is not None:
+                    prefetched = self.next_task is not None
+                    if self.recovered_tasks:
+                        # Leases left unfinished by a crash go first, their files are downloaded again
+                        task = self.recovered_tasks.popleft()
+                        prefetched = False
+                    elif prefetched:
                         task = self.next_task
                         files = self.next_task_files
                         self.next_task = None
                         self.next_task_files = {}
-                    else:
-                        task = self.get_task()
-                        files = {}
+                if task is None:
+                    # Requested outside cache_lock: a cancel push for a prefetched lease takes it
+                    task = self.get_task()
 
                 if task.get('task_id') is None:
+                    self.status.update(state='idle', task_id=None, ligand_id=None)
                     time.sleep(5)
                     continue
 
                 logger.info(f"Received task {task['task_id']}")
+                self.status.update(state='downloading', task_id=task['task_id'], ligand_id=None)
 
                 # Use precached files or download required files
-                receptor_file = files.get('receptor_file') or self.download_input(task['task_id'], 'receptor.pdbqt')
-                ligand_file = files.get('ligand_file') or self.download_input(task['task_id'], task['ligand_file'])
-
-                if not all([receptor_file, ligand_file]):
-                    logger.error("Failed to download required files")
-                    continue
-                
-                # Perform molecular docking
-                output_path = self.run_vina(task['task_id'], task['ligand_id'],
-                                          receptor_file, ligand_file, task['params'])
-                if not output_path:
-                    logger.error("Docking failed")
-                    self._mark_ligand_failed(task['task_id'], task['ligand_id'])
-                    continue
+                download_start = time.time()
+                receptor_file = files.get('receptor_file') or self.download_input(task['task_id'], 'receptor.pdbqt', task.get('receptor_hash'))
+                ligand_files = files.get('ligand_files', {})
+                if task.get('maps') is None:
+                    task['maps'] = self.get_grid_maps(task, receptor_file)
                 
-                # Submit result
-                if self.submit_result(task['task_id'], task['ligand_id'], output_path):
-                    logger.info(f"Task {task['task_id']} ligand {task['ligand_id']} completed successfully")
-                else:
-                    logger.info(f"Failed to submit results for task {task['task_id']} ligand {task['ligand_id']}")
+                # A lease may contain a batch of small ligands, dock them one after another
+                # or, in batch mode, together once all of them are downloaded
+                ligands = self._lease_ligands(task)
+                batch = self.batch_docking and len(ligands) > 1
+                ready = []
+                for index, ligand in enumerate(ligands):
+                    # Dispatch and receptor download are charged to the first ligand of the lease,
+                    # a prefetched lease was dispatched while the previous one was running
+                    trace = self._new_trace(task, ligand['ligand_id'], first=(index == 0 and not prefetched))
+                    if index == 0 and not files.get('receptor_file'):
+                        trace['download_start'] = download_start
+                    if self._is_cancelled(task['task_id']):
+                        logger.info(f"Skipping remaining ligands of cancelled task {task['task_id']}")
+                        for skipped in ligands[index:]:
+                            self._finish_ligand(task['task_id'], skipped['ligand_id'], 'cancelled')
+                        break
+                    ligand_file = ligand_files.get(ligand['ligand_id'])
+                    if not ligand_file:
+                        trace.setdefault('download_start', time.time())
+                        ligand_file = self.download_input(task['task_id'], ligand['ligand_file'], ligand_id=ligand['ligand_id'])
+                    if 'download_start' in trace:
+                        trace['download_end'] = time.time()
+                    if not all([receptor_file, ligand_file]):
+                        logger.error("Failed to download required files")
+                        self._mark_ligand_failed(task['task_id'], ligand['ligand_id'], trace)
+                        continue
+                    if batch:
+                        ready.append((ligand['ligand_id'], ligand_file, trace))
+                    else:
+                        self.process_ligand(task, ligand['ligand_id'], receptor_file, ligand_file, trace)
+                if ready:
+                    self.process_batch(task, receptor_file, ready)
             
             except Exception as e:
                 logger.error(f"Unexpected error: {e}")
-                self._mark_ligand_failed(task['task_id'], task['ligand_id'])
                 # If an error occurs, try to re-establish the connection
                 if not self.connect_tcp():
                     logger.error("Failed to reconnect to server, exiting...")
                     return
                 time.sleep(self.retry_delay)
 
+    def process_ligand(self, task, ligand_id, receptor_file, ligand_file, trace=None):
+        """Dock one leased ligand and report the result"""
+        trace = trace if trace is not None else self._new_trace(task, ligand_id)
+        try:
+            if task.get('speculative'):
+                logger.info(f"Task {task['task_id']} ligand {ligand_id} is a speculative copy of a slow ligand")
+            # Perform molecular docking
+            trace['vina_start'] = time.time()
+            output_path, modes = self.run_vina(task['task_id'], ligand_id,
+                                             receptor_file, ligand_file, task['params'], task.get('maps'))
+            trace['vina_end'] = time.time()
+            self._report_result(task, ligand_id, output_path, modes, trace)
+        except Exception as e:
+            logger.error(f"Unexpected error processing ligand {ligand_id}: {e}")
+            self._mark_ligand_failed(task['task_id'], ligand_id, trace)
+    
+    def process_batch(self, task, receptor_file, ligands):
+        """Dock the ligands of a lease in one vina run and report each result separately
+
+        ligands is a list of (ligand_id, ligand_file, trace). A ligand vina rejects
+        stops the run part way through and a cancellation kills it; ligands left
+        without a complete output are docked again one by one, so a bad ligand
+        only fails itself.
+        """
+        task_id = task['task_id']
+        batch = [(ligand_id, ligand_file) for ligand_id, ligand_file, _ in ligands
+                 if not self._is_cancelled(task_id, ligand_id)]
+        results = {}
+        batch_start = None
+        if len(batch) > 1:
+            logger.info(f"Starting batch Vina docking for task {task_id}, {len(batch)} ligands")
+            self.status.update(state='docking', task_id=task_id, ligand_id=f"{len(batch)} ligands")
+            out_dir = Path(batch[0][1]).parent
+            
+            def register_process(process):
+                with self.process_lock:
+                    for ligand_id, _ in batch:
+                        self.active_processes[(task_id, ligand_id)] = process
+                    if task_id in self.cancelled_tasks or any((task_id, ligand_id) in self.cancelled_ligands for ligand_id, _ in batch):
+                        process.kill()
+            
+            batch_start = time.time()
+            try:
+                results = self.backend.dock_batch(task_id, batch, receptor_file, task['params'],
+                                                  out_dir, on_process=register_process, maps=task.get('maps'))
+            except Exception as e:
+                logger.error(f"Batch docking failed for task {task_id}: {e}")
+            finally:
+                with self.process_lock:
+                    for ligand_id, _ in batch:
+                        self.active_processes.pop((task_id, ligand_id), None)
+        
+        # Vina docks the batch in order, each output is written when its ligand finishes
+        previous_end = batch_start
+        for ligand_id, ligand_file, trace in ligands:
+            output_path, modes = results.get(ligand_id, (None, []))
+            if not output_path:
+                self.process_ligand(task, ligand_id, receptor_file, ligand_file, trace)
+                continue
+            try:
+                trace['vina_start'] = previous_end
+                trace['vina_end'] = previous_end = max(output_path.stat().st_mtime, previous_end)
+                vina_logger.info("Task %s ligand %s: best affinity %.2f kcal/mol over %d modes",
+                                 task_id, ligand_id, modes[0]['affinity'], len(modes))
+                self._report_result(task, ligand_id, output_path, modes, trace)
+            except Exception as e:
+                logger.error(f"Unexpected error processing ligand {ligand_id}: {e}")
+                self._mark_ligand_failed(task_id, ligand_id, trace)
+    
+    def _report_result(self, task, ligand_id, output_path, modes, trace):
+        """Submit a docked ligand, or report it failed or drop it if it was cancelled"""
+        if self._pop_cancelled(task['task_id'], ligand_id):
+            # Another node finished first, the server no longer needs this result
+            logger.info(f"Task {task['task_id']} ligand {ligand_id} was cancelled")
+            self._finish_ligand(task['task_id'], ligand_id, 'cancelled')
+            self._finish_trace(trace, 'cancelled')
+            return
+        if not output_path:
+            logger.error("Docking failed")
+            self._mark_ligand_failed(task['task_id'], ligand_id, trace)
+            return
+        
+        # Submit result; until it is acknowledged the output is kept and submitted again after a restart.
+        # Outputs on tmpfs are uploaded from there and written to disk only if the submit fails
+        on_scratch = self.scratch.is_scratch(output_path)
+        if not on_scratch:
+            self._keep_output(task['task_id'], ligand_id, output_path, modes)
+        self.status.update(state='submitting', task_id=task['task_id'], ligand_id=ligand_id)
+        if self.submit_result(task['task_id'], ligand_id, output_path, trace, modes):
+            logger.info(f"Task {task['task_id']} ligand {ligand_id} completed successfully")
+            self._finish_ligand(task['task_id'], ligand_id, 'submitted')
+            self._finish_trace(trace, 'completed')
+        else:
+            logger.info(f"Failed to submit results for task {task['task_id']} ligand {ligand_id}")
+            if on_scratch:
+                try:
+                    output_path = self.scratch.persist(task['task_id'], output_path)
+                except OSError as e:
+                    # Kept on tmpfs, only a reboot before the next submit loses it
+                    logger.warning(f"Failed to move output of task {task['task_id']} ligand {ligand_id} to disk: {e}")
+                self._keep_output(task['task_id'], ligand_id, output_path, modes)
+            self._finish_trace(trace, 'submit_failed')
+    
+    def _keep_output(self, task_id, ligand_id, output_path, modes):
+        """Journal an unsubmitted output so it is submitted again after a restart"""
+        self.journal.docked(task_id, ligand_id, output_path, modes)
+        self.workdir.add(task_id, output_path, ligand_id)
+    
+    def _finish_ligand(self, task_id, ligand_id, status):
+        """Record the end of a ligand and delete its files, the server no longer needs them"""
+        self.journal.finish(task_id, ligand_id, status)
+        with self.process_lock:
+            self.cancelled_ligands.discard((task_id, ligand_id))
+        # A failed or cancelled vina run may leave a partial output that was never registered
+        self.workdir.discard(task_id, ligand_id, *(ligand_dir / f"{ligand_id}_out.pdbqt"
+                                                   for ligand_dir in self.scratch.ligand_dirs(task_id)))
+    
+    def _recover_journal(self):
+        """Pick up the ligands a previous run of this worker left unfinished
 
+        Outputs docked before the crash are submitted instead of docked again.
+        Leases with at least half of the server's lease timeout, as journaled with
+        the lease, left are resumed; older ones are released so the server
+        dispatches them at once instead of waiting for the timeout. Renewals are
+        not journaled, so the age counts from the lease and errs towards release.
+        """
+        entries = self.journal.unfinished()
+        if not entries:
+            return
+        logger.info(f"Recovering {len(entries)} unfinished ligands from {self.journal.path}")
+        now = time.time()
+        resumed = {}
+        released = {}
+        for entry in entries:
+            task_id, ligand_id = entry['task_id'], entry['ligand_id']
+            # A crash between vina finishing and the docked record leaves a complete output without one
+            candidates = [Path(entry['output_file'])] if entry['output_file'] else [
+                ligand_dir / f"{ligand_id}_out.pdbqt" for ligand_dir in self.scratch.ligand_dirs(task_id)]
+            output_path, modes = next(((path, read_output_modes(path)) for path in candidates if path.exists()),
+                                      (candidates[0], []))
+            if modes:
+                submitted = self.submit_result(task_id, ligand_id, output_path, modes=entry['modes'] or modes)
+                logger.info(f"Resubmitted task {task_id} ligand {ligand_id} docked before restart: {submitted}")
+                self._finish_ligand(task_id, ligand_id, 'submitted' if submitted else 'submit_failed')
+            elif now - (entry['leased_at'] or 0) < (entry['lease_timeout'] or self.lease_timeout) / 2:
+                resumed.setdefault(task_id, []).append(entry)
+            else:
+                released.setdefault((task_id, entry['node_id']), []).append(ligand_id)
+        
+        for (task_id, node_id), ligand_ids in released.items():
+            response = self.request({'type': 'release', 'task_id': task_id, 'ligand_ids': ligand_ids, 'node_id': node_id})
+            if response and response.get('status') == 'ok':
+                logger.info(f"Released {len(ligand_ids)} expired leases of task {task_id}")
+            for ligand_id in ligand_ids:
+                self.journal.finish(task_id, ligand_id, 'released')
+        
+        for task_id, group in resumed.items():
+            logger.info(f"Resuming {len(group)} leased ligands of task {task_id}")
+            params = dict(group[0]['params'] or {})
+            if self.cpus and params:
+                params['cpu'] = len(self.cpus)
+            ligands = [{'ligand_id': entry['ligand_id'], 'ligand_file': entry['ligand_file']} for entry in group]
+            self.recovered_tasks.append({
+                'task_id': task_id,
+                'ligand_id': ligands[0]['ligand_id'],
+                'ligand_file': ligands[0]['ligand_file'],
+                'ligands': ligands,
+                'receptor_hash': group[0]['receptor_hash'],
+                'params': params,
+                'speculative': group[0]['speculative'],
+                'leased_at': group[0]['leased_at']
+            })
+        self.journal.compact()
     
+    def _new_trace(self, task, ligand_id, first=True):
+        """Lifecycle timestamps of one leased ligand, filled in as it moves through the pipeline"""
+        return {
+            'task_id': task['task_id'],
+            'ligand_id': ligand_id,
+            'speculative': bool(task.get('speculative')),
+            'requested_at': task.get('requested_at') if first else None,
+            'leased_at': task.get('leased_at')
+        }
+    
+    def _finish_trace(self, trace, status):
+        """Queue a finished trace for the next request, dropping the oldest if the server is unreachable"""
+        trace['status'] = status
+        self.status.count(status)
+        with self.trace_lock:
+            self.pending_traces.append(trace)
+            del self.pending_traces[:-self.max_pending_traces]
+
+    @staticmethod
+    def _lease_ligands(task):
+        """Ligands in a lease, servers without batching send a single ligand"""
+        return task.get('ligands') or [{'ligand_id': task['ligand_id'], 'ligand_file': task['ligand_file']}]
+
     def _start_cleanup_thread(self):
-        """Start cleanup thread to periodically clean up expired work directory files"""
+        """Start cleanup thread to expire idle task directories and keep the work directory within its disk limits"""
         def cleanup_worker():
             while True:
                 try:
-                    # Get current time
-                    now = datetime.now()
-                    # Traverse the work directory
-                    for task_dir in self.work_dir.iterdir():
-                        if task_dir.is_dir():
-                            # Get the last modification time of the directory
-                            mtime = datetime.fromtimestamp(task_dir.stat().st_mtime)
-                            # If the directory exceeds the cleanup time threshold, delete it
-                            if (now - mtime).total_seconds() > self.cleanup_age:
-                                logger.info(f"Cleaning up expired task directory: {task_dir}")
-                                shutil.rmtree(task_dir)
+                    # Tasks with leased ligands or outputs not yet submitted are kept
+                    unfinished = self.journal.unfinished_tasks()
+                    for task_id in self.workdir.sweep(self.cleanup_age, protected=unfinished):
+                        logger.info(f"Cleaned up task directory: {self.work_dir / task_id}")
+                    self.scratch.sweep(unfinished)
                 except Exception as e:
                     logger.error(f"Error in cleanup thread: {e}")
-                # Wait for the next cleanup
-                time.sleep(self.cleanup_interval)
+                # Wait for the next cleanup, or less when a download or output exceeds a limit
+                self.workdir.wait_for_pressure(self.cleanup_interval)
         
         # Create and start cleanup thread
         cleanup_thread = threading.Thread(target=cleanup_worker)
@@ -413,22 +900,55 @@ class DockingClient:
         cleanup_thread.start()
         logger.info("Cleanup thread started")
 
-    def _mark_ligand_failed(self, task_id, ligand_id):
+    def renew_leases(self):
+        """Renew every held ligand not docked yet: queued in a lease, prefetched or docking
+
+        Without renewal the server re-leases the tail of a long batch, or a
+        ligand docking for longer than its lease timeout, while it is still
+        being worked on. Docked ligands whose submission failed are left to
+        expire, so another node picks them up.
+        """
+        held = {}
+        for entry in self.journal.unfinished():
+            if not entry['output_file']:
+                held.setdefault((entry['task_id'], entry['node_id']), []).append(entry['ligand_id'])
+        for (task_id, node_id), ligand_ids in held.items():
+            response = self.request({'type': 'renew', 'task_id': task_id, 'ligand_ids': ligand_ids, 'node_id': node_id})
+            if not response or response.get('status') != 'ok':
+                logger.warning(f"Failed to renew {len(ligand_ids)} leases of task {task_id}")
+    
+    def _start_renewal_thread(self):
+        """Start the thread renewing held leases every third of the server's lease timeout"""
+        def renewal_worker():
+            while True:
+                time.sleep(self.lease_timeout / 3)
+                try:
+                    self.renew_leases()
+                except Exception as e:
+                    logger.error(f"Error renewing leases: {e}")
+        
+        renewal_thread = threading.Thread(target=renewal_worker)
+        renewal_thread.daemon = True
+        renewal_thread.start()
+        logger.info("Lease renewal thread started")
+
+    def _mark_ligand_failed(self, task_id, ligand_id, trace=None):
         """Mark ligand as failed"""
-        try:
-            data = {
-                'type': 'submit_result',
-                'task_id': task_id,
-                'ligand_id': ligand_id,
-                'output_file': None,
-                'status': 'failed'
-            }
-            self.secure_sock.send_message(data)
-            response = self.secure_sock.receive_message()
-            return response and response.get('status') == 'ok'
-        except Exception as e:
-            logger.error(f"Failed to mark ligand as failed: {e}")
-            return False
+        response = self.request({
+            'type': 'submit_result',
+            'task_id': task_id,
+            'ligand_id': ligand_id,
+            'output_file': None,
+            'status': 'failed'
+        })
+        if not response:
+            logger.error("Failed to mark ligand as failed")
+        # Without an acknowledgement the server's timeout retries the ligand
+        self._finish_ligand(task_id, ligand_id, 'failed')
+        if trace is not None:
+            trace['acked_at'] = time.time()
+            self._finish_trace(trace, 'failed')
+        return bool(response and response.get('status') == 'ok')
 
 if __name__ == '__main__':
     client = DockingClient()
@@ -1,10 +1,16 @@
+import os
+import json
 import curses
+import signal
 import sys
 import time
 import psutil
+import argparse
+import selectors
 import threading
 import subprocess
 import socket
+from collections import deque
 from datetime import datetime
 from pathlib import Path
 
@@ -13,14 +19,151 @@ sys.path.append('..')
 from config import PROCESS_CONFIG, SERVER_CONFIG, TASK_CONFIG
 from utils.logger import logger
 from utils.network import SSLContextManager, SecureSocket
+from autoscaler import Autoscaler, ResourceMonitor
+from status import StatusCollector, StatusEndpoint, read_status, WORKER_SOCKET_ENV, WORKER_ID_ENV
+from placement import Topology, plan_slots, format_cpu_list, CPUS_ENV
+from agent import NodeAgent, AGENT_SOCKET_ENV
 
-class ProcessManager:
+# Worker output lines kept for the TUI, and the longest line kept
+OUTPUT_LINES = 100
+MAX_OUTPUT_LINE = 1000
+
+class StatusView:
+    """Curses view of a daemon snapshot, drawn by the daemon itself or by an attached viewer
+
+    The layout follows the number of workers: one box with recent output per
+    worker while they fit, one summary line per worker otherwise.
+    """
+    HEADER_HEIGHT = 5
+    
     def __init__(self):
+        self.screen = curses.initscr()
+        curses.start_color()
+        curses.use_default_colors()  # Use terminal default colors
+        curses.init_pair(1, curses.COLOR_GREEN, -1)  # -1 means use default background color
+        curses.init_pair(2, curses.COLOR_RED, -1)
+        curses.init_pair(3, curses.COLOR_YELLOW, -1)
+        curses.noecho()
+        curses.cbreak()
+        curses.curs_set(0)  # Hide cursor
+        self.screen.keypad(True)
+        self.screen.nodelay(True)
+    
+    @staticmethod
+    def _put(window, y, x, text, attr=0):
+        height, width = window.getmaxyx()
+        if 0 <= y < height and x < width - 1:
+            try:
+                window.addstr(y, x, text[:width - x - 2], attr)
+            except curses.error:
+                pass
+    
+    @staticmethod
+    def _describe(process):
+        status = process.get('status') or {}
+        text = status.get('state', 'unknown')
+        if status.get('task_id') is not None:
+            text += f" task {status['task_id']}"
+        if status.get('ligand_id') is not None:
+            text += f" ligand {status['ligand_id']}"
+        return f"{text} | completed {status.get('completed', 0)} failed {status.get('failed', 0)}"
+    
+    def render(self, snapshot, message=None):
+        curses.update_lines_cols()
+        height, width = self.screen.getmaxyx()
+        self.screen.erase()
+        self.screen.noutrefresh()
+        
+        header = curses.newwin(min(self.HEADER_HEIGHT, height), width, 0, 0)
+        header.box()
+        self._put(header, 0, 2, " Daemon Status ")
+        if snapshot is None:
+            self._put(header, 1, 2, message or "No status", curses.color_pair(2))
+            header.noutrefresh()
+            curses.doupdate()
+            return
+        processes = snapshot['processes']
+        cpu = snapshot.get('cpu_percent')
+        self._put(header, 1, 2, f"CPU Usage: {'-' if cpu is None else round(cpu, 1)}%    Memory Usage: {snapshot['memory_percent']}%")
+        server = 'connected' if snapshot.get('connected') else 'disconnected'
+        pending = snapshot.get('pending_ligands')
+        self._put(header, 2, 2, f"Server: {server}    Pending ligands: {'-' if pending is None else pending}")
+        scaling = f" ({snapshot['scale_reason']})" if snapshot.get('autoscale') and snapshot.get('scale_reason') else ""
+        self._put(header, 3, 2, f"Running Processes: {sum(1 for p in processes if p['running'])}/{snapshot['max_processes']}{scaling}")
+        header.noutrefresh()
+        
+        rows = height - self.HEADER_HEIGHT
+        per_process = rows // len(processes) if processes else 0
+        if per_process >= 3:
+            for index, process in enumerate(processes):
+                window = curses.newwin(per_process, width, self.HEADER_HEIGHT + index * per_process, 0)
+                window.box()
+                color = curses.color_pair(1) if process['running'] else curses.color_pair(2)
+                state = "Running" if process['running'] else "Stopped"
+                self._put(window, 0, 2, f" Process {process['id']} (PID: {process['pid']}) - {state} - {self._describe(process)} ", color)
+                lines = process['output'][-(per_process - 2):] if per_process > 2 else []
+                for i, line in enumerate(lines):
+                    self._put(window, i + 1, 2, line)
+                window.noutrefresh()
+        elif rows > 2:
+            window = curses.newwin(rows, width, self.HEADER_HEIGHT, 0)
+            window.box()
+            self._put(window, 0, 2, f" Processes ({len(processes)}) ")
+            for i, process in enumerate(processes[:rows - 2]):
+                color = curses.color_pair(1) if process['running'] else curses.color_pair(2)
+                self._put(window, i + 1, 2, f"{process['id']:>3} PID {process['pid']:<8} {self._describe(process)}", color)
+            window.noutrefresh()
+        curses.doupdate()  # Refresh all windows at once
+    
+    def quit_requested(self):
+        return self.screen.getch() in (ord('q'), ord('Q'))
+    
+    def close(self):
+        # Restore terminal state
+        curses.nocbreak()
+        self.screen.keypad(False)
+        curses.echo()
+        curses.endwin()
+
+class ProcessManager:
+    def __init__(self, headless=False):
         # Process configuration
         self.max_processes = PROCESS_CONFIG['max_processes']
         self.process_start_interval = PROCESS_CONFIG['process_start_interval']
         self.min_memory_per_process = PROCESS_CONFIG['min_memory_per_process']
         self.max_cpu_per_process = PROCESS_CONFIG['max_cpu_per_process']
+        self.min_processes = min(PROCESS_CONFIG.get('min_processes', 1), self.max_processes)
+        
+        # Each worker slot gets its own cores ('compact' or 'spread' across NUMA nodes), vina runs with --cpu set to the slot size
+        self.cpu_placement = PROCESS_CONFIG.get('cpu_placement', 'none')
+        self.cpu_slots = [None] * self.max_processes
+        if self.cpu_placement != 'none':
+            topology = Topology.detect()
+            self.cpu_slots = plan_slots(topology, self.max_processes, self.max_cpu_per_process, self.cpu_placement)
+            if self.max_processes * self.max_cpu_per_process > topology.cpu_count:
+                logger.warning(f"{self.max_processes} processes x {self.max_cpu_per_process} CPUs exceed the "
+                               f"{topology.cpu_count} usable CPUs, some slots share cores")
+        
+        # Scale workers with the host's spare CPU and memory and the server's queue
+        self.autoscale = PROCESS_CONFIG.get('autoscale', False)
+        self.autoscale_interval = PROCESS_CONFIG.get('autoscale_interval', 5)
+        self.autoscaler = Autoscaler(
+            self.min_processes,
+            self.max_processes,
+            cpus_per_worker=self.max_cpu_per_process,
+            memory_per_worker=self.min_memory_per_process,
+            reserve_cpus=PROCESS_CONFIG.get('reserve_cpus', 0),
+            reserve_memory=PROCESS_CONFIG.get('reserve_memory', 512),
+            max_load_per_cpu=PROCESS_CONFIG.get('max_load_per_cpu', 1.25),
+            scale_up_delay=PROCESS_CONFIG.get('scale_up_delay', 30),
+            scale_down_delay=PROCESS_CONFIG.get('scale_down_delay', 60),
+            user_idle_threshold=PROCESS_CONFIG.get('user_idle_threshold', 300),
+            user_active_workers=PROCESS_CONFIG.get('user_active_processes', 0)
+        )
+        self.resource_monitor = ResourceMonitor()
+        self.scale_reason = None
+        # Ligands waiting on the server, reported in heartbeat responses
+        self.pending_ligands = None
         
         # Server configuration
         self.server_host = SERVER_CONFIG['host']
@@ -41,124 +184,154 @@ class ProcessManager:
         self.ssl_context = SSLContextManager().get_client_context()
         self.secure_sock = None
         self.sock_lock = threading.Lock()
+        # Reused on reconnect to skip the full TLS handshake and the server-side bcrypt check
+        self.tls_session = None
+        self.session_token = None
+        # Session tokens are bound to the node ID they were issued to
+        self.node_id = f"{socket.gethostname()}-daemon"
         
-        # Initialize curses
-        self.screen = curses.initscr()
-        curses.start_color()
-        curses.use_default_colors()  # Use terminal default colors
-        curses.init_pair(1, curses.COLOR_GREEN, -1)  # -1 means use default background color
-        curses.init_pair(2, curses.COLOR_RED, -1)
-        curses.init_pair(3, curses.COLOR_YELLOW, -1)
-        curses.noecho()
-        curses.cbreak()
-        curses.curs_set(0)  # Hide cursor
-        self.screen.keypad(True)
-        
-        # Get screen size
-        self.height, self.width = self.screen.getmaxyx()
-        
-        # Create windows
-        self.daemon_window = curses.newwin(5, self.width, 0, 0)
-        self.process_windows = {}
-        process_height = (self.height - 5) // 5
-        for i in range(5):
-            self.process_windows[i] = curses.newwin(
-                process_height,
-                self.width,
-                5 + i * process_height,
-                0
-            )
+        # Workers report their state over a Unix datagram socket; the status socket
+        # serves snapshots to `daemon.py --status` and `--attach`, the TUI is optional
+        self.headless = headless
+        self.worker_socket = os.path.abspath(PROCESS_CONFIG.get('worker_socket', 'daemon_workers.sock'))
+        self.status_socket = PROCESS_CONFIG.get('status_socket', 'daemon_status.sock')
+        self.status_collector = None
+        self.status_endpoint = None
+        self.view = None
+        # Optional node agent: workers share its server connection and coalesced leases
+        self.agent = None
+        if PROCESS_CONFIG.get('agent', False):
+            self.agent = NodeAgent(os.path.abspath(PROCESS_CONFIG.get('agent_socket', 'agent.sock')),
+                                   PROCESS_CONFIG.get('agent_lease_wait', 0.05))
+        # One thread drains the output of all workers
+        self.output_selector = selectors.DefaultSelector()
     
     def start_process(self, process_id):
         """Start a new client.py process"""
         try:
+            env = dict(os.environ)
+            env[WORKER_SOCKET_ENV] = self.worker_socket
+            env[WORKER_ID_ENV] = str(process_id)
+            slot = self.cpu_slots[process_id] if process_id < len(self.cpu_slots) else None
+            if slot:
+                env[CPUS_ENV] = format_cpu_list(slot)
+            if self.agent is not None:
+                env[AGENT_SOCKET_ENV] = self.agent.socket_path
             process = subprocess.Popen(
                 [sys.executable, 'client.py'],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                bufsize=1
+                env=env,
+                start_new_session=True  # Own process group, so stopping it also stops its vina runs
             )
             
+            output = deque(maxlen=OUTPUT_LINES)
             with self.process_lock:
                 self.processes[process_id] = process
-                self.process_outputs[process_id] = []
+                self.process_outputs[process_id] = output
+            if self.status_collector is not None:
+                self.status_collector.forget(process_id)
+            self.output_selector.register(process.stdout, selectors.EVENT_READ, output)
             
-            # Start output monitoring thread
-            threading.Thread(
-                target=self.monitor_process_output,
-                args=(process_id,),
-                daemon=True
-            ).start()
-            
-            logger.info(f"Started process {process_id} with PID {process.pid}")
+            logger.info(f"Started process {process_id} with PID {process.pid}" + (f" on CPUs {env[CPUS_ENV]}" if slot else ""))
             return True
         except Exception as e:
             logger.error(f"Failed to start process {process_id}: {e}")
             return False
     
-    def monitor_process_output(self, process_id):
-        """Monitor process output and update display"""
-        process = self.processes[process_id]
+    def stop_process(self, process_id):
+        """Stop a worker and the vina processes it started"""
+        with self.process_lock:
+            process = self.processes.pop(process_id, None)
+        if process is None:
+            return
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(timeout=5)
+        except ProcessLookupError:
+            pass
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+        logger.info(f"Stopped process {process_id} (PID: {process.pid})")
+    
+    def scale_processes(self):
+        """Start or stop one worker when the autoscaler asks for it"""
+        with self.process_lock:
+            worker_pids = [process.pid for process in self.processes.values() if process.poll() is None]
+            current = len(self.processes)
+        sample = self.resource_monitor.sample(worker_pids, self.pending_ligands)
+        desired, self.scale_reason = self.autoscaler.decide(current, sample)
+        if desired > current:
+            with self.process_lock:
+                process_id = next(i for i in range(self.max_processes) if i not in self.processes)
+            logger.info(f"Scaling up to {desired} processes ({self.scale_reason})")
+            self.start_process(process_id)
+        elif desired < current:
+            logger.info(f"Scaling down to {desired} processes ({self.scale_reason})")
+            # The most recently added workers go first
+            with self.process_lock:
+                process_ids = sorted(self.processes, reverse=True)[:current - desired]
+            for process_id in process_ids:
+                self.stop_process(process_id)
+    
+    def _read_outputs(self):
+        """Drain the stdout of every worker in one thread, keeping the last lines of each"""
+        partial = {}
         while True:
-            output = process.stdout.readline()
-            if output == '' and process.poll() is not None:
-                break
-            if output:
+            try:
+                events = self.output_selector.select(timeout=1)
+            except OSError:
+                events = []
+            if not events and not self.output_selector.get_map():
+                time.sleep(1)
+            for key, _ in events:
+                data = os.read(key.fd, 65536)
+                if not data:
+                    self.output_selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    partial.pop(key.fd, None)
+                    continue
+                lines = (partial.pop(key.fd, b'') + data).split(b'\n')
+                partial[key.fd] = lines.pop()[-MAX_OUTPUT_LINE:]
+                lines = [line.decode(errors='replace').rstrip()[:MAX_OUTPUT_LINE] for line in lines if line.strip()]
                 with self.process_lock:
-                    self.process_outputs[process_id].append(output.strip())
-                    # Keep the latest 100 lines of output
-                    if len(self.process_outputs[process_id]) > 100:
-                        self.process_outputs[process_id].pop(0)
-    
-    def update_daemon_status(self):
-        """Update daemon status display"""
-        self.daemon_window.clear()
-        self.daemon_window.box()
-        self.daemon_window.addstr(0, 2, " Daemon Status ")
-        
-        # Display system resource usage
-        cpu_percent = psutil.cpu_percent()
-        mem = psutil.virtual_memory()
-        self.daemon_window.addstr(1, 2, f"CPU Usage: {cpu_percent}%")
-        self.daemon_window.addstr(2, 2, f"Memory Usage: {mem.percent}%")
-        self.daemon_window.addstr(3, 2, f"Running Processes: {len(self.processes)}")
-        
-        self.daemon_window.refresh()
+                    key.data.extend(lines)
     
-    def update_process_status(self):
-        """Update all process status display"""
+    def snapshot(self, output_lines=20):
+        """Daemon and worker status, served on the status socket and drawn by the TUI"""
         with self.process_lock:
-            for process_id, window in self.process_windows.items():
-                window.clear()
-                window.box()
-                
-                process = self.processes.get(process_id)
-                if process:
-                    status = "Running" if process.poll() is None else "Stopped"
-                    color = curses.color_pair(1) if status == "Running" else curses.color_pair(2)
-                    window.addstr(0, 2, f" Process {process_id} (PID: {process.pid}) - {status} ", color)
-                    
-                    # Display process output
-                    outputs = self.process_outputs.get(process_id, [])
-                    max_lines = window.getmaxyx()[0] - 2
-                    for i, line in enumerate(outputs[-max_lines:]):
-                        try:
-                            window.addstr(i + 1, 2, line[:self.width-4])
-                        except curses.error:
-                            pass
-                else:
-                    window.addstr(0, 2, f" Process {process_id} - Not Started ", curses.color_pair(3))
-                
-                window.refresh()
+            processes = [
+                {
+                    'id': process_id,
+                    'pid': process.pid,
+                    'running': process.poll() is None,
+                    'status': self.status_collector.get(process_id) if self.status_collector else None,
+                    'output': list(self.process_outputs.get(process_id, ()))[-output_lines:]
+                }
+                for process_id, process in sorted(self.processes.items())
+            ]
+        cpu_percent = self.resource_monitor.cpu_percent if self.autoscale else psutil.cpu_percent()
+        return {
+            'time': time.time(),
+            'cpu_percent': cpu_percent,
+            'memory_percent': psutil.virtual_memory().percent,
+            'connected': self.secure_sock is not None,
+            'pending_ligands': self.pending_ligands,
+            'autoscale': self.autoscale,
+            'scale_reason': self.scale_reason,
+            'max_processes': self.max_processes,
+            'processes': processes
+        }
     
     def check_and_restart_processes(self):
         """Check process status and restart if needed"""
         with self.process_lock:
-            for process_id, process in list(self.processes.items()):
-                if process.poll() is not None:
-                    logger.warning(f"Process {process_id} (PID: {process.pid}) has stopped, restarting...")
-                    self.start_process(process_id)
+            stopped = [(process_id, process) for process_id, process in self.processes.items() if process.poll() is not None]
+        # start_process takes the lock itself
+        for process_id, process in stopped:
+            logger.warning(f"Process {process_id} (PID: {process.pid}) has stopped, restarting...")
+            self.start_process(process_id)
     
     def connect_tcp(self):
         """Connect to TCP command server, support auto-reconnect"""
@@ -177,13 +350,16 @@ class ProcessManager:
                 raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 raw_sock.settimeout(10)  # Set connection timeout
                 raw_sock.connect((self.server_host, self.tcp_port))
-                self.secure_sock = SecureSocket(raw_sock, self.ssl_context)
+                self.secure_sock = SecureSocket(raw_sock, self.ssl_context, session=self.tls_session)
                 
                 # Send authentication information
                 auth_data = {
                     'type': 'auth',
-                    'password': self.server_password
+                    'password': self.server_password,
+                    'node_id': self.node_id
                 }
+                if self.session_token:
+                    auth_data['token'] = self.session_token
                 self.secure_sock.send_message(auth_data)
                 
                 # Wait for authentication result
@@ -196,7 +372,9 @@ class ProcessManager:
                         time.sleep(min(self.retry_delay * (retries + 1), 30))  # Use exponential backoff strategy
                     continue
                 
-                logger.info("Successfully connected and authenticated to TCP server")
+                self.session_token = response.get('token')
+                self.tls_session = self.secure_sock.session
+                logger.info(f"Successfully connected and authenticated to TCP server (TLS session reused: {self.secure_sock.session_reused})")
                 # Send initial heartbeat
                 cpu_usage = psutil.cpu_percent(interval=1)
                 self.secure_sock.send_message({
@@ -258,6 +436,7 @@ class ProcessManager:
                             response = self.secure_sock.receive_message()
                             if not response or response.get('status') != 'ok':
                                 raise ConnectionError("Invalid heartbeat response")
+                            self.pending_ligands = response.get('pending_ligands')
                             consecutive_failures = 0  # Reset failure count
                         except Exception as e:
                             logger.warning(f"Heartbeat failed: {e}, attempting to reconnect...")
@@ -281,25 +460,37 @@ class ProcessManager:
 
     def run(self):
         """Run daemon main loop"""
+        # systemd stops the daemon with SIGTERM, clean up the workers as on Ctrl-C
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         try:
+            self.status_collector = StatusCollector(self.worker_socket)
+            self.status_endpoint = StatusEndpoint(self.status_socket, self.snapshot)
+            threading.Thread(target=self._read_outputs, daemon=True).start()
+            if not self.headless:
+                self.view = StatusView()
+            
             # Establish connection to server
             if not self.connect_tcp():
                 logger.error("Failed to connect to server")
                 return
-            # Start initial processes
-            for i in range(min(5, self.max_processes)):
+            if self.agent is not None:
+                self.agent.start()
+            # Start initial processes, the autoscaler adds more as capacity allows
+            initial = self.min_processes if self.autoscale else min(5, self.max_processes)
+            for i in range(initial):
                 if self.start_process(i):
                     time.sleep(self.process_start_interval)
             
             # Main loop
+            next_scale = time.monotonic() + self.autoscale_interval
             while True:
                 try:
-                    # Batch update windows to reduce flicker
-                    curses.update_lines_cols()
-                    self.update_daemon_status()
-                    self.update_process_status()
                     self.check_and_restart_processes()
-                    curses.doupdate()  # Refresh all windows at once
+                    if self.autoscale and time.monotonic() >= next_scale:
+                        self.scale_processes()
+                        next_scale = time.monotonic() + max(self.autoscale_interval, self.process_start_interval)
+                    if self.view is not None:
+                        self.view.render(self.snapshot())
                     time.sleep(1)  # Use a single delay time
                 except curses.error as e:
                     logger.error(f"Curses error in main loop: {e}")
@@ -310,20 +501,50 @@ class ProcessManager:
         except KeyboardInterrupt:
             pass
         finally:
-            # Clean up and restore terminal state
-            curses.nocbreak()
-            self.screen.keypad(False)
-            curses.echo()
-            curses.endwin()
+            if self.view is not None:
+                self.view.close()
             
             # Terminate all child processes
-            for process in self.processes.values():
+            for process_id in list(self.processes):
                 try:
-                    process.terminate()
-                    process.wait(timeout=5)
-                except:
-                    process.kill()
+                    self.stop_process(process_id)
+                except Exception as e:
+                    logger.error(f"Failed to stop process {process_id}: {e}")
+            for service in (self.status_endpoint, self.status_collector, self.agent):
+                if service is not None:
+                    service.close()
+
+def attach(status_socket):
+    """Show the status of a running daemon until q or Ctrl-C is pressed"""
+    view = StatusView()
+    try:
+        while not view.quit_requested():
+            try:
+                view.render(read_status(status_socket))
+            except (OSError, ValueError) as e:
+                view.render(None, f"Daemon not reachable on {status_socket}: {e}")
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        view.close()
 
 if __name__ == '__main__':
-    manager = ProcessManager()
-    manager.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='VortexDock compute node daemon')
+    parser.add_argument('--headless', action='store_true',
+                        help='Run without the TUI (the default when stdout is not a terminal)')
+    parser.add_argument('--attach', action='store_true', help='Show the TUI of a running daemon')
+    parser.add_argument('--status', action='store_true', help='Print the status of a running daemon as JSON')
+    args = parser.parse_args()
+    
+    status_socket = PROCESS_CONFIG.get('status_socket', 'daemon_status.sock')
+    if args.attach:
+        attach(status_socket)
+    elif args.status:
+        try:
+            print(json.dumps(read_status(status_socket), indent=2))
+        except (OSError, ValueError) as e:
+            sys.exit(f"Daemon not reachable on {status_socket}: {e}")
+    else:
+        manager = ProcessManager(headless=args.headless or not sys.stdout.isatty())
+        manager.run()
\ No newline at end of file
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import abc
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from pathlib import Path
+from collections import OrderedDict
+
+from utils.logger import logger
+from vina_output import VinaOutputParser, stream_process, read_output_modes
+
+# Vina progress output, its level is configured with LOG_CONFIG['components']['vina']
+vina_logger = logger.get_component('vina')
+
+DEFAULT_VINA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vina')
+# Vina's default search effort, used when the task parameters do not set exhaustiveness
+VINA_EXHAUSTIVENESS = 8
+# First vina release with --batch, --dir, --write_maps and --maps; the bundled binary is 1.1.2
+VINA_1_2 = (1, 2)
+
+def probe_vina_version(vina_path):
+    """(major, minor, patch) reported by vina --version, None if it cannot be run or parsed"""
+    try:
+        result = subprocess.run([str(vina_path), '--version'], capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning("Cannot run %s --version: %s", vina_path, e)
+        return None
+    # "AutoDock Vina 1.1.2 (May 11, 2011)" or "AutoDock Vina v1.2.5"
+    match = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', result.stdout + result.stderr)
+    if not match:
+        return None
+    return tuple(int(part or 0) for part in match.groups())
+
+class DockingBackend(abc.ABC):
+    """Docks one ligand against a receptor inside the search box given by the task parameters"""
+    name = None
+    # Whether dock_batch can dock a whole lease in one run
+    supports_batch = False
+    # Whether write_maps can precompute grid maps for dock and dock_batch to load
+    supports_maps = False
+
+    @abc.abstractmethod
+    def dock(self, task_id, ligand_id, receptor_file, ligand_file, params, output_path, on_process=None, maps=None):
+        """Write the docked poses to output_path
+
+        Returns (output_path, modes), where modes is the result table
+        (mode, affinity, rmsd_lb, rmsd_ub per pose); output_path is None on failure.
+        on_process is called with the child process for backends that start one,
+        so the caller can kill it on cancellation. maps is the prefix of grid maps
+        from write_maps, used instead of the receptor.
+        """
+
+    @abc.abstractmethod
+    def dock_batch(self, task_id, ligands, receptor_file, params, out_dir, on_process=None, maps=None):
+        """Dock a list of (ligand_id, ligand_file) together
+
+        Returns {ligand_id: (output_path, modes)}; a ligand that failed maps to (None, []).
+        """
+
+    @abc.abstractmethod
+    def write_maps(self, receptor_file, params, map_prefix):
+        """Compute the grid maps of the receptor in the search box, returns True on success"""
+
+    def close(self):
+        pass
+
+class SubprocessBackend(DockingBackend):
+    """Runs the vina binary once per ligand, or once per lease in batch mode
+
+    Batch mode and grid maps need vina 1.2 or later, the binary's version is
+    probed on first use.
+    """
+    name = 'subprocess'
+
+    def __init__(self, vina_path=DEFAULT_VINA_PATH, timeout=None):
+        self.vina_path = vina_path
+        self.timeout = timeout
+        self._version = None
+        self._probed = False
+
+    @property
+    def version(self):
+        if not self._probed:
+            self._version = probe_vina_version(self.vina_path)
+            self._probed = True
+        return self._version
+
+    @property
+    def supports_batch(self):
+        return self.version is not None and self.version >= VINA_1_2
+
+    @property
+    def supports_maps(self):
+        return self.version is not None and self.version >= VINA_1_2
+
+    def _command(self, receptor_file, params, maps=None):
+        if maps:
+            # The maps replace the receptor and define the search box
+            cmd = [self.vina_path, '--maps', str(maps)]
+        else:
+            cmd = [
+                self.vina_path,
+                '--receptor', str(receptor_file),
+                '--center_x', str(params['center_x']),
+                '--center_y', str(params['center_y']),
+                '--center_z', str(params['center_z']),
+                '--size_x', str(params['size_x']),
+                '--size_y', str(params['size_y']),
+                '--size_z', str(params['size_z'])
+            ]
+        cmd += [
+            '--num_modes', str(params['num_modes']),
+            '--energy_range', str(params['energy_range']),
+            '--cpu', str(params['cpu'])
+        ]
+        if params.get('exhaustiveness'):
+            cmd += ['--exhaustiveness', str(params['exhaustiveness'])]
+        return cmd
+
+    def _run(self, cmd, label, parser, timeout, on_process):
+        """Run vina and stream its output, returns True if it exited cleanly"""
+        def on_event(event):
+            if event['type'] == 'phase':
+                vina_logger.info("%s: %s", label, event['phase'])
+            elif event['type'] == 'progress':
+                vina_logger.debug("%s: %d%%", label, event['percent'])
+            elif event['type'] == 'line':
+                vina_logger.debug("%s", event['text'])
+
+        try:
+            # Both pipes are drained as output arrives, so a chatty stderr cannot block vina
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if on_process is not None:
+                on_process(process)
+            stderr_tail = stream_process(process, parser, on_event, timeout=timeout)
+
+            # Check process return value
+            if process.returncode == 0:
+                return True
+            logger.error(f"Vina process failed with return code {process.returncode}: {' | '.join(stderr_tail[-3:])}")
+            return False
+        except subprocess.TimeoutExpired:
+            logger.error(f"{label} timed out after {timeout} seconds")
+            return False
+        except OSError as e:
+            logger.error(f"Vina execution failed: {e}")
+            return False
+
+    def dock(self, task_id, ligand_id, receptor_file, ligand_file, params, output_path, on_process=None, maps=None):
+        cmd = self._command(receptor_file, params, maps) + ['--ligand', str(ligand_file), '--out', str(output_path)]
+        parser = VinaOutputParser()
+        if self._run(cmd, f"Task {task_id} ligand {ligand_id}", parser, self.timeout, on_process):
+            return (output_path if output_path.exists() else None), parser.modes
+        return None, []
+
+    def dock_batch(self, task_id, ligands, receptor_file, params, out_dir, on_process=None, maps=None):
+        """Dock all ligands in one vina run (vina 1.2 --batch)
+
+        Vina writes <ligand file stem>_out.pdbqt per ligand into a private
+        directory; complete outputs are moved to out_dir/<ligand_id>_out.pdbqt.
+        A ligand vina rejects aborts the run, so ligands from that one on have
+        no output and are reported as (None, []).
+        """
+        batch_dir = Path(tempfile.mkdtemp(prefix='batch_', dir=out_dir))
+        try:
+            cmd = self._command(receptor_file, params, maps)
+            for _, ligand_file in ligands:
+                cmd += ['--batch', str(ligand_file)]
+            cmd += ['--dir', str(batch_dir)]
+            timeout = self.timeout * len(ligands) if self.timeout else None
+            self._run(cmd, f"Task {task_id} batch of {len(ligands)}", VinaOutputParser(), timeout, on_process)
+
+            results = {}
+            for ligand_id, ligand_file in ligands:
+                produced = batch_dir / f"{Path(ligand_file).stem}_out.pdbqt"
+                # Vina may have been killed while writing this ligand's poses
+                modes = read_output_modes(produced)
+                if modes:
+                    output_path = Path(out_dir) / f"{ligand_id}_out.pdbqt"
+                    os.replace(produced, output_path)
+                    results[ligand_id] = (output_path, modes)
+                else:
+                    results[ligand_id] = (None, [])
+            return results
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+    def write_maps(self, receptor_file, params, map_prefix):
+        """Write the maps for all atom types (vina 1.2 --write_maps)"""
+        cmd = self._command(receptor_file, params) + ['--write_maps', str(map_prefix), '--force_even_voxels']
+        return self._run(cmd, f"Grid maps for {receptor_file}", VinaOutputParser(), self.timeout, None)
+
+class VinaEngineProcess:
+    """A child process holding one Vina engine for a receptor and search box
+
+    The engine's maps live in the child, which is killed on timeout or
+    cancellation like a vina binary run. poll and kill follow subprocess.Popen,
+    so the client tracks it as any other docking process.
+    """
+    def __init__(self, context, receptor_file, center, box_size, cpu):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=run_vina_engine, daemon=True,
+                                       args=(child_connection, str(receptor_file), center, box_size, cpu))
+        self.process.start()
+        child_connection.close()
+        # One ligand at a time per engine, different engines dock in parallel
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def poll(self):
+        return self.process.exitcode
+
+    def kill(self):
+        self.process.kill()
+
+    def request(self, message, timeout=None):
+        """Send one docking request and wait for its reply
+
+        Raises TimeoutError after killing the child when no reply arrives in
+        time, and EOFError when the child died, e.g. killed on cancellation.
+        """
+        self.connection.send(message)
+        if not self.connection.poll(timeout):
+            self.kill()
+            raise TimeoutError(f"no result within {timeout} seconds")
+        return self.connection.recv()
+
+    def close(self):
+        self.closed = True
+        if self.process.exitcode is None:
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+def run_vina_engine(connection, receptor_file, center, box_size, cpu):
+    """Child process of VinaEngineProcess: compute the maps once, then dock every request"""
+    from vina import Vina
+    engine = Vina(sf_name='vina', cpu=cpu, verbosity=0)
+    engine.set_receptor(receptor_file)
+    engine.compute_vina_maps(center=center, box_size=box_size)
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        try:
+            engine.set_ligand_from_file(request['ligand_file'])
+            engine.dock(exhaustiveness=request['exhaustiveness'])
+            engine.write_poses(request['output_path'], n_poses=request['num_modes'],
+                               energy_range=request['energy_range'], overwrite=True)
+            energies = engine.energies(n_poses=request['num_modes'], energy_range=request['energy_range'])
+            connection.send({'energies': [float(row[0]) for row in energies]})
+        except Exception as e:
+            connection.send({'error': str(e)})
+
+class VinaPythonBackend(DockingBackend):
+    """Docks with the Vina Python bindings (pip install vina)
+
+    One engine is kept per receptor content and search box, so the receptor is
+    parsed and the grid maps are computed once and reused for every ligand, also
+    across tasks sharing the receptor. Each engine runs in its own child process:
+    engines dock in parallel, and timeout and cancellation kill the child, which
+    loses its maps. At most max_engines engines are kept, least recently used
+    first out.
+    """
+    name = 'vina_python'
+
+    def __init__(self, max_engines=2, exhaustiveness=VINA_EXHAUSTIVENESS, timeout=None):
+        import vina  # Optional dependency, ImportError when not installed
+        self.max_engines = max_engines
+        self.exhaustiveness = exhaustiveness
+        self.timeout = timeout
+        # Spawned, the children do not inherit the client's threads and sockets
+        self.context = multiprocessing.get_context('spawn')
+        self.engines = OrderedDict()
+        self.receptor_hashes = {}
+        self.lock = threading.Lock()
+
+    def _receptor_hash(self, receptor_file):
+        """Content hash of the receptor, task directories hold their own copy of shared receptors"""
+        stat = os.stat(receptor_file)
+        key = (str(receptor_file), stat.st_size, stat.st_mtime_ns)
+        receptor_hash = self.receptor_hashes.get(key)
+        if receptor_hash is None:
+            sha256 = hashlib.sha256()
+            with open(receptor_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha256.update(chunk)
+            receptor_hash = self.receptor_hashes[key] = sha256.hexdigest()
+        return receptor_hash
+
+    def _engine(self, receptor_file, params):
+        """Return the engine for the receptor and box, called with self.lock held"""
+        center = [float(params['center_x']), float(params['center_y']), float(params['center_z'])]
+        box_size = [float(params['size_x']), float(params['size_y']), float(params['size_z'])]
+        key = (self._receptor_hash(receptor_file), tuple(center), tuple(box_size), int(params['cpu']))
+        engine = self.engines.get(key)
+        if engine is not None and engine.poll() is None:
+            self.engines.move_to_end(key)
+            return key, engine
+
+        logger.info(f"Starting Vina engine for {receptor_file} (center {center}, size {box_size})")
+        engine = self.engines[key] = VinaEngineProcess(self.context, receptor_file, center, box_size,
+                                                       int(params['cpu']))
+        # Engines docking a ligand right now are kept until a later call
+        for old_key, old_engine in list(self.engines.items()):
+            if len(self.engines) <= self.max_engines:
+                break
+            if old_key != key and old_engine.lock.acquire(blocking=False):
+                del self.engines[old_key]
+                old_engine.close()
+                old_engine.lock.release()
+        return key, engine
+
+    def _discard(self, key, engine):
+        with self.lock:
+            if self.engines.get(key) is engine:
+                del self.engines[key]
+        engine.close()
+
+    def dock(self, task_id, ligand_id, receptor_file, ligand_file, params, output_path, on_process=None, maps=None):
+        # The engine keeps its own maps in memory
+        request = {
+            'ligand_file': str(ligand_file),
+            'output_path': str(output_path),
+            'num_modes': int(params['num_modes']),
+            'energy_range': float(params['energy_range']),
+            'exhaustiveness': int(params.get('exhaustiveness') or self.exhaustiveness)
+        }
+        while True:
+            try:
+                with self.lock:
+                    key, engine = self._engine(receptor_file, params)
+            except Exception as e:
+                logger.error(f"Failed to start Vina engine for task {task_id}: {e}")
+                return None, []
+            with engine.lock:
+                # Evicted while this thread waited for it
+                if engine.closed:
+                    continue
+                if on_process is not None:
+                    on_process(engine)
+                try:
+                    reply = engine.request(request, self.timeout)
+                except (TimeoutError, EOFError, OSError) as e:
+                    # Killed on timeout or cancellation, the next ligand starts a new engine
+                    logger.error(f"Vina docking stopped for task {task_id} ligand {ligand_id}: {str(e) or 'engine exited'}")
+                    self._discard(key, engine)
+                    return None, []
+            break
+
+        if 'error' in reply:
+            logger.error(f"Vina docking failed for task {task_id} ligand {ligand_id}: {reply['error']}")
+            return None, []
+        # The bindings report energies only; RMSDs to the best pose are in the output file
+        modes = [
+            {'mode': index + 1, 'affinity': affinity, 'rmsd_lb': None, 'rmsd_ub': None}
+            for index, affinity in enumerate(reply['energies'])
+        ]
+        return (output_path if output_path.exists() else None), modes
+
+    def dock_batch(self, task_id, ligands, receptor_file, params, out_dir, on_process=None, maps=None):
+        """Dock the ligands one after the other on the same engine"""
+        return {
+            ligand_id: self.dock(task_id, ligand_id, receptor_file, ligand_file, params,
+                                 Path(out_dir) / f"{ligand_id}_out.pdbqt", on_process=on_process)
+            for ligand_id, ligand_file in ligands
+        }
+
+    def write_maps(self, receptor_file, params, map_prefix):
+        """Engines compute their maps in memory, the bindings cannot load them from files"""
+        return False
+
+    def close(self):
+        with self.lock:
+            engines = list(self.engines.values())
+            self.engines.clear()
+        for engine in engines:
+            engine.close()
+
+def create_backend(name='subprocess', vina_path=DEFAULT_VINA_PATH, timeout=None, max_engines=2):
+    """Create the configured backend, falling back to the vina binary when the bindings are missing"""
+    if name == VinaPythonBackend.name:
+        try:
+            return VinaPythonBackend(max_engines=max_engines, timeout=timeout)
+        except ImportError:
+            logger.warning("Vina Python bindings are not installed, falling back to the vina binary")
+    elif name != SubprocessBackend.name:
+        logger.warning(f"Unknown docking backend '{name}', using the vina binary")
+    return SubprocessBackend(vina_path, timeout=timeout)
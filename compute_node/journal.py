@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import fcntl
+import threading
+from pathlib import Path
+
+# Rewrite the journal once it holds this many more records than live ligands
+COMPACT_SLACK = 1000
+
+class WorkJournal:
+    """Append-only record of this worker's leases and results
+
+    One JSON line per event: a lease, a finished docking with its output file,
+    and the end of a ligand (submitted, failed, cancelled or released). Leases
+    and docked results are fsynced, so after a crash or reboot replaying the
+    file tells which ligands are still held and which outputs were never
+    submitted. A torn last line is ignored.
+
+    Each worker claims a journal file of its own with an flock, so workers
+    started from the same directory never share one, and a restarted worker
+    picks up a journal its predecessor left behind.
+    """
+    def __init__(self, journal_dir='journal'):
+        self.journal_dir = Path(journal_dir)
+        self.journal_dir.mkdir(exist_ok=True)
+        self.lock = threading.Lock()
+        self.entries = {}  # (task_id, ligand_id) -> unfinished ligand
+        self.records = 0
+        self.path, self.file = self._claim()
+        self._replay()
+
+    def _claim(self):
+        index = 0
+        while True:
+            path = self.journal_dir / f"worker-{index}.jsonl"
+            journal_file = open(path, 'a+')
+            try:
+                fcntl.flock(journal_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                journal_file.close()
+                index += 1
+                continue
+            # The owner may have compacted the file while we waited: retry on the current one
+            if os.fstat(journal_file.fileno()).st_ino == os.stat(path).st_ino:
+                return path, journal_file
+            journal_file.close()
+
+    def _replay(self):
+        self.file.seek(0)
+        line = ''
+        for line in self.file:
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                # Torn write of the last record before a crash
+                continue
+            self.records += 1
+        if line and not line.endswith('\n'):
+            # Start the next record on a line of its own
+            self.file.write('\n')
+            self.file.flush()
+
+    def _apply(self, record):
+        event = record['event']
+        if event == 'lease':
+            for ligand in record['ligands']:
+                self.entries[(record['task_id'], ligand['ligand_id'])] = {
+                    'task_id': record['task_id'],
+                    'ligand_id': ligand['ligand_id'],
+                    'ligand_file': ligand['ligand_file'],
+                    'receptor_hash': record.get('receptor_hash'),
+                    'params': record.get('params'),
+                    'speculative': record.get('speculative', False),
+                    'node_id': record.get('node_id'),
+                    'leased_at': record.get('leased_at'),
+                    'lease_timeout': record.get('lease_timeout'),
+                    'output_file': None,
+                    'modes': []
+                }
+        elif event == 'docked':
+            entry = self.entries.get((record['task_id'], record['ligand_id']))
+            if entry is not None:
+                entry['output_file'] = record['output_file']
+                entry['modes'] = record.get('modes') or []
+        elif event == 'done':
+            self.entries.pop((record['task_id'], record['ligand_id']), None)
+
+    def _append(self, record, durable):
+        with self.lock:
+            self._apply(record)
+            self.file.write(json.dumps(record, default=str) + '\n')
+            self.file.flush()
+            if durable:
+                os.fsync(self.file.fileno())
+            self.records += 1
+            if self.records > len(self.entries) * 4 + COMPACT_SLACK:
+                self._compact()
+
+    def lease(self, task, node_id):
+        """Record a lease from the server, before any of its ligands is docked"""
+        self._append({
+            'event': 'lease',
+            'task_id': task['task_id'],
+            'ligands': [{'ligand_id': ligand['ligand_id'], 'ligand_file': ligand['ligand_file']}
+                        for ligand in task.get('ligands') or [task]],
+            'receptor_hash': task.get('receptor_hash'),
+            'params': task.get('params'),
+            'speculative': bool(task.get('speculative')),
+            'node_id': node_id,
+            'leased_at': task.get('leased_at') or time.time(),
+            # The server's lease timeout, recovery resumes only leases it has not expired
+            'lease_timeout': task.get('lease_timeout')
+        }, durable=True)
+
+    def docked(self, task_id, ligand_id, output_file, modes):
+        """Record a finished docking whose output has not been submitted yet"""
+        self._append({
+            'event': 'docked',
+            'task_id': task_id,
+            'ligand_id': ligand_id,
+            'output_file': str(output_file),
+            'modes': modes
+        }, durable=True)
+
+    def finish(self, task_id, ligand_id, status):
+        """Record the end of a ligand; losing this record only repeats a harmless submit or release"""
+        self._append({'event': 'done', 'task_id': task_id, 'ligand_id': ligand_id, 'status': status}, durable=False)
+
+    def unfinished(self):
+        """Leased ligands without a recorded end, oldest lease first"""
+        with self.lock:
+            return sorted((dict(entry) for entry in self.entries.values()), key=lambda entry: entry['leased_at'] or 0)
+
+    def holds(self, task_id, ligand_id):
+        """Whether the ligand is leased to this worker and not finished"""
+        with self.lock:
+            return (task_id, ligand_id) in self.entries
+
+    def unfinished_tasks(self):
+        with self.lock:
+            return {task_id for task_id, _ in self.entries}
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the journal with only the unfinished ligands"""
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as tmp_file:
+            for entry in self.entries.values():
+                tmp_file.write(json.dumps({
+                    'event': 'lease',
+                    'task_id': entry['task_id'],
+                    'ligands': [{'ligand_id': entry['ligand_id'], 'ligand_file': entry['ligand_file']}],
+                    'receptor_hash': entry['receptor_hash'],
+                    'params': entry['params'],
+                    'speculative': entry['speculative'],
+                    'node_id': entry['node_id'],
+                    'leased_at': entry['leased_at'],
+                    'lease_timeout': entry['lease_timeout']
+                }, default=str) + '\n')
+                if entry['output_file']:
+                    tmp_file.write(json.dumps({
+                        'event': 'docked',
+                        'task_id': entry['task_id'],
+                        'ligand_id': entry['ligand_id'],
+                        'output_file': entry['output_file'],
+                        'modes': entry['modes']
+                    }, default=str) + '\n')
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        # Lock the new file before it replaces the old one, so the claim is never lost
+        new_file = open(tmp_path, 'a+')
+        fcntl.flock(new_file, fcntl.LOCK_EX)
+        os.replace(tmp_path, self.path)
+        self.file.close()
+        self.file = new_file
+        self.records = len(self.entries) + sum(1 for entry in self.entries.values() if entry['output_file'])
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import os
+from pathlib import Path
+
+# Set by the daemon for each worker: the CPUs of the worker's docking slot, e.g. "0-7"
+CPUS_ENV = 'VORTEXDOCK_CPUS'
+
+STRATEGIES = ('none', 'compact', 'spread')
+
+def parse_cpu_list(text):
+    """Parse a kernel CPU list such as "0-3,8-11" """
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def format_cpu_list(cpus):
+    """Format CPUs as a kernel CPU list, the inverse of parse_cpu_list"""
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
+
+class Topology:
+    """Usable CPUs per NUMA node, each node ordered one hardware thread per
+    physical core first and SMT siblings after, so slots fill physical cores first"""
+    def __init__(self, nodes):
+        self.nodes = {node: cpus for node, cpus in sorted(nodes.items()) if cpus}
+
+    @classmethod
+    def detect(cls, sys_root='/sys/devices/system'):
+        allowed = os.sched_getaffinity(0)
+        nodes = {}
+        for path in sorted(Path(sys_root, 'node').glob('node[0-9]*')):
+            try:
+                cpus = parse_cpu_list((path / 'cpulist').read_text())
+            except (OSError, ValueError):
+                continue
+            nodes[int(path.name[4:])] = [cpu for cpu in cpus if cpu in allowed]
+        if not any(nodes.values()):
+            # No NUMA information (containers, non-Linux /sys layouts): one node
+            nodes = {0: sorted(allowed)}
+        return cls({node: cls._order_by_core(cpus, sys_root) for node, cpus in nodes.items()})
+
+    @staticmethod
+    def _order_by_core(cpus, sys_root):
+        """Order CPUs so that each physical core contributes one thread before any sibling"""
+        rank = {}
+        for cpu in cpus:
+            try:
+                siblings = parse_cpu_list(Path(sys_root, 'cpu', f'cpu{cpu}', 'topology', 'thread_siblings_list').read_text())
+                rank[cpu] = sorted(siblings).index(cpu)
+            except (OSError, ValueError):
+                rank[cpu] = 0
+        return sorted(cpus, key=lambda cpu: (rank[cpu], cpu))
+
+    @property
+    def cpu_count(self):
+        return sum(len(cpus) for cpus in self.nodes.values())
+
+def plan_slots(topology, slots, cpus_per_slot, strategy='compact'):
+    """Assign a CPU set to each of slots docking slots
+
+    compact fills NUMA node 0 before node 1, spread alternates between nodes.
+    A slot never straddles nodes unless it is larger than a node. Returns a
+    list of sorted CPU lists, or a list of None for strategy 'none'. When the
+    host has fewer CPUs than slots * cpus_per_slot, the slots without a whole
+    chunk split the CPUs left over as evenly as possible, and only slots beyond
+    that reuse CPUs, taking the planned sets in turn.
+    """
+    if strategy == 'none' or slots <= 0:
+        return [None] * max(slots, 0)
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown placement strategy: {strategy}")
+    cpus_per_slot = max(int(cpus_per_slot), 1)
+
+    if cpus_per_slot > max(len(cpus) for cpus in topology.nodes.values()):
+        pools = [[cpu for cpus in topology.nodes.values() for cpu in cpus]]
+    else:
+        pools = list(topology.nodes.values())
+
+    # Whole slots inside each node; the remainders of all nodes form further slots
+    per_pool = []
+    leftover = []
+    for cpus in pools:
+        count = len(cpus) // cpus_per_slot
+        per_pool.append([cpus[i * cpus_per_slot:(i + 1) * cpus_per_slot] for i in range(count)])
+        leftover.extend(cpus[count * cpus_per_slot:])
+
+    if strategy == 'compact':
+        plan = [chunk for chunks in per_pool for chunk in chunks]
+    else:
+        plan = []
+        for index in range(max((len(chunks) for chunks in per_pool), default=0)):
+            plan.extend(chunks[index] for chunks in per_pool if index < len(chunks))
+    whole = len(leftover) // cpus_per_slot
+    plan.extend(leftover[i * cpus_per_slot:(i + 1) * cpus_per_slot] for i in range(whole))
+    # Smaller slots on the CPUs no whole slot covers, before any CPU is shared
+    remainder = leftover[whole * cpus_per_slot:]
+    parts = min(slots - len(plan), len(remainder))
+    plan.extend(remainder[i * len(remainder) // parts:(i + 1) * len(remainder) // parts] for i in range(max(parts, 0)))
+    return [sorted(plan[slot % len(plan)]) for slot in range(slots)]
+
+def apply_worker_affinity():
+    """Pin this worker to the CPUs the daemon assigned to it
+
+    Returns the CPU list, or None when the worker was not given a slot.
+    Child processes such as vina inherit the affinity.
+    """
+    text = os.environ.get(CPUS_ENV)
+    if not text:
+        return None
+    cpus = parse_cpu_list(text)
+    os.sched_setaffinity(0, cpus)
+    return cpus
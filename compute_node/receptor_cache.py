@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import re
+import fcntl
+import shutil
+import hashlib
+import tarfile
+from pathlib import Path
+from contextlib import contextmanager
+
+# Receptors are cached under their SHA-256 content hash, shared by every task using them
+RECEPTOR_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+def cached_receptor_path(cache_dir, task_id, receptor_hash=None):
+    """Path of the cached receptor, keyed by content hash when the server provides one"""
+    if receptor_hash:
+        return Path(cache_dir) / f"{receptor_hash}.pdbqt"
+    return Path(cache_dir) / f"{task_id}_receptor.pdbqt"
+
+@contextmanager
+def cache_file_lock(cache_dir, name):
+    """Exclusive lock on a cache entry, held across all processes sharing the cache directory"""
+    with open(Path(cache_dir) / f".{name}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def list_cached_receptors(cache_dir):
+    """Return the content hashes of all receptors in the cache directory"""
+    cache_dir = Path(cache_dir)
+    if not cache_dir.is_dir():
+        return []
+    return [path.stem for path in cache_dir.glob('*.pdbqt') if RECEPTOR_HASH_PATTERN.match(path.stem)]
+
+# Grid maps are reused on this node by every task docking against the same receptor and
+# search box; the server stores and serves them per task
+GRID_MAPS_ARCHIVE = 'maps.tar.gz'
+GRID_MAPS_PREFIX = 'receptor'
+GRID_MAP_FIELDS = ('center_x', 'center_y', 'center_z', 'size_x', 'size_y', 'size_z')
+
+def grid_maps_key(task_id, receptor_hash, params):
+    """Cache key of the grid maps for a receptor and search box"""
+    box = ','.join(f"{float(params[field]):.4f}" for field in GRID_MAP_FIELDS)
+    source = receptor_hash or f"task-{task_id}"
+    return hashlib.sha256(f"{source}|{box}".encode()).hexdigest()
+
+def cached_grid_maps_dir(cache_dir, key):
+    """Directory holding the cached maps, it only exists once complete"""
+    return Path(cache_dir) / 'maps' / key
+
+def pack_grid_maps(map_dir, archive_path):
+    """Write the map files of map_dir into a gzipped tar archive"""
+    with tarfile.open(archive_path, 'w:gz') as archive:
+        for path in sorted(Path(map_dir).iterdir()):
+            if path.is_file():
+                archive.add(path, arcname=path.name)
+
+def unpack_grid_maps(archive_path, map_dir):
+    """Extract a map archive into map_dir, accepting plain files only"""
+    map_dir = Path(map_dir)
+    with tarfile.open(archive_path, 'r:gz') as archive:
+        for member in archive.getmembers():
+            name = Path(member.name).name
+            if not member.isfile() or name != member.name or not name.startswith(GRID_MAPS_PREFIX + '.'):
+                raise ValueError(f"Unexpected entry in grid map archive: {member.name}")
+            source = archive.extractfile(member)
+            with open(map_dir / name, 'wb') as f:
+                shutil.copyfileobj(source, f)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+from pathlib import Path
+
+from utils.logger import logger
+
+def available_memory():
+    """MemAvailable from /proc/meminfo in bytes, None where it is not available"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class ScratchSpace:
+    """Directories for per-ligand files: the downloaded ligand and vina's output
+
+    With a scratch root on tmpfs (e.g. /dev/shm) the files of a ligand never
+    touch the disk. A ligand falls back to work_dir/<task>/ligands when the
+    tmpfs or the host's available memory is below min_free_bytes, since tmpfs
+    pages are memory that vina and the other workers need. Outputs on tmpfs
+    are uploaded from there; only one whose submit failed is moved to disk
+    with persist, so it survives a reboot until it is submitted again.
+    """
+    def __init__(self, work_dir, scratch_root=None, worker_name='worker-0', min_free_bytes=1024 * 1024 * 1024):
+        self.work_dir = Path(work_dir)
+        self.min_free_bytes = min_free_bytes
+        self.root = None
+        if scratch_root:
+            root = Path(scratch_root) / f"vortexdock-{os.getuid()}" / worker_name
+            try:
+                root.mkdir(parents=True, exist_ok=True)
+                os.chmod(root.parent, 0o700)
+                self.root = root
+            except OSError as e:
+                logger.warning(f"Scratch directory {root} unusable, keeping ligand files on disk: {e}")
+
+    def _has_room(self):
+        try:
+            if shutil.disk_usage(self.root).free < self.min_free_bytes:
+                return False
+        except OSError:
+            return False
+        memory = available_memory()
+        return memory is None or memory >= self.min_free_bytes
+
+    def ligand_dir(self, task_id):
+        """Directory for the next ligand of a task, on tmpfs when there is room"""
+        if self.root is not None and self._has_room():
+            ligand_dir = self.root / str(task_id)
+        else:
+            ligand_dir = self.work_dir / str(task_id) / 'ligands'
+        ligand_dir.mkdir(parents=True, exist_ok=True)
+        return ligand_dir
+
+    def is_scratch(self, path):
+        """Whether path is on the tmpfs scratch root"""
+        return self.root is not None and self.root in Path(path).parents
+
+    def persist(self, task_id, path):
+        """Move an output off tmpfs into work_dir/<task>/ligands, returns its new path
+
+        The copy is fsynced before it replaces anything, so a journal record
+        pointing at it never refers to a torn file. Paths already on disk are
+        returned unchanged.
+        """
+        path = Path(path)
+        if not self.is_scratch(path):
+            return path
+        disk_dir = self.work_dir / str(task_id) / 'ligands'
+        disk_dir.mkdir(parents=True, exist_ok=True)
+        target = disk_dir / path.name
+        tmp_path = target.with_name(f".{target.name}.tmp")
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, target)
+        path.unlink()
+        return target
+
+    def ligand_dirs(self, task_id):
+        """Every directory a ligand of the task may have been placed in"""
+        dirs = [self.work_dir / str(task_id) / 'ligands']
+        if self.root is not None:
+            dirs.append(self.root / str(task_id))
+        return dirs
+
+    def sweep(self, keep_tasks, min_age=60):
+        """Remove the tmpfs directories of tasks without unfinished ligands
+
+        Directories changed in the last min_age seconds are kept, they may
+        belong to a lease taken after keep_tasks was read.
+        """
+        if self.root is None:
+            return
+        keep = {str(task_id) for task_id in keep_tasks}
+        now = time.time()
+        for task_dir in self.root.iterdir():
+            try:
+                if task_dir.name in keep or now - task_dir.stat().st_mtime < min_age:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(task_dir, ignore_errors=True)
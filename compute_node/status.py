@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import socket
+import threading
+
+# Set by the daemon for the client.py workers it starts
+WORKER_SOCKET_ENV = 'VORTEXDOCK_WORKER_SOCKET'
+WORKER_ID_ENV = 'VORTEXDOCK_WORKER_ID'
+
+# A status update always fits in one datagram
+MAX_DATAGRAM = 4096
+
+def _bind_unix(path, kind):
+    """Bind a Unix socket, replacing a stale socket file left by a previous run"""
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, kind)
+    sock.bind(path)
+    return sock
+
+class StatusReporter:
+    """Sends a worker's state to the daemon as one Unix datagram per change
+
+    Sending never blocks or raises: without a daemon listening, updates are dropped.
+    """
+    def __init__(self, path=None, worker_id=None):
+        self.path = path or os.environ.get(WORKER_SOCKET_ENV)
+        self.lock = threading.Lock()
+        self.state = {
+            'worker_id': worker_id if worker_id is not None else os.environ.get(WORKER_ID_ENV),
+            'pid': os.getpid(),
+            'state': 'starting',
+            'completed': 0,
+            'failed': 0
+        }
+        self.sock = None
+        if self.path:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+
+    def update(self, **fields):
+        with self.lock:
+            self.state.update(fields)
+            self.state['updated_at'] = time.time()
+            self._send()
+
+    def count(self, result):
+        """Record how a ligand ended, counting completed and failed ones"""
+        with self.lock:
+            if result == 'completed':
+                self.state['completed'] += 1
+            elif result in ('failed', 'submit_failed'):
+                self.state['failed'] += 1
+            self.state['last_result'] = result
+            self.state['updated_at'] = time.time()
+            self._send()
+
+    def _send(self):
+        if self.sock is None:
+            return
+        try:
+            self.sock.sendto(json.dumps(self.state, default=str).encode(), self.path)
+        except OSError:
+            pass
+
+class StatusCollector:
+    """Receives worker status datagrams in the daemon, keeping the latest per worker"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.statuses = {}
+        self.sock = _bind_unix(path, socket.SOCK_DGRAM)
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def _receive(self):
+        while True:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM)
+            except OSError:
+                return
+            try:
+                status = json.loads(data)
+            except ValueError:
+                continue
+            with self.lock:
+                self.statuses[str(status.get('worker_id'))] = status
+
+    def get(self, worker_id):
+        with self.lock:
+            return self.statuses.get(str(worker_id))
+
+    def forget(self, worker_id):
+        with self.lock:
+            self.statuses.pop(str(worker_id), None)
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class StatusEndpoint:
+    """Local status endpoint: each connection receives one JSON snapshot and is closed"""
+    def __init__(self, path, snapshot):
+        self.path = path
+        self.snapshot = snapshot
+        self.sock = _bind_unix(path, socket.SOCK_STREAM)
+        self.sock.listen(8)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            try:
+                with conn:
+                    conn.settimeout(2)
+                    conn.sendall(json.dumps(self.snapshot(), default=str).encode())
+            except Exception:
+                # A failed snapshot or a viewer that went away must not stop the endpoint
+                pass
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def read_status(path, timeout=2):
+    """Fetch a snapshot from a running daemon's status endpoint"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b''.join(chunks))
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import codecs
+import selectors
+import subprocess
+from collections import deque
+
+# Longest stderr line kept for error reports
+MAX_STDERR_LINE = 1000
+
+# Vina draws a progress bar of 51 '*' characters without newlines
+PROGRESS_STARS = 51
+
+# Progress lines announcing a new phase of the run
+PHASE_MARKERS = (
+    ('Reading input', 'reading_input'),
+    ('Performing search', 'searching'),
+    ('Refining results', 'refining'),
+    ('Writing output', 'writing_output'),
+)
+
+class VinaOutputParser:
+    """Incremental parser turning Vina's stdout into structured events
+
+    Events are dicts with a 'type' of:
+      phase     {'phase': 'reading_input' | 'searching' | 'refining' | 'writing_output'}
+      progress  {'percent': 0-100}, from the '*' progress bar
+      mode      {'mode', 'affinity', 'rmsd_lb', 'rmsd_ub'}, one per row of the result table
+      line      {'text'}, any other output
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.stars = 0
+        self.in_table = False
+        self.modes = []
+
+    def feed(self, text):
+        """Parse a chunk of output and return the events it completes"""
+        events = []
+        # Progress stars arrive one by one on an unterminated line
+        stars = text.count('*')
+        if stars:
+            before = self.stars * 100 // PROGRESS_STARS
+            self.stars = min(self.stars + stars, PROGRESS_STARS)
+            after = self.stars * 100 // PROGRESS_STARS
+            if after // 10 > before // 10:
+                events.append({'type': 'progress', 'percent': after})
+
+        self.buffer += text
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            event = self._parse_line(line.rstrip('\r'))
+            if event is not None:
+                events.append(event)
+        return events
+
+    def close(self):
+        """Parse any trailing output without a newline"""
+        events = []
+        if self.buffer:
+            event = self._parse_line(self.buffer)
+            self.buffer = ''
+            if event is not None:
+                events.append(event)
+        return events
+
+    def _parse_line(self, line):
+        stripped = line.strip()
+        if self.in_table:
+            mode = self._parse_mode(stripped)
+            if mode is not None:
+                self.modes.append(mode)
+                return dict(mode, type='mode')
+            self.in_table = False
+        if not stripped or set(stripped) <= set('*0123456789%| '):
+            # Progress bar and its scale
+            return None
+        if stripped.startswith('-----+'):
+            self.in_table = True
+            return None
+        for marker, phase in PHASE_MARKERS:
+            if stripped.startswith(marker):
+                return {'type': 'phase', 'phase': phase}
+        return {'type': 'line', 'text': stripped}
+
+    @staticmethod
+    def _parse_mode(line):
+        fields = line.split()
+        if len(fields) != 4:
+            return None
+        try:
+            return {
+                'mode': int(fields[0]),
+                'affinity': float(fields[1]),
+                'rmsd_lb': float(fields[2]),
+                'rmsd_ub': float(fields[3])
+            }
+        except ValueError:
+            return None
+
+def stream_process(process, parser, on_event, timeout=None, stderr_lines=20):
+    """Drain stdout and stderr of a running process without blocking on either pipe
+
+    stdout is fed to the parser and each event passed to on_event. The last
+    stderr_lines lines of stderr are kept and returned. The process is killed
+    and subprocess.TimeoutExpired raised if it runs longer than timeout seconds.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    stderr_tail = deque(maxlen=stderr_lines)
+    stderr_buffer = ''
+    # Chunks may split multi-byte characters
+    decoders = {
+        'stdout': codecs.getincrementaldecoder('utf-8')(errors='replace'),
+        'stderr': codecs.getincrementaldecoder('utf-8')(errors='replace')
+    }
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, 'stdout')
+        selector.register(process.stderr, selectors.EVENT_READ, 'stderr')
+        while selector.get_map():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    process.kill()
+                    process.wait()
+                    raise subprocess.TimeoutExpired(process.args, timeout)
+            for key, _ in selector.select(remaining):
+                data = os.read(key.fileobj.fileno(), 65536)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    continue
+                text = decoders[key.data].decode(data)
+                if key.data == 'stdout':
+                    for event in parser.feed(text):
+                        on_event(event)
+                else:
+                    lines = (stderr_buffer + text).split('\n')
+                    stderr_buffer = lines.pop()
+                    stderr_tail.extend(line[:MAX_STDERR_LINE] for line in lines if line.strip())
+                    stderr_buffer = stderr_buffer[-MAX_STDERR_LINE:]
+    for event in parser.close():
+        on_event(event)
+    if stderr_buffer.strip():
+        stderr_tail.append(stderr_buffer[:MAX_STDERR_LINE])
+
+    remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+    try:
+        process.wait(remaining)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        raise
+    return list(stderr_tail)
+
+def read_output_modes(output_path):
+    """Mode table from the REMARK VINA RESULT lines of a Vina output file
+
+    Returns [] when the file is missing or was cut off before its last model.
+    """
+    try:
+        with open(output_path, 'r', errors='replace') as f:
+            text = f.read()
+    except OSError:
+        return []
+    if not text.rstrip().endswith('ENDMDL'):
+        return []
+    modes = []
+    for line in text.splitlines():
+        if line.startswith('REMARK VINA RESULT:'):
+            mode = VinaOutputParser._parse_mode(f"{len(modes) + 1} {line[len('REMARK VINA RESULT:'):]}")
+            if mode is not None:
+                modes.append(mode)
+    return modes
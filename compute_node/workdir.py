@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import shutil
+import threading
+from pathlib import Path
+
+from utils.logger import logger
+
+INDEX_FILE = 'index.json'
+
+class WorkDirIndex:
+    """Files, sizes and last use of each task directory under a worker's work_dir
+
+    Files are registered as they are written and a ligand's files are deleted
+    as soon as the server has its result, so a task directory normally only
+    holds its receptor. Expiry and disk limits are decided from the index,
+    which is saved to work_dir/index.json, instead of walking the tree.
+    Files outside the task directory, such as ligands on a tmpfs scratch
+    directory, are recorded by absolute path and do not count towards the
+    disk limits.
+    """
+    def __init__(self, work_dir, max_bytes=0, min_free_bytes=0):
+        self.work_dir = Path(work_dir)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.work_dir / INDEX_FILE
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.lock = threading.Lock()
+        # Set when a write pushes the directory over a limit, wakes the cleanup thread
+        self.pressure = threading.Event()
+        self.tasks = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                tasks = json.load(f)
+        except (OSError, ValueError):
+            tasks = {}
+        # Directories written after the last save, or by a version without the index
+        for task_dir in self.work_dir.iterdir():
+            if task_dir.is_dir() and task_dir.name not in tasks:
+                tasks[task_dir.name] = self._scan(task_dir)
+        return tasks
+
+    def _scan(self, task_dir):
+        files = {}
+        for path in task_dir.rglob('*'):
+            try:
+                if path.is_file():
+                    files[str(path.relative_to(task_dir))] = path.stat().st_size
+            except OSError:
+                pass
+        try:
+            last_used = task_dir.stat().st_mtime
+        except OSError:
+            last_used = time.time()
+        return {'last_used': last_used, 'files': files, 'ligands': {}}
+
+    def _entry(self, task_id):
+        entry = self.tasks.setdefault(str(task_id), {'last_used': 0, 'files': {}, 'ligands': {}})
+        entry['last_used'] = time.time()
+        return entry
+
+    def _relative(self, task_id, path):
+        """Path relative to the task directory, or absolute for files outside it"""
+        try:
+            return str(Path(path).relative_to(self.work_dir / str(task_id))), True
+        except ValueError:
+            return str(Path(path).absolute()), False
+
+    def add(self, task_id, path, ligand_id=None):
+        """Register a file written for a task, owned by ligand_id if given"""
+        path = Path(path)
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return
+        relative, inside = self._relative(task_id, path)
+        size = size if inside else 0
+        with self.lock:
+            entry = self._entry(task_id)
+            entry['files'][relative] = size
+            if ligand_id is not None:
+                owned = entry['ligands'].setdefault(str(ligand_id), [])
+                if relative not in owned:
+                    owned.append(relative)
+        if self.over_limit():
+            self.pressure.set()
+
+    def discard(self, task_id, ligand_id, *paths):
+        """Delete the files of a ligand whose result the server no longer needs"""
+        task_dir = self.work_dir / str(task_id)
+        with self.lock:
+            entry = self.tasks.get(str(task_id))
+            owned = entry['ligands'].pop(str(ligand_id), []) if entry else []
+            relatives = set(owned) | {self._relative(task_id, path)[0] for path in paths}
+            for relative in relatives:
+                try:
+                    (task_dir / relative).unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.debug(f"Failed to delete {task_dir / relative}: {e}")
+                if entry:
+                    entry['files'].pop(relative, None)
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(sum(entry['files'].values()) for entry in self.tasks.values())
+
+    def over_limit(self):
+        if self.max_bytes and self.total_bytes() > self.max_bytes:
+            return True
+        if self.min_free_bytes:
+            try:
+                return shutil.disk_usage(self.work_dir).free < self.min_free_bytes
+            except OSError:
+                return False
+        return False
+
+    def wait_for_pressure(self, timeout):
+        """Sleep until the next periodic sweep, or until a write exceeds a limit"""
+        self.pressure.wait(timeout)
+        self.pressure.clear()
+
+    def sweep(self, max_age, protected=(), now=None):
+        """Delete task directories idle for max_age seconds, then the least recently
+        used ones while over a limit; tasks in protected are never deleted.
+        Returns the deleted task IDs."""
+        now = time.time() if now is None else now
+        protected = {str(task_id) for task_id in protected}
+        removed = []
+        with self.lock:
+            for task_id, entry in list(self.tasks.items()):
+                if task_id not in protected and now - entry['last_used'] > max_age:
+                    self._remove(task_id)
+                    removed.append(task_id)
+        while self.over_limit():
+            with self.lock:
+                candidates = sorted((entry['last_used'], task_id) for task_id, entry in self.tasks.items()
+                                    if task_id not in protected)
+                if not candidates:
+                    logger.warning(f"Work directory {self.work_dir} is over its disk limit with only active tasks left")
+                    break
+                task_id = candidates[0][1]
+                self._remove(task_id)
+                removed.append(task_id)
+        self.save()
+        return removed
+
+    def _remove(self, task_id):
+        shutil.rmtree(self.work_dir / task_id, ignore_errors=True)
+        del self.tasks[task_id]
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.tasks)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+def remove_legacy_task_dirs(root, max_age):
+    """Delete task directories of the layout before per-worker work directories once they expire"""
+    now = time.time()
+    for task_dir in Path(root).iterdir():
+        if task_dir.is_dir() and not task_dir.name.startswith('worker-'):
+            try:
+                if now - task_dir.stat().st_mtime > max_age:
+                    logger.info(f"Cleaning up expired task directory: {task_dir}")
+                    shutil.rmtree(task_dir, ignore_errors=True)
+            except OSError:
+                pass
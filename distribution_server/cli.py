@@ -1,12 +1,23 @@
 import os
 import sys
+import shutil
 import zipfile
 import argparse
 from pathlib import Path
+from datetime import datetime
 
 sys.path.append('..')
-from utils.db import execute_query, execute_update, get_db_connection
+from utils.db import execute_query, execute_update, execute_many, get_db_connection, migrate_tasks_table
 from config import DB_CONFIG
+from pdbqt import inspect_ligands, estimate_cost, hash_file
+
+# Docking parameters read from parameter.txt and their types; the search box is required
+PARAM_TYPES = {
+    'center_x': float, 'center_y': float, 'center_z': float,
+    'size_x': float, 'size_y': float, 'size_z': float,
+    'num_modes': int, 'energy_range': float, 'cpu': int, 'exhaustiveness': int
+}
+PARAM_DEFAULTS = {'num_modes': 9, 'energy_range': 3, 'cpu': 1, 'exhaustiveness': 8}
 
 def init_db():
     """Initialize the database"""
@@ -27,6 +38,12 @@ def init_db():
                 num_modes INTEGER,
                 energy_range REAL,
                 cpu INTEGER,
+                exhaustiveness INTEGER,
+                owner TEXT DEFAULT 'default',
+                priority REAL DEFAULT 1,
+                deadline TIMESTAMP NULL,
+                receptor_hash TEXT,
+                receptor_size INTEGER DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
@@ -46,21 +63,28 @@ def init_db():
                 num_modes INT,
                 energy_range FLOAT,
                 cpu INT,
+                exhaustiveness INT,
+                owner VARCHAR(255) DEFAULT 'default',
+                priority FLOAT DEFAULT 1,
+                deadline TIMESTAMP NULL,
+                receptor_hash VARCHAR(64),
+                receptor_size BIGINT DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
     conn.commit()
     conn.close()
+    migrate_tasks_table()
 
 def list_tasks():
-    tasks = execute_query('SELECT id, status, created_at FROM tasks')
+    tasks = execute_query('SELECT id, status, owner, priority, created_at FROM tasks')
     
     if not tasks:
         print("No tasks found")
     else:
         print("Task List:")
-        print("ID\tStatus\tProgress\t\tSpeed (items/min)\tCreated At")
+        print("ID\tStatus\tOwner\tPriority\tProgress\t\tSpeed (items/min)\tCreated At")
         for task in tasks:
             task_id = task['id']
             # Get the total number of ligands and completed ligands for the task
@@ -80,7 +104,71 @@ def list_tasks():
             ''', fetch_one=True)['count']
             speed = recent_completed / 5 if recent_completed > 0 else 0
             
-            print(f"{task_id}\t{task['status']}\t{progress_bar}\t{speed:.1f}\t\t{task['created_at']}")
+            print(f"{task_id}\t{task['status']}\t{task['owner']}\t{task['priority']}\t\t{progress_bar}\t{speed:.1f}\t\t{task['created_at']}")
+
+# Phases reported by trace_report: (name, start timestamp, end timestamp)
+TRACE_PHASES = (
+    ('dispatch', 'requested_at', 'leased_at'),
+    ('download', 'download_start', 'download_end'),
+    ('vina', 'vina_start', 'vina_end'),
+    ('upload', 'upload_start', 'upload_end'),
+    ('ack', 'upload_end', 'acked_at')
+)
+
+def summarize_traces(traces, key):
+    # Sum phase durations per group; wall time runs from the first to the last timestamp of each ligand
+    groups = {}
+    for trace in traces:
+        group = groups.setdefault(trace[key], {'ligands': 0, 'wall': 0.0, 'phases': {name: 0.0 for name, _, _ in TRACE_PHASES}})
+        # Later ligands of a batch wait behind the first one; that wait is not charged to them
+        fields = [field for _, start, end in TRACE_PHASES for field in (start, end)
+                  if trace['requested_at'] is not None or field != 'leased_at']
+        timestamps = [trace[field] for field in fields if trace[field] is not None]
+        if len(timestamps) < 2:
+            continue
+        group['ligands'] += 1
+        group['wall'] += max(timestamps) - min(timestamps)
+        for name, start, end in TRACE_PHASES:
+            if trace[start] is not None and trace[end] is not None:
+                group['phases'][name] += max(trace[end] - trace[start], 0)
+    return groups
+
+def print_trace_summary(title, groups):
+    phase_names = [name for name, _, _ in TRACE_PHASES]
+    print(title)
+    print("ID\tLigands\tWall (s)\t" + "\t".join(phase_names) + "\tother")
+    for group_id, group in sorted(groups.items()):
+        wall = group['wall']
+        if not group['ligands'] or wall <= 0:
+            continue
+        shares = [group['phases'][name] / wall for name in phase_names]
+        other = max(1 - sum(shares), 0)
+        print(f"{group_id}\t{group['ligands']}\t{wall:.1f}\t" + "\t".join(f"{share:.0%}" for share in shares) + f"\t{other:.0%}")
+
+def trace_report(task_id=None):
+    # Show where compute node wall time goes, per node and per task
+    try:
+        if task_id:
+            traces = execute_query('SELECT * FROM ligand_traces WHERE task_id = ?', (task_id,))
+        else:
+            traces = execute_query('SELECT * FROM ligand_traces')
+    except Exception as e:
+        print(f"Error reading ligand traces: {str(e)}")
+        return
+    
+    if not traces:
+        print("No ligand traces recorded")
+        return
+    
+    print_trace_summary("Per-node time breakdown:", summarize_traces(traces, 'node_id'))
+    print()
+    print_trace_summary("Per-task time breakdown:", summarize_traces(traces, 'task_id'))
+    
+    statuses = {}
+    for trace in traces:
+        statuses[trace['status']] = statuses.get(trace['status'], 0) + 1
+    print()
+    print("Outcomes: " + ", ".join(f"{status}={count}" for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))))
 
 def create_progress_bar(progress, width=20):
     # Generate a progress bar string
@@ -90,7 +178,75 @@ def create_progress_bar(progress, width=20):
     percentage = int(progress * 100)
     return f'[{bar}] {percentage}%'
 
-def create_task(zip_path, name):
+def parse_parameters(path):
+    """Read parameter.txt in Vina config syntax: key = value lines, # comments
+
+    Vina options that are not task parameters (out, seed, ...) are
+    ignored. Raises ValueError naming the line of a malformed entry or the
+    missing search box fields.
+    """
+    params = dict(PARAM_DEFAULTS)
+    with open(path, 'r', encoding='utf-8-sig', errors='replace') as f:
+        for number, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            key, separator, value = line.partition('=')
+            if not separator:
+                raise ValueError(f"parameter.txt line {number}: expected 'key = value', got '{line}'")
+            key, value = key.strip().lower(), value.strip()
+            if key not in PARAM_TYPES:
+                continue
+            try:
+                params[key] = PARAM_TYPES[key](value)
+            except ValueError:
+                raise ValueError(f"parameter.txt line {number}: invalid value for {key}: '{value}'")
+    
+    missing = [key for key in PARAM_TYPES if key not in params]
+    if missing:
+        raise ValueError(f"parameter.txt is missing {', '.join(missing)}")
+    if min(params['size_x'], params['size_y'], params['size_z']) <= 0:
+        raise ValueError("parameter.txt search box sizes must be greater than 0")
+    if params['exhaustiveness'] < 1:
+        raise ValueError("parameter.txt exhaustiveness must be at least 1")
+    return params
+
+def validate_ligands(ligand_files, workers=None):
+    """Check ligands in parallel and split them into (valid, invalid, duplicates)
+
+    valid is a list of (path, summary); invalid of (path, errors); duplicates
+    of (path, kept path) for files with the same molecule or ligand ID as a
+    file kept earlier.
+    """
+    valid, invalid, duplicates = [], [], []
+    seen_hashes, seen_ids = {}, {}
+    ligand_files = sorted(ligand_files)
+    for path, summary in zip(ligand_files, inspect_ligands(ligand_files, workers)):
+        if summary['errors']:
+            invalid.append((path, summary['errors']))
+        elif summary['content_hash'] in seen_hashes:
+            duplicates.append((path, seen_hashes[summary['content_hash']]))
+        elif path.stem in seen_ids:
+            # ligand_id is the file name, it has to be unique within the task
+            invalid.append((path, [f"duplicate ligand ID of {seen_ids[path.stem].name}"]))
+        else:
+            seen_hashes[summary['content_hash']] = path
+            seen_ids[path.stem] = path
+            valid.append((path, summary))
+    return valid, invalid, duplicates
+
+def write_validation_report(task_dir, invalid, duplicates):
+    """Move rejected ligands to the task's quarantine directory and list why"""
+    quarantine_dir = task_dir / 'quarantine'
+    quarantine_dir.mkdir(exist_ok=True)
+    with open(task_dir / 'validation_report.txt', 'w') as report:
+        for path, errors in invalid:
+            shutil.move(str(path), str(quarantine_dir / path.name))
+            report.write(f"{path.name}\tinvalid\t{'; '.join(errors)}\n")
+        for path, kept in duplicates:
+            report.write(f"{path.name}\tduplicate\t{kept.name}\n")
+
+def create_task(zip_path, name, owner='default', priority=1, deadline=None, reject_invalid=False, workers=None):
     if not os.path.exists(zip_path):
         print(f"Error: File {zip_path} not found")
         return
@@ -116,6 +272,25 @@ def create_task(zip_path, name):
             print("Error: ZIP file is missing required files (receptor.pdbqt, parameter.txt, ligands/ligand_*.pdbqt)")
             return
         
+        # Validate before anything is written, so a bad upload leaves no task behind
+        try:
+            params = parse_parameters(parameter_file)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        
+        valid, invalid, duplicates = validate_ligands(ligand_files, workers)
+        for path, errors in invalid[:10]:
+            print(f"Invalid ligand {path.name}: {'; '.join(errors)}")
+        if len(invalid) > 10:
+            print(f"... and {len(invalid) - 10} more invalid ligands")
+        if invalid and reject_invalid:
+            print(f"Error: {len(invalid)} invalid ligands, task not created")
+            return
+        if not valid:
+            print("Error: No valid ligands")
+            return
+        
         # Move files to task directory
         task_dir = Path('tasks') / name
         task_dir.mkdir(parents=True, exist_ok=True)
@@ -134,28 +309,24 @@ def create_task(zip_path, name):
         conn = get_db_connection()
         c = conn.cursor()
         
-        # Parse parameter file
-        params = {}
-        with open(parameter_dest, 'r') as f:
-            for line in f:
-                if '=' in line:
-                    key, value = line.strip().split('=')
-                    params[key.strip()] = value.strip()
-        
         # Insert main task record
         execute_update('''
             INSERT INTO tasks (
                 id, status,
                 center_x, center_y, center_z,
                 size_x, size_y, size_z,
-                num_modes, energy_range, cpu
+                num_modes, energy_range, cpu, exhaustiveness,
+                owner, priority, deadline,
+                receptor_hash, receptor_size
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             name, 'pending',
-            float(params.get('center_x', 0)), float(params.get('center_y', 0)), float(params.get('center_z', 0)),
-            float(params.get('size_x', 0)), float(params.get('size_y', 0)), float(params.get('size_z', 0)),
-            int(params.get('num_modes', 9)), float(params.get('energy_range', 3)), int(params.get('cpu', 1))
+            params['center_x'], params['center_y'], params['center_z'],
+            params['size_x'], params['size_y'], params['size_z'],
+            params['num_modes'], params['energy_range'], params['cpu'], params['exhaustiveness'],
+            owner, priority, deadline,
+            hash_file(receptor_dest), receptor_dest.stat().st_size
         ))
         
         # Create task-specific ligand table
@@ -164,35 +335,43 @@ def create_task(zip_path, name):
                 ligand_id VARCHAR(255) PRIMARY KEY,
                 ligand_file VARCHAR(255),
                 status VARCHAR(50) DEFAULT 'pending',
+                retry_count INT DEFAULT 0,
+                cost FLOAT DEFAULT 1,
+                affinity FLOAT NULL,
                 output_file VARCHAR(255),
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        
-        # Add ligand records
-        for ligand_file in ligand_files:
-            # Use file name (without extension) as ligand_id
-            ligand_id = ligand_file.stem
-            ligand_dest = ligands_dir / ligand_file.name
-            ligand_file.rename(ligand_dest)
-            
-            execute_update(f'''
-                INSERT INTO task_{name}_ligands (ligand_id, ligand_file)
-                VALUES (?, ?)
-            ''', (ligand_id, ligand_file.name))
+        execute_update(f'CREATE INDEX idx_{name}_status_cost ON task_{name}_ligands (status, cost)')
+        
+        # Add ligand records in one transaction
+        rows = []
+        for ligand_file, summary in valid:
+            ligand_file.rename(ligands_dir / ligand_file.name)
+            # Use file name (without extension) as ligand_id; the cost from torsions
+            # and heavy atoms orders dispatch
+            rows.append((ligand_file.stem, ligand_file.name, estimate_cost(summary)))
+        execute_many(f'''
+            INSERT INTO task_{name}_ligands (ligand_id, ligand_file, cost)
+            VALUES (%s, %s, %s)
+        ''', rows)
+        if invalid or duplicates:
+            write_validation_report(task_dir, invalid, duplicates)
         
         conn.commit()
         conn.close()
         
-        print(f"Task {name} created successfully")
+        print(f"Task {name} created successfully: {len(valid)} ligands"
+              + (f", {len(invalid)} invalid quarantined" if invalid else "")
+              + (f", {len(duplicates)} duplicates skipped" if duplicates else "")
+              + (f" (see {task_dir / 'validation_report.txt'})" if invalid or duplicates else ""))
         
     except Exception as e:
         print(f"Error: {str(e)}")
     finally:
         # Clean up temporary directory
         if temp_dir.exists():
-            import shutil
             shutil.rmtree(temp_dir)
 
 def remove_task(task_id):
@@ -243,6 +422,22 @@ def pause_task(task_id):
     except Exception as e:
         print(f"Error updating task status: {str(e)}")
 
+def set_task_priority(task_id, priority):
+    try:
+        if not execute_query('SELECT id FROM tasks WHERE id = ?', (task_id,), fetch_one=True):
+            print(f"Error: Task {task_id} not found")
+            return
+        
+        if priority <= 0:
+            print("Error: Priority must be greater than 0")
+            return
+        
+        execute_update('UPDATE tasks SET priority = ? WHERE id = ?', (priority, task_id))
+        print(f"Task {task_id} priority set to {priority}")
+        
+    except Exception as e:
+        print(f"Error updating task priority: {str(e)}")
+
 def set_server_password(password):
     try:
         # Generate password hash
@@ -344,12 +539,21 @@ def main():
     parser.add_argument('-ls', action='store_true', help='List all tasks')
     parser.add_argument('-zip', help='Path to the task ZIP file to submit')
     parser.add_argument('-name', help='Task name')
+    parser.add_argument('-owner', default='default', help='Task owner, used for fair-share scheduling between users')
+    parser.add_argument('-priority', type=float, default=1, help='Task priority (relative share, default 1)')
+    parser.add_argument('-deadline', help='Task deadline, e.g. "2025-01-31 18:00"')
+    parser.add_argument('-reject-invalid', action='store_true',
+                        help='Do not create the task if any ligand is invalid (default: quarantine invalid ligands)')
+    parser.add_argument('-validate-workers', type=int, help='Processes used to validate ligands (default: all CPUs)')
+    parser.add_argument('-set-priority', nargs=2, metavar=('TASK_ID', 'PRIORITY'), help='Change the priority of a task')
     parser.add_argument('-rm', help='Delete specified task')
     parser.add_argument('-pause', help='Pause/Resume specified task')
     parser.add_argument('-set-password', help='Set server password')
     parser.add_argument('-reset-heartbeats', action='store_true', help='Reset node heartbeats table')
     parser.add_argument('-reset-processing', action='store_true', help='Reset all processing tasks to pending status')
     parser.add_argument('-reset-failed', action='store_true', help='Reset all failed tasks to pending status')
+    parser.add_argument('-trace-report', nargs='?', const='all', metavar='TASK_ID',
+                        help='Show where compute node time goes (dispatch, download, vina, upload, ack), optionally for one task')
     
     args = parser.parse_args()
     
@@ -360,11 +564,27 @@ def main():
     if args.ls:
         list_tasks()
     elif args.zip and args.name:
-        create_task(args.zip, args.name)
+        deadline = None
+        if args.deadline:
+            try:
+                deadline = datetime.fromisoformat(args.deadline).strftime('%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                print(f"Error: Invalid deadline '{args.deadline}', expected YYYY-MM-DD HH:MM")
+                return
+        if args.priority <= 0:
+            print("Error: Priority must be greater than 0")
+            return
+        create_task(args.zip, args.name, args.owner, args.priority, deadline,
+                    reject_invalid=args.reject_invalid, workers=args.validate_workers)
     elif args.rm:
         remove_task(args.rm)
     elif args.pause:
         pause_task(args.pause)
+    elif args.set_priority:
+        try:
+            set_task_priority(args.set_priority[0], float(args.set_priority[1]))
+        except ValueError:
+            print(f"Error: Invalid priority '{args.set_priority[1]}'")
     elif args.set_password:
         set_server_password(args.set_password)
     elif args.reset_heartbeats:
@@ -373,6 +593,8 @@ def main():
         reset_processing_tasks()
     elif args.reset_failed:
         reset_failed_tasks()
+    elif args.trace_report:
+        trace_report(None if args.trace_report == 'all' else args.trace_report)
     else:
         parser.print_help()
 
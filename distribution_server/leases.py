@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import math
+import time
+import threading
+
+class Lease:
+    """一个已分配给节点、尚未返回结果的配体"""
+    def __init__(self, node_id, task_id, ligand_id, cost, leased_at, speculative=False):
+        self.node_id = node_id
+        self.task_id = task_id
+        self.ligand_id = ligand_id
+        self.cost = cost
+        self.leased_at = leased_at
+        # 最近一次续租时间，超时按它计算；leased_at 仍用于吞吐量统计和推测执行
+        self.renewed_at = leased_at
+        self.speculative = speculative
+
+class NodeStats:
+    """单个节点的吞吐量统计（指数加权移动平均）"""
+    def __init__(self):
+        self.seconds_per_cost = None
+        self.seconds_per_ligand = None
+        self.completed = 0
+        self.last_result_at = None
+        self.last_seen = time.time()
+
+class LeaseTracker:
+    """跟踪未完成的配体租约，并根据节点实测吞吐量计算每次分配的成本预算
+
+    节点每完成一个配体就更新其单位成本耗时，使每个节点持有约 target_seconds 的工作量。
+    任务尾部同一配体可以同时租给多个节点（推测执行），最先返回的结果生效。
+    """
+    def __init__(self, target_seconds=120, smoothing=0.2, active_window=600):
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing
+        self.active_window = active_window
+        self.lock = threading.Lock()
+        self.leases = {}  # (task_id, ligand_id) -> [Lease]，推测执行时有多个
+        self.nodes = {}  # node_id -> NodeStats
+
+    def lease(self, node_id, task_id, ligands, speculative=False, now=None):
+        """记录一次分配，ligands 为包含 ligand_id 和 cost 的字典列表"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.nodes.setdefault(node_id, NodeStats()).last_seen = now
+            for ligand in ligands:
+                key = (task_id, ligand['ligand_id'])
+                holders = [lease for lease in self.leases.get(key, []) if lease.node_id != node_id]
+                holders.append(Lease(node_id, task_id, ligand['ligand_id'], ligand.get('cost') or 1, now, speculative))
+                self.leases[key] = holders
+
+    def complete(self, task_id, ligand_id, node_id, success=True, now=None):
+        """结束节点的租约，成功时用本次耗时更新节点吞吐量
+
+        成功时同一配体的其它租约一并结束并返回，以便通知这些节点取消计算；
+        失败时返回仍持有该配体的其它租约。
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            key = (task_id, ligand_id)
+            holders = self.leases.pop(key, [])
+            lease = next((holder for holder in holders if holder.node_id == node_id), None)
+            others = [holder for holder in holders if holder is not lease]
+            if not success and others:
+                self.leases[key] = others
+
+            stats = self.nodes.setdefault(node_id, NodeStats())
+            stats.last_seen = now
+            if lease is not None and success:
+                # 批内配体依次计算，耗时从租约开始或上一个结果返回时算起
+                start = max(lease.leased_at, stats.last_result_at or lease.leased_at)
+                elapsed = max(now - start, 0.001)
+                stats.seconds_per_cost = self._smooth(stats.seconds_per_cost, elapsed / lease.cost)
+                stats.seconds_per_ligand = self._smooth(stats.seconds_per_ligand, elapsed)
+                stats.completed += 1
+            stats.last_result_at = now
+            return others
+
+    def speculation_candidate(self, node_id, min_elapsed, max_copies, is_valid=None, now=None):
+        """选择运行时间最长、已超过 min_elapsed 秒且副本数未满的配体，供空闲节点重复计算"""
+        now = time.time() if now is None else now
+        with self.lock:
+            best = None
+            for (task_id, ligand_id), holders in self.leases.items():
+                if len(holders) >= max_copies or any(holder.node_id == node_id for holder in holders):
+                    continue
+                started = min(holder.leased_at for holder in holders)
+                if now - started < min_elapsed:
+                    continue
+                if best is None or started < best[0]:
+                    if is_valid is None or is_valid(task_id):
+                        best = (started, holders[0])
+            return best[1] if best else None
+
+    def release(self, task_id, ligand_id, node_id):
+        """节点主动退回配体时结束其租约，返回仍持有该配体的其它租约"""
+        with self.lock:
+            key = (task_id, ligand_id)
+            others = [holder for holder in self.leases.pop(key, []) if holder.node_id != node_id]
+            if others:
+                self.leases[key] = others
+            return others
+
+    def renew(self, task_id, ligand_ids, node_id, now=None):
+        """节点续租仍在排队或计算的配体"""
+        now = time.time() if now is None else now
+        with self.lock:
+            for ligand_id in ligand_ids:
+                for lease in self.leases.get((task_id, ligand_id), ()):
+                    if lease.node_id == node_id:
+                        lease.renewed_at = now
+
+    def release_task(self, task_id):
+        """丢弃任务的全部租约（任务被暂停或删除），返回被丢弃的租约"""
+        with self.lock:
+            released = []
+            for key in [key for key in self.leases if key[0] == task_id]:
+                released.extend(self.leases.pop(key))
+            return released
+
+    def cost_budget(self, node_id):
+        """该节点在 target_seconds 内能完成的成本量，尚无统计时返回 None"""
+        with self.lock:
+            stats = self.nodes.get(node_id)
+            if stats is None or not stats.seconds_per_cost:
+                return None
+            return self.target_seconds / stats.seconds_per_cost
+
+    def fair_batch_limit(self, pending, now=None):
+        """任务接近结束时按活跃节点数平分剩余配体，避免少数节点拿走最后的工作"""
+        now = time.time() if now is None else now
+        with self.lock:
+            active = sum(1 for stats in self.nodes.values() if now - stats.last_seen <= self.active_window)
+        return max(1, math.ceil(pending / max(active, 1)))
+
+    def outstanding(self):
+        with self.lock:
+            return sum(len(holders) for holders in self.leases.values())
+
+    def expire(self, max_age, now=None):
+        """丢弃超过 max_age 秒未续租也未返回的租约（服务器已将其重置为待处理）"""
+        now = time.time() if now is None else now
+        with self.lock:
+            for key, holders in list(self.leases.items()):
+                holders = [lease for lease in holders if now - lease.renewed_at <= max_age]
+                if holders:
+                    self.leases[key] = holders
+                else:
+                    del self.leases[key]
+
+    def get_node_stats(self):
+        """返回各节点的吞吐量统计"""
+        with self.lock:
+            return {
+                node_id: {
+                    'seconds_per_cost': stats.seconds_per_cost,
+                    'seconds_per_ligand': stats.seconds_per_ligand,
+                    'completed': stats.completed
+                }
+                for node_id, stats in self.nodes.items()
+            }
+
+    def _smooth(self, previous, value):
+        if previous is None:
+            return value
+        return previous + self.smoothing * (value - previous)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# Relative cost of one rotatable bond compared to one heavy atom.
+# Vina search time grows much faster with torsions than with atom count.
+TORSION_COST_WEIGHT = 10
+
+HYDROGEN_TYPES = {'H', 'HD', 'HS'}
+
+# AutoDock 4 atom types accepted by Vina, including the macrocycle closure
+# (G0-G3, CG0-CG3) and hydrated docking (W) pseudo atoms of Vina 1.2
+ATOM_TYPES = HYDROGEN_TYPES | {
+    'C', 'A', 'N', 'NA', 'NS', 'O', 'OA', 'OS', 'S', 'SA', 'P', 'F', 'Cl', 'CL', 'Br', 'BR', 'I',
+    'Si', 'B', 'Se', 'Mg', 'MG', 'Ca', 'CA', 'Mn', 'MN', 'Fe', 'FE', 'Zn', 'ZN', 'Met',
+    'G', 'G0', 'G1', 'G2', 'G3', 'CG0', 'CG1', 'CG2', 'CG3', 'W'
+}
+
+def inspect_pdbqt(path):
+    """Check a ligand PDBQT file in one pass and summarize it
+
+    Returns a dict with heavy_atoms and torsdof for estimate_cost, the
+    content_hash of the molecule (REMARK lines, such as the ligand name, are
+    ignored, so identical molecules in differently named files hash alike)
+    and errors, a list of reasons Vina would reject the file.
+    """
+    heavy_atoms = 0
+    atoms = 0
+    torsdof = None
+    roots = 0
+    endroots = 0
+    branches = []
+    errors = []
+    sha256 = hashlib.sha256()
+
+    def error(number, message):
+        # The first few are enough to tell what is wrong with a file
+        if len(errors) < 5:
+            errors.append(f"line {number}: {message}")
+
+    try:
+        f = open(path, 'r', errors='replace')
+    except OSError as e:
+        return {'heavy_atoms': 0, 'torsdof': 0, 'content_hash': None, 'errors': [f"unreadable: {e}"]}
+    with f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip()
+            if not line or line.startswith('REMARK'):
+                continue
+            sha256.update(line.encode() + b'\n')
+            # Serial numbers above 9999 run into HETATM, match the prefix
+            record = 'ATOM' if line.startswith(('ATOM', 'HETATM')) else line.split(None, 1)[0]
+
+            if record == 'ATOM':
+                atoms += 1
+                if roots == 0 or (endroots == 1 and not branches):
+                    error(number, "atom outside ROOT and BRANCH blocks")
+                fields = line.split()
+                atom_type = fields[-1] if fields else ''
+                if atom_type not in ATOM_TYPES:
+                    error(number, f"unknown atom type '{atom_type}'")
+                elif atom_type not in HYDROGEN_TYPES:
+                    heavy_atoms += 1
+                try:
+                    float(line[30:38]), float(line[38:46]), float(line[46:54])
+                except ValueError:
+                    error(number, "invalid coordinates")
+            elif record == 'ROOT':
+                roots += 1
+                if roots > 1:
+                    error(number, "more than one ROOT")
+            elif record == 'ENDROOT':
+                endroots += 1
+                if endroots > roots:
+                    error(number, "ENDROOT without ROOT")
+            elif record == 'BRANCH':
+                if endroots == 0:
+                    error(number, "BRANCH before ENDROOT")
+                branches.append(line.split()[1:3])
+            elif record == 'ENDBRANCH':
+                if not branches:
+                    error(number, "ENDBRANCH without BRANCH")
+                elif branches.pop() != line.split()[1:3]:
+                    error(number, "ENDBRANCH does not match the open BRANCH")
+            elif record == 'TORSDOF':
+                try:
+                    torsdof = int(line.split()[1])
+                except (IndexError, ValueError):
+                    error(number, "invalid TORSDOF")
+            elif record == 'MODEL' and atoms:
+                error(number, "more than one model")
+
+    if atoms == 0:
+        errors.append("no atoms")
+    if roots != 1 or endroots != 1:
+        errors.append(f"{roots} ROOT and {endroots} ENDROOT records, expected one of each")
+    if branches:
+        errors.append(f"{len(branches)} BRANCH blocks not closed")
+    if torsdof is None:
+        errors.append("missing TORSDOF")
+    return {
+        'heavy_atoms': heavy_atoms,
+        'torsdof': torsdof or 0,
+        'content_hash': sha256.hexdigest(),
+        'errors': errors
+    }
+
+def inspect_ligands(paths, workers=None):
+    """inspect_pdbqt for many files, spread over worker processes
+
+    Results are returned in the order of paths. Parsing is CPU bound, so
+    processes rather than threads; small imports are checked in-process.
+    """
+    paths = [str(path) for path in paths]
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(paths) < 256:
+        return [inspect_pdbqt(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(inspect_pdbqt, paths, chunksize=max(1, len(paths) // (workers * 8))))
+
+def hash_file(path):
+    """SHA-256 of a file's bytes, used by compute nodes to cache receptors across tasks"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def estimate_cost(summary):
+    """Cheap docking cost estimate in arbitrary units, used for ordering and batching"""
+    return summary['heavy_atoms'] + TORSION_COST_WEIGHT * summary['torsdof']
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import itertools
+import threading
+from datetime import datetime
+
+# 从任务表同步到调度器的参数字段
+TASK_PARAM_FIELDS = (
+    'center_x', 'center_y', 'center_z',
+    'size_x', 'size_y', 'size_z',
+    'num_modes', 'energy_range', 'cpu', 'exhaustiveness'
+)
+
+def to_timestamp(value):
+    """将数据库中的时间字段转换为时间戳"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(str(value)).timestamp()
+
+class TaskEntry:
+    """调度器中的单个任务"""
+    def __init__(self, task_id, owner, priority, deadline, params, receptor_hash=None):
+        self.task_id = task_id
+        self.receptor_hash = receptor_hash
+        self.receptor_size = 0
+        self.pending = 0
+        self.total = 0
+        self.owner = owner
+        self.priority = priority
+        self.deadline = deadline
+        self.params = params
+        self.active = False
+        self.heap_seq = None  # 堆中有效条目的序号，其余同 ID 条目均已失效
+        self.pass_value = 0.0
+        self.debt = 0.0  # 尚未计入 pass_value 的调度量，下次出堆时结算
+        self.dispatched = 0
+
+class UserEntry:
+    """同一用户的任务集合"""
+    def __init__(self, owner, weight):
+        self.owner = owner
+        self.weight = weight
+        self.heap_seq = None
+        self.pass_value = 0.0
+        self.debt = 0.0
+        self.task_heap = []
+
+class TaskScheduler:
+    """按优先级和用户份额加权公平地选择下一个分发的任务
+
+    两级步幅调度（stride scheduling）：先在用户之间按份额选择，
+    再在该用户的任务之间按优先级选择。每次选择 O(log n)。
+    截止时间临近的任务可以占用 deadline_share 比例的分发机会（EDF）。
+    节点已缓存受体的任务只要落后公平进度不超过 affinity_slack 即可优先分发。
+    """
+    def __init__(self, user_shares=None, deadline_horizon=3600, deadline_share=0.5, affinity_slack=50):
+        self.user_shares = user_shares or {}
+        self.deadline_horizon = deadline_horizon
+        self.deadline_share = deadline_share
+        self.affinity_slack = affinity_slack
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.users = {}
+        self.user_heap = []
+        self.deadline_heap = []
+        self.receptor_index = {}  # receptor_hash -> set(task_id)
+        self._deadline_credit = 0.0
+        self._seq = itertools.count()
+
+    def sync(self, rows, now=None):
+        """用数据库中的任务行刷新调度状态
+
+        rows 中每一项包含 id、status、owner、priority、deadline、pending 以及任务参数。
+        返回不再出现在 rows 中、已从调度器移除的任务 ID 列表。
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            seen = set()
+            for row in rows:
+                task_id = row['id']
+                seen.add(task_id)
+                owner = row.get('owner') or 'default'
+                priority = max(float(row.get('priority') or 1), 0.01)
+                deadline = to_timestamp(row.get('deadline'))
+                params = {field: row[field] for field in TASK_PARAM_FIELDS if field in row}
+                receptor_hash = row.get('receptor_hash')
+
+                entry = self.tasks.get(task_id)
+                if entry is None or entry.owner != owner:
+                    if entry is not None:
+                        entry.active = False
+                        self._unindex(entry)
+                    entry = TaskEntry(task_id, owner, priority, deadline, params, receptor_hash)
+                    self.tasks[task_id] = entry
+                    self._index(entry)
+                else:
+                    entry.priority = priority
+                    entry.params = params
+                    if entry.receptor_hash != receptor_hash:
+                        self._unindex(entry)
+                        entry.receptor_hash = receptor_hash
+                        self._index(entry)
+                    if entry.deadline != deadline:
+                        entry.deadline = deadline
+                        if entry.active and deadline is not None:
+                            heapq.heappush(self.deadline_heap, (deadline, next(self._seq), task_id))
+                entry.receptor_size = row.get('receptor_size') or 0
+                entry.pending = row.get('pending') or 0
+                entry.total = row.get('total') or entry.pending
+
+                runnable = row.get('status') in ('pending', 'processing') and (row.get('pending') or 0) > 0
+                if runnable and not entry.active:
+                    self._activate(entry)
+                elif not runnable:
+                    entry.active = False
+
+            removed = []
+            for task_id in list(self.tasks):
+                if task_id not in seen:
+                    entry = self.tasks.pop(task_id)
+                    entry.active = False
+                    self._unindex(entry)
+                    removed.append(task_id)
+            return removed
+
+    def select(self, now=None, receptor_hashes=None):
+        """选择下一个分发的任务并计入一次调度，没有可运行任务时返回 None
+
+        receptor_hashes 为请求节点已缓存的受体哈希，用于优先分发无需下载受体的任务。
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self._select_urgent(now)
+            if entry is None and receptor_hashes:
+                entry = self._select_affine(receptor_hashes)
+            if entry is None:
+                entry = self._select_fair()
+            if entry is None:
+                return None
+            entry.dispatched += 1
+            return entry.task_id
+
+    def charge(self, task_id, units):
+        """追加计入调度量（例如一次分发了多个配体）"""
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None or units <= 0:
+                return
+            entry.debt += units / entry.priority
+            user = self.users.get(entry.owner)
+            if user is not None:
+                user.debt += units / user.weight
+
+    def deactivate(self, task_id):
+        """任务暂时没有待处理的配体，停止调度直到下次同步"""
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is not None:
+                entry.active = False
+
+    def consume(self, task_id, count):
+        """分发配体后减少待处理数量，下次同步时以数据库为准"""
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is not None:
+                entry.pending = max(entry.pending - count, 0)
+
+    def restore(self, task_id, count):
+        """节点退回未计算的配体后增加待处理数量，已停用的任务重新参与调度"""
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None or count <= 0:
+                return
+            entry.pending += count
+            if not entry.active:
+                self._activate(entry)
+
+    def get_progress(self, task_id):
+        """返回任务的 (待处理配体数, 配体总数)"""
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            return (entry.pending, entry.total) if entry else (0, 0)
+
+    def pending_ligands(self):
+        """返回所有可调度任务的待处理配体总数"""
+        with self.lock:
+            return sum(entry.pending for entry in self.tasks.values() if entry.active)
+
+    def get_params(self, task_id):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            return dict(entry.params) if entry else None
+
+    def get_receptor(self, task_id):
+        """返回任务受体的 (哈希, 字节数)"""
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            return (entry.receptor_hash, entry.receptor_size) if entry else (None, 0)
+
+    def get_shares(self):
+        """返回每个任务累计获得的分发次数"""
+        with self.lock:
+            return {task_id: entry.dispatched for task_id, entry in self.tasks.items()}
+
+    def _activate(self, entry):
+        entry.active = True
+        user = self.users.get(entry.owner)
+        if user is None:
+            user = UserEntry(entry.owner, max(float(self.user_shares.get(entry.owner, 1)), 0.01))
+            self.users[entry.owner] = user
+
+        # 新加入的任务和用户从当前虚拟时间开始，避免空闲期积累的份额一次性用完
+        if user.heap_seq is None:
+            user.pass_value = max(user.pass_value, self._global_pass())
+            self._push_user(user)
+        if entry.heap_seq is None:
+            entry.pass_value = max(entry.pass_value, user.task_heap[0][0] if user.task_heap else 0.0)
+            self._push_task(user, entry)
+        if entry.deadline is not None:
+            heapq.heappush(self.deadline_heap, (entry.deadline, next(self._seq), entry.task_id))
+
+    def _index(self, entry):
+        if entry.receptor_hash:
+            self.receptor_index.setdefault(entry.receptor_hash, set()).add(entry.task_id)
+
+    def _unindex(self, entry):
+        task_ids = self.receptor_index.get(entry.receptor_hash)
+        if task_ids is not None:
+            task_ids.discard(entry.task_id)
+            if not task_ids:
+                del self.receptor_index[entry.receptor_hash]
+
+    def _push_user(self, user):
+        user.heap_seq = next(self._seq)
+        heapq.heappush(self.user_heap, (user.pass_value, user.heap_seq, user.owner))
+
+    def _push_task(self, user, entry):
+        entry.heap_seq = next(self._seq)
+        heapq.heappush(user.task_heap, (entry.pass_value, entry.heap_seq, entry.task_id))
+
+    def _global_pass(self):
+        return self.user_heap[0][0] if self.user_heap else 0.0
+
+    def _select_urgent(self, now):
+        """截止时间在 deadline_horizon 内的任务按最早截止时间优先，受 deadline_share 限制"""
+        self._deadline_credit = min(self._deadline_credit + self.deadline_share, 1.0)
+        while self.deadline_heap:
+            deadline, _, task_id = self.deadline_heap[0]
+            entry = self.tasks.get(task_id)
+            if entry is None or not entry.active or entry.deadline != deadline:
+                heapq.heappop(self.deadline_heap)
+                continue
+            if deadline - now > self.deadline_horizon or self._deadline_credit < 1.0:
+                return None
+            self._deadline_credit -= 1.0
+            entry.debt += 1.0 / entry.priority
+            self.users[entry.owner].debt += 1.0 / self.users[entry.owner].weight
+            return entry
+        return None
+
+    def _select_affine(self, receptor_hashes):
+        """在节点已缓存受体的任务中选择 pass 值最小且未超出公平范围的任务"""
+        best = None
+        global_pass = self._global_pass()
+        for receptor_hash in receptor_hashes:
+            for task_id in self.receptor_index.get(receptor_hash, ()):
+                entry = self.tasks[task_id]
+                user = self.users.get(entry.owner)
+                if not entry.active or user is None or user.heap_seq is None:
+                    continue
+                # 用户和任务的虚拟时间都不能领先太多，否则让位给公平调度
+                user_pass = user.pass_value + user.debt
+                task_pass = entry.pass_value + entry.debt
+                task_floor = user.task_heap[0][0] if user.task_heap else task_pass
+                if user_pass - global_pass > self.affinity_slack or task_pass - task_floor > self.affinity_slack:
+                    continue
+                if best is None or task_pass < best[0]:
+                    best = (task_pass, entry, user)
+        if best is None:
+            return None
+
+        _, entry, user = best
+        entry.debt += 1.0 / entry.priority
+        user.debt += 1.0 / user.weight
+        return entry
+
+    def _select_fair(self):
+        while self.user_heap:
+            _, seq, owner = heapq.heappop(self.user_heap)
+            user = self.users[owner]
+            if seq != user.heap_seq:
+                continue
+            if user.debt:
+                # 结算之前的追加调度量后重新排序
+                user.pass_value += user.debt
+                user.debt = 0.0
+                self._push_user(user)
+                continue
+
+            entry = self._pop_task(user)
+            if entry is None:
+                user.heap_seq = None
+                continue
+
+            entry.pass_value += 1.0 / entry.priority
+            self._push_task(user, entry)
+            user.pass_value += 1.0 / user.weight
+            self._push_user(user)
+            return entry
+        return None
+
+    def _pop_task(self, user):
+        """弹出该用户 pass 值最小的活动任务，同时清理失效条目"""
+        while user.task_heap:
+            _, seq, task_id = heapq.heappop(user.task_heap)
+            entry = self.tasks.get(task_id)
+            if entry is None or entry.owner != user.owner or seq != entry.heap_seq:
+                continue
+            if not entry.active:
+                entry.heap_seq = None
+                continue
+            if entry.debt:
+                entry.pass_value += entry.debt
+                entry.debt = 0.0
+                self._push_task(user, entry)
+                continue
+            entry.heap_seq = None
+            return entry
+        return None
+
+class AffinityStats:
+    """受体缓存命中统计，用于衡量节省的带宽
+
+    只统计节点换到另一个任务的租约：同一任务的后续租约无论是否按缓存调度都不会重新下载受体。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def record(self, hit, receptor_size=0):
+        with self.lock:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += receptor_size or 0
+            else:
+                self.misses += 1
+
+    def snapshot(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'bytes_saved': self.bytes_saved
+            }
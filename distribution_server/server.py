@@ -2,28 +2,78 @@
 
 import os
 import sys
+import hmac
 import json
 import socket
+import hashlib
+import secrets
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, send_file
 from werkzeug.utils import secure_filename
 
 sys.path.append('..')
-from utils.db import init_connection_pool, init_database, execute_query, execute_update, get_db_connection
+from utils.db import init_connection_pool, init_database, execute_query, execute_update, get_db_connection, migrate_ligand_table, DBWriter, consume_db_time
 from utils.logger import logger
-from utils.network import SSLContextManager, SecureSocket
+from utils.metrics import REGISTRY, Counter, Gauge, Histogram
+from utils.network import SSLContextManager, SecureSocket, MAX_FRAME_SIZE
 from config import SERVER_CONFIG, TASK_CONFIG, DB_CONFIG, DEBUG
+from scheduler import TaskScheduler, AffinityStats
+from leases import LeaseTracker
+from pdbqt import hash_file
 
 app = Flask(__name__)
 
-# 任务超时时间（秒）
-TASK_TIMEOUT = 300
+# 租约超时时间（秒）：处理中的配体超过该时长未续租或返回结果即重置为待处理
+TASK_TIMEOUT = TASK_CONFIG.get('lease_timeout', 300)
 
 # 数据库连接状态
 db_initialized = False
 
+# 受体缓存命中统计
+affinity_stats = AffinityStats()
+
+# TCP 命令服务器实例，由主程序创建
+tcp_server = None
+
+# 计算节点上报的配体生命周期时间戳（ligand_traces 表的列）
+TRACE_FIELDS = (
+    'requested_at', 'leased_at',
+    'download_start', 'download_end',
+    'vina_start', 'vina_end',
+    'upload_start', 'upload_end',
+    'acked_at'
+)
+# 计算节点上传的受体网格图归档，保存在任务目录中供其他节点下载
+GRID_MAPS_ARCHIVE = 'maps.tar.gz'
+
+# 计算节点上传的结果文件名为 <ligand_id>_out.pdbqt
+RESULT_SUFFIX = '_out.pdbqt'
+
+# 单条消息最多接受的跟踪记录数
+MAX_TRACES_PER_MESSAGE = 1000
+
+# 命令处理热路径的日志，级别由 LOG_CONFIG['components']['dispatch'] 单独配置
+dispatch_logger = logger.get_component('dispatch')
+
+# 运行指标，通过 /metrics 以 Prometheus 文本格式导出
+COMMAND_SECONDS = Histogram('vortexdock_command_seconds', 'Time to handle a node command, including the response', ('command',))
+COMMAND_DB_SECONDS = Histogram('vortexdock_command_db_seconds', 'Database time spent handling a node command', ('command',))
+COMMAND_ERRORS = Counter('vortexdock_command_errors_total', 'Node commands answered with an error', ('command',))
+TLS_HANDSHAKE_SECONDS = Histogram('vortexdock_tls_handshake_seconds', 'Server-side TLS handshake time')
+ACTIVE_CONNECTIONS = Gauge('vortexdock_active_connections', 'Authenticated node connections')
+REAPER_SECONDS = Histogram('vortexdock_reaper_sweep_seconds', 'Duration of a timeout reaper sweep')
+SCHEDULER_SYNC_SECONDS = Histogram('vortexdock_scheduler_sync_seconds', 'Duration of a scheduler sync from the database')
+RECEPTOR_CACHE = Gauge('vortexdock_receptor_cache', 'Receptor cache affinity statistics', ('stat',))
+EXECUTOR_QUEUE_DEPTH = Gauge('vortexdock_executor_queue_depth', 'Pipelined commands waiting for a worker thread')
+# 以下两项在抓取指标时由 TCPServer 实例计算
+LEASES_OUTSTANDING = Gauge('vortexdock_leases_outstanding', 'Ligand leases awaiting a result')
+RUNNABLE_TASKS = Gauge('vortexdock_runnable_tasks', 'Tasks with pending ligands in the scheduler')
+for stat in ('hits', 'misses', 'bytes_saved'):
+    RECEPTOR_CACHE.labels(stat).set_function(lambda stat=stat: affinity_stats.snapshot()[stat])
+
 def init_db():
     """Initialize the database connection pool and table structure"""
     global db_initialized
@@ -40,9 +90,15 @@ def init_db():
             logger.error(f"Failed to initialize database: {e}")
             raise
 
+def log_write_error(future):
+    """不等待结果的批量写入出错时记录日志"""
+    if future.exception() is not None:
+        logger.error(f"Deferred database write failed: {future.exception()}")
+
 # 检查并重置超时任务
 def check_timeout_tasks():
     while True:
+        sweep_start = time.perf_counter()
         try:
             timeout_time = datetime.now() - timedelta(seconds=TASK_TIMEOUT)
             
@@ -109,6 +165,8 @@ def check_timeout_tasks():
 
         except Exception as e:
             logger.error(f"Error checking timeout tasks: {e}")
+        finally:
+            REAPER_SECONDS.observe(time.perf_counter() - sweep_start)
         
         time.sleep(60)
 
@@ -120,20 +178,113 @@ def download_file(task_id, filename):
         file_path = os.path.join('tasks', str(task_id), filename)
         if os.path.exists(file_path):
             return send_file(file_path)
+    elif filename == GRID_MAPS_ARCHIVE:
+        file_path = os.path.join('tasks', str(task_id), filename)
+        if os.path.exists(file_path):
+            return send_file(file_path)
     elif filename.endswith('.pdbqt'):
         file_path = os.path.join('tasks', str(task_id), 'ligands', filename)
         if os.path.exists(file_path):
             return send_file(file_path)
     return {'error': '文件不存在或不支持下载该类型的文件'}, 404
 
+@app.route('/stats/affinity')
+def get_affinity_stats():
+    return json.dumps(affinity_stats.snapshot())
+
+@app.route('/stats/nodes')
+def get_node_stats():
+    return json.dumps(tcp_server.leases.get_node_stats() if tcp_server else {})
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/upload/result/<task_id>/<filename>', methods=['POST'])
 def upload_result_file(task_id, filename):
+    # 任务名可以是任意字符串，在任务表中确认存在后才拼入配体表名
+    task = execute_query('SELECT id FROM tasks WHERE id = %s', (task_id,), fetch_one=True)
+    if not task or not os.path.isdir(os.path.join('tasks', str(task_id))):
+        # 任务已被删除，不再为其创建结果目录
+        return json.dumps({'status': 'cancelled'}), 410
+    task_id = task['id']
+    # 旧版节点不上传 ligand_id，从结果文件名 <ligand_id>_out.pdbqt 得出
+    ligand_id = request.form.get('ligand_id')
+    if ligand_id is None and filename.endswith(RESULT_SUFFIX):
+        ligand_id = filename[:-len(RESULT_SUFFIX)]
+    if ligand_id is not None:
+        ligand = execute_query(f'''
+            SELECT status FROM task_{task_id}_ligands WHERE ligand_id = %s
+        ''', (ligand_id,), fetch_one=True)
+        if ligand and ligand['status'] == 'completed':
+            # 推测执行时同一配体可能被多个节点计算，已有结果生效后不再保存
+            return json.dumps({'status': 'ok', 'duplicate': True})
     result_dir = os.path.join('results', str(task_id))
     os.makedirs(result_dir, exist_ok=True)
     file_path = os.path.join(result_dir, filename)
-    request.files['file'].save(file_path)
+    # 先写临时文件，再以硬链接原子地占用最终文件名：并发上传的副本中最先写完的一份生效，
+    # 已保存的结果不会被另一份覆盖或截断
+    temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        request.files['file'].save(temp_path)
+        os.link(temp_path, file_path)
+    except FileExistsError:
+        return json.dumps({'status': 'ok', 'duplicate': True})
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+    return json.dumps({'status': 'ok'})
+
+@app.route('/upload/maps/<task_id>', methods=['POST'])
+def upload_grid_maps(task_id):
+    task_dir = os.path.join('tasks', str(task_id))
+    if not os.path.isdir(task_dir):
+        return json.dumps({'status': 'cancelled'}), 410
+    file_path = os.path.join(task_dir, GRID_MAPS_ARCHIVE)
+    if os.path.exists(file_path):
+        # 多个节点可能同时计算网格图，保留最先上传的一份
+        return json.dumps({'status': 'ok', 'duplicate': True})
+    # 先写临时文件再改名，下载方不会读到未写完的归档
+    temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+    request.files['file'].save(temp_path)
+    os.replace(temp_path, file_path)
     return json.dumps({'status': 'ok'})
 
+def load_token_secret(path):
+    """读取会话令牌的签名密钥，不存在时生成随机密钥并保存为仅所有者可读的文件"""
+    try:
+        with open(path, 'rb') as f:
+            secret = f.read()
+        if len(secret) >= 32:
+            return secret
+    except FileNotFoundError:
+        pass
+    secret = secrets.token_bytes(32)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    os.replace(temp_path, path)
+    logger.info(f"Generated session token key {path}")
+    return secret
+
+class ClientConnection:
+    """已认证的节点连接"""
+    def __init__(self, secure_sock, addr):
+        self.secure_sock = secure_sock
+        self.addr = addr
+        # 节点未上报 node_id 时以连接地址标识
+        self.node_id = f"{addr[0]}:{addr[1]}"
+        # 流水线处理时多个工作线程共用同一连接发送响应
+        self.send_lock = threading.Lock()
+        # 带请求 ID 的客户端能区分响应和服务器主动推送的消息
+        self.supports_push = False
+    
+    def send(self, message):
+        with self.send_lock:
+            self.secure_sock.send_message(message)
+
 # TCP 命令服务器
 class TCPServer:
     def __init__(self, host='0.0.0.0', port=None, init_db_connection=True):
@@ -143,176 +294,642 @@ class TCPServer:
         self.sock.bind((host, port or SERVER_CONFIG['tcp_port']))
         self.sock.listen(5)
         self.ssl_context = SSLContextManager().get_server_context()
+        self.max_frame_size = SERVER_CONFIG.get('max_frame_size', MAX_FRAME_SIZE)
+        
+        # 认证缓存：密码哈希、已验证密码和会话令牌
+        self.auth_lock = threading.Lock()
+        self.password_cache_ttl = SERVER_CONFIG.get('password_cache_ttl', 60)
+        self.session_token_ttl = SERVER_CONFIG.get('session_token_ttl', 3600)
+        self.token_secret = load_token_secret(SERVER_CONFIG.get('session_token_key', os.path.join('certs', 'session_token.key')))
+        self._password_hash_cache = None
+        self._verified_passwords = set()
+        
+        # 处理流水线请求的共享工作线程池
+        self.executor = ThreadPoolExecutor(max_workers=SERVER_CONFIG.get('worker_threads', 32))
+        # 结果和心跳的写入合并成批量事务提交
+        self.db_writer = DBWriter(
+            flush_interval=DB_CONFIG.get('write_batch_interval', 0.01),
+            max_batch=DB_CONFIG.get('write_batch_size', 256)
+        )
+        # 任务调度器
+        self.scheduler = TaskScheduler(
+            user_shares=TASK_CONFIG.get('user_shares'),
+            deadline_horizon=TASK_CONFIG.get('deadline_horizon', 3600),
+            deadline_share=TASK_CONFIG.get('deadline_share', 0.5),
+            affinity_slack=TASK_CONFIG.get('affinity_slack', 50)
+        )
+        # 各节点（按 node_id）已缓存的受体哈希，以及上一次分发给该节点的任务
+        self.node_receptors = {}
+        self.node_tasks = {}
+        self.node_receptors_lock = threading.Lock()
+        self.scheduler_sync_interval = TASK_CONFIG.get('scheduler_sync_interval', 5)
+        self.migrated_tasks = set()
+        
+        # 配体分批和尾部调度
+        self.max_batch = TASK_CONFIG.get('max_batch', 32)
+        self.batch_cost_target = TASK_CONFIG.get('batch_cost_target', 200)
+        self.tail_fraction = TASK_CONFIG.get('tail_fraction', 0.05)
+        # 每个节点持有约 lease_target_seconds 的工作量；节点定期续租，批内排队的配体不会被超时检查重置
+        self.leases = LeaseTracker(target_seconds=TASK_CONFIG.get('lease_target_seconds', 120))
+        # 推测执行：没有待处理配体时，把运行最久的配体再分给空闲节点
+        self.speculation_min_seconds = TASK_CONFIG.get('speculation_min_seconds', 60)
+        self.speculation_max_copies = TASK_CONFIG.get('speculation_max_copies', 2)
+        
+        # 已认证的连接（按 node_id），用于向节点推送取消消息
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        
+        self.handlers = {
+            'heartbeat': self.handle_heartbeat,
+            'get_task': self.handle_get_task,
+            'submit_result': self.handle_submit_result,
+            'release': self.handle_release,
+            'renew': self.handle_renew
+        }
+        
+        # 指标在模块级注册一次，最近创建的实例提供抓取时的数值
+        LEASES_OUTSTANDING.set_function(self.leases.outstanding)
+        RUNNABLE_TASKS.set_function(lambda: sum(1 for entry in list(self.scheduler.tasks.values()) if entry.active))
+    
+    def get_password_hash(self):
+        """获取当前密码哈希，缓存在内存中以避免每次连接都查询数据库"""
+        with self.auth_lock:
+            if self._password_hash_cache is not None and time.time() - self._password_hash_cache[1] < self.password_cache_ttl:
+                return self._password_hash_cache[0]
+        
+        result = execute_query(
+            'SELECT password_hash FROM server_auth ORDER BY created_at DESC LIMIT 1',
+            fetch_one=True
+        )
+        stored_hash = None
+        if result:
+            stored_hash = result['password_hash'].encode() if isinstance(result['password_hash'], str) else result['password_hash']
+        
+        with self.auth_lock:
+            if self._password_hash_cache is None or self._password_hash_cache[0] != stored_hash:
+                # 密码已修改，之前验证通过的密码全部作废
+                self._verified_passwords.clear()
+            self._password_hash_cache = (stored_hash, time.time())
+        return stored_hash
     
     def verify_password(self, password):
         """验证客户端提供的密码"""
         try:
-            result = execute_query(
-                'SELECT password_hash FROM server_auth ORDER BY created_at DESC LIMIT 1',
-                fetch_one=True
-            )
-            
-            if not result:
+            stored_hash = self.get_password_hash()
+            if not stored_hash:
                 logger.warning("No server password set")
                 return True
             
+            # 同一密码只需执行一次 bcrypt 校验
+            digest = hashlib.sha256(stored_hash + password.encode()).digest()
+            with self.auth_lock:
+                if digest in self._verified_passwords:
+                    return True
+            
             import bcrypt
-            stored_hash = result['password_hash'].encode() if isinstance(result['password_hash'], str) else result['password_hash']
-            return bcrypt.checkpw(password.encode(), stored_hash)
+            if not bcrypt.checkpw(password.encode(), stored_hash):
+                return False
+            with self.auth_lock:
+                self._verified_passwords.add(digest)
+            return True
         except Exception as e:
             logger.error(f"Error verifying password: {e}")
             return False
     
+    def _token_signature(self, stored_hash, expires, nonce, node_id, host):
+        # 密钥由服务器私有的随机密钥和当前密码哈希派生：能读取数据库也无法伪造令牌，
+        # 服务器重启后令牌仍然有效，修改密码后立即失效
+        key = hmac.new(self.token_secret, b'vortexdock-session:' + (stored_hash or b''), hashlib.sha256).digest()
+        message = f"{expires}.{nonce}.{node_id}.{host}".encode()
+        return hmac.new(key, message, hashlib.sha256).hexdigest()
+    
+    def issue_token(self, node_id, host):
+        """签发短期会话令牌，重连时可代替 bcrypt 校验
+
+        令牌绑定节点标识和来源地址，其它主机或节点拿到也无法使用。
+        """
+        expires = int(time.time()) + self.session_token_ttl
+        nonce = secrets.token_hex(8)
+        signature = self._token_signature(self.get_password_hash(), expires, nonce, node_id, host)
+        return f"{expires}.{nonce}.{signature}", expires
+    
+    def verify_token(self, token, node_id, host):
+        """验证会话令牌的签名、有效期以及节点标识和来源地址"""
+        try:
+            expires, nonce, signature = token.split('.', 2)
+            expires = int(expires)
+            if expires < time.time():
+                return False
+            expected = self._token_signature(self.get_password_hash(), expires, nonce, node_id, host)
+            return hmac.compare_digest(signature, expected)
+        except Exception as e:
+            logger.debug(f"Invalid session token: {e}")
+            return False
+    
+    def authenticate(self, auth_data, addr):
+        """优先使用会话令牌认证，失败时回退到密码校验"""
+        if not auth_data or auth_data.get('type') != 'auth':
+            return False
+        token = auth_data.get('token')
+        if token and self.verify_token(token, str(auth_data.get('node_id') or ''), addr[0]):
+            return True
+        return self.verify_password(auth_data.get('password', ''))
+    
     def handle_client(self, client_sock, addr):
-        logger.info(f"Client {addr} connected")
+        logger.info("Client %s connected", addr)
         
         # 将原始套接字包装为安全套接字
-        secure_sock = SecureSocket(client_sock, self.ssl_context)
+        with TLS_HANDSHAKE_SECONDS.time():
+            secure_sock = SecureSocket(client_sock, self.ssl_context, self.max_frame_size)
+        client = ClientConnection(secure_sock, addr)
+        authenticated = False
         
         try:
             # 等待客户端发送密码
             auth_data = secure_sock.receive_message()
-            if not auth_data or auth_data.get('type') != 'auth' or not self.verify_password(auth_data.get('password', '')):
-                logger.warning(f"Authentication failed for client {addr}")
+            auth_start = time.perf_counter()
+            consume_db_time()
+            if not self.authenticate(auth_data, addr):
+                COMMAND_ERRORS.labels('auth').inc()
+                logger.warning("Authentication failed for client %s", addr)
                 secure_sock.send_message({'status': 'error', 'message': '认证失败'})
                 return
             
-            secure_sock.send_message({'status': 'ok'})
-            logger.info(f"Client {addr} authenticated successfully")
+            if auth_data.get('node_id'):
+                client.node_id = str(auth_data['node_id'])
+            with self.clients_lock:
+                self.clients[client.node_id] = client
+            self.update_node_receptors(client.node_id, auth_data.get('receptor_hashes'))
+            token, token_expires = self.issue_token(str(auth_data.get('node_id') or ''), addr[0])
+            secure_sock.send_message({'status': 'ok', 'token': token, 'token_expires': token_expires})
+            COMMAND_SECONDS.labels('auth').observe(time.perf_counter() - auth_start)
+            COMMAND_DB_SECONDS.labels('auth').observe(consume_db_time())
+            authenticated = True
+            ACTIVE_CONNECTIONS.inc()
+            logger.info("Client %s authenticated successfully (TLS session reused: %s)", addr, secure_sock.session_reused)
             
             while True:
                 try:
                     command = secure_sock.receive_message()
                     if not command:
-                        logger.info(f"Client {addr} disconnected")
+                        logger.info("Client %s disconnected", addr)
                         break
                     
-                    if command['type'] == 'heartbeat':
-                        # 处理心跳消息和性能数据
-                        try:
-                            execute_update('''
-                                INSERT INTO node_heartbeats (client_addr, cpu_usage, memory_usage, last_heartbeat)
-                                VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
-                            ''', (addr[0], command.get('cpu_usage', 0), command.get('memory_usage', 0)))
-                            
-                            secure_sock.send_message({'status': 'ok'})
-                        except Exception as e:
-                            logger.error(f"Error updating node heartbeat: {e}")
-                            secure_sock.send_message({'status': 'error'})
-                        continue
-                    elif command['type'] == 'get_task':
-                        logger.debug(f"Client {addr} requesting task")
-                        # 获取待处理任务
-                        try:
-                            # 获取一个待处理的任务，优先选择进行中的任务
-                            task = execute_query('''
-                                SELECT id,
-                                center_x, center_y, center_z,
-                                size_x, size_y, size_z,
-                                num_modes, energy_range, cpu
-                                FROM tasks 
-                                WHERE status IN ('pending', 'processing')
-                                ORDER BY 
-                                    CASE status
-                                        WHEN 'processing' THEN 0
-                                        WHEN 'pending' THEN 1
-                                    END,
-                                    created_at ASC LIMIT 1
-                            ''', fetch_one=True)
-                            
-                            if task:
-                                task_id = task['id']
-                                
-                                # 从该任务的配体表中获取一个待处理的配体
-                                ligand = execute_query(f'''
-                                    SELECT ligand_id, ligand_file 
-                                    FROM task_{task_id}_ligands 
-                                    WHERE status = 'pending' 
-                                    ORDER BY created_at ASC LIMIT 1
-                                ''', fetch_one=True)
-                                
-                                if ligand:
-                                    ligand_id, ligand_file = ligand['ligand_id'], ligand['ligand_file']
-                                    logger.info(f"Assigning task {task_id} ligand {ligand_id} to client {addr}")
-                                    
-                                    # 更新配体状态和时间戳
-                                    execute_update(f'''
-                                        UPDATE task_{task_id}_ligands 
-                                        SET status = 'processing', last_updated = CURRENT_TIMESTAMP 
-                                        WHERE ligand_id = %s
-                                    ''', (ligand_id,))
-                                    
-                                    response = {
-                                        'task_id': task_id,
-                                        'ligand_id': ligand_id,
-                                        'ligand_file': ligand_file,
-                                        'params': {
-                                            'center_x': task['center_x'],
-                                            'center_y': task['center_y'],
-                                            'center_z': task['center_z'],
-                                            'size_x': task['size_x'],
-                                            'size_y': task['size_y'],
-                                            'size_z': task['size_z'],
-                                            'num_modes': task['num_modes'],
-                                            'energy_range': task['energy_range'],
-                                            'cpu': task['cpu']
-                                        }
-                                    }
-                                else:
-                                    logger.debug(f"No pending ligands for task {task_id}")
-                                    # 如果该任务的所有配体都已处理完，将任务标记为已完成
-                                    execute_update('UPDATE tasks SET status = %s WHERE id = %s', ('completed', task_id))
-                                    response = {'task_id': None}
-                            else:
-                                logger.debug("No pending tasks available")
-                                response = {'task_id': None}
-                            
-                            secure_sock.send_message(response)
-                        except Exception as e:
-                            logger.error(f"Error getting task: {e}")
-                            secure_sock.send_message({'status': 'error'})
-                    
-                    elif command['type'] == 'submit_result':
-                        task_id = command['task_id']
-                        ligand_id = command['ligand_id']
-                        status = command.get('status', 'completed')  # 新增状态字段
-                        
-                        try:
-                            # 根据提交状态更新
-                            if status == 'completed':
-                                update_sql = '''
-                                    UPDATE task_{task_id}_ligands 
-                                    SET status = %s, 
-                                        output_file = %s, 
-                                        last_updated = CURRENT_TIMESTAMP 
-                                    WHERE ligand_id = %s
-                                '''
-                                params = ('completed', os.path.join('results', str(task_id), command['output_file']), ligand_id)
-                            else:
-                                update_sql = '''
-                                    UPDATE task_{task_id}_ligands 
-                                    SET status = 'failed',
-                                        retry_count = retry_count + 1,
-                                        last_updated = CURRENT_TIMESTAMP 
-                                    WHERE ligand_id = %s
-                                '''
-                                params = (ligand_id,)
-                            
-                            execute_update(update_sql.format(task_id=task_id), params)
-                            secure_sock.send_message({'status': 'ok'})
-                        except Exception as e:
-                            logger.error(f"Error updating task status: {e}")
-                            secure_sock.send_message({'status': 'error'})
+                    if 'request_id' in command:
+                        # 带请求 ID 的命令交给工作线程并发处理，响应按 ID 关联
+                        client.supports_push = True
+                        EXECUTOR_QUEUE_DEPTH.inc()
+                        self.executor.submit(self.process_queued_command, command, client)
+                    else:
+                        # 旧版客户端按顺序一问一答
+                        self.process_command(command, client)
                 
                 except Exception as e:
-                    logger.error(f"Unexpected error handling client {addr}: {e}")
+                    logger.error("Unexpected error handling client %s: %s", addr, e)
                     break
         except Exception as e:
-            logger.error(f"Error during authentication for client {addr}: {e}")
+            logger.error("Error during authentication for client %s: %s", addr, e)
         finally:
+            if authenticated:
+                ACTIVE_CONNECTIONS.dec()
+            with self.clients_lock:
+                if self.clients.get(client.node_id) is client:
+                    del self.clients[client.node_id]
             secure_sock.close()
     
+    def process_queued_command(self, command, client):
+        """工作线程取出流水线命令后处理，队列深度为已提交减去已开始的命令数"""
+        EXECUTOR_QUEUE_DEPTH.dec()
+        self.process_command(command, client)
+    
+    def process_command(self, command, client):
+        """处理单条命令并发送响应"""
+        start = time.perf_counter()
+        consume_db_time()
+        if command.get('traces'):
+            # 节点把已确认配体的跟踪记录附带在后续请求中上报
+            self.record_traces(command['traces'], client)
+        handler = self.handlers.get(command.get('type'))
+        # 未知命令归为一类，避免指标标签无限增长
+        command_type = command.get('type') if handler else 'unknown'
+        if handler:
+            try:
+                response = handler(command, client)
+            except Exception as e:
+                logger.error(f"Error handling {command.get('type')} from client {client.addr}: {e}")
+                response = {'status': 'error'}
+        else:
+            logger.warning(f"Unknown command from client {client.addr}: {command.get('type')}")
+            response = {'status': 'error', 'message': '未知命令'}
+        
+        if 'request_id' in command:
+            response['request_id'] = command['request_id']
+        try:
+            client.send(response)
+        except Exception as e:
+            logger.error(f"Error sending response to client {client.addr}: {e}")
+        
+        if response.get('status') == 'error':
+            COMMAND_ERRORS.labels(command_type).inc()
+        COMMAND_SECONDS.labels(command_type).observe(time.perf_counter() - start)
+        COMMAND_DB_SECONDS.labels(command_type).observe(consume_db_time())
+    
+    def record_traces(self, traces, client):
+        """保存节点上报的配体生命周期跟踪记录，写入不阻塞当前命令"""
+        columns = ('task_id', 'ligand_id', 'node_id', 'status', 'speculative') + TRACE_FIELDS
+        query = f'''
+            INSERT INTO ligand_traces ({', '.join(columns)})
+            VALUES ({', '.join(['%s'] * len(columns))})
+        '''
+        for trace in traces[:MAX_TRACES_PER_MESSAGE]:
+            try:
+                params = (
+                    str(trace['task_id']), str(trace['ligand_id']), client.node_id,
+                    trace.get('status'), int(bool(trace.get('speculative')))
+                ) + tuple(float(trace[field]) if trace.get(field) is not None else None for field in TRACE_FIELDS)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.debug(f"Ignoring malformed trace from {client.node_id}: {e}")
+                continue
+            self.db_writer.submit(query, params).add_done_callback(log_write_error)
+    
+    def push(self, node_id, message):
+        """向节点推送不带请求 ID 的消息，节点不在线或不支持推送时返回 False"""
+        with self.clients_lock:
+            client = self.clients.get(node_id)
+        if client is None or not client.supports_push:
+            return False
+        try:
+            client.send(message)
+            return True
+        except Exception as e:
+            logger.error(f"Error pushing {message.get('type')} to node {node_id}: {e}")
+            return False
+    
+    def update_node_receptors(self, node_id, receptor_hashes):
+        """记录节点上报的受体缓存"""
+        if receptor_hashes is None:
+            return
+        with self.node_receptors_lock:
+            self.node_receptors[node_id] = set(receptor_hashes)
+    
+    def handle_heartbeat(self, command, client):
+        """处理心跳消息和性能数据"""
+        self.update_node_receptors(client.node_id, command.get('receptor_hashes'))
+        try:
+            self.db_writer.execute('''
+                INSERT INTO node_heartbeats (client_addr, cpu_usage, memory_usage, last_heartbeat)
+                VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+            ''', (client.addr[0], command.get('cpu_usage', 0), command.get('memory_usage', 0)))
+            # 节点守护进程根据待处理配体数调整计算进程数量
+            return {'status': 'ok', 'pending_ligands': self.scheduler.pending_ligands()}
+        except Exception as e:
+            logger.error(f"Error updating node heartbeat: {e}")
+            return {'status': 'error'}
+    
+    def handle_get_task(self, command, client):
+        """按调度器选出的任务分配一批待处理的配体"""
+        dispatch_logger.debug("Client %s requesting task", client.addr)
+        # 旧版客户端不声明 max_batch，每次只分配一个配体
+        max_batch = max(1, min(int(command.get('max_batch', 1)), self.max_batch))
+        with self.node_receptors_lock:
+            cached_receptors = set(self.node_receptors.get(client.node_id, ()))
+        try:
+            # 每个任务最多尝试一次，没有待处理配体的任务会被停用
+            for _ in range(len(self.scheduler.tasks) + 1):
+                task_id = self.scheduler.select(receptor_hashes=cached_receptors)
+                if task_id is None:
+                    break
+                
+                # 按节点实测吞吐量确定本次分配的成本预算，新节点使用默认预算
+                cost_budget = self.leases.cost_budget(client.node_id) or self.batch_cost_target
+                ligands = self.lease_ligands(task_id, max_batch, cost_budget)
+                if not ligands:
+                    dispatch_logger.debug("No pending ligands for task %s", task_id)
+                    self.scheduler.deactivate(task_id)
+                    self.complete_task_if_done(task_id)
+                    continue
+                
+                self.scheduler.consume(task_id, len(ligands))
+                self.scheduler.charge(task_id, len(ligands) - 1)
+                self.leases.lease(client.node_id, task_id, ligands)
+                dispatch_logger.info("Assigning task %s ligands %s to client %s", task_id,
+                                     [ligand['ligand_id'] for ligand in ligands], client.addr)
+                
+                receptor_hash, receptor_size = self.scheduler.get_receptor(task_id)
+                with self.node_receptors_lock:
+                    switched = self.node_tasks.get(client.node_id) != task_id
+                    self.node_tasks[client.node_id] = task_id
+                    if receptor_hash:
+                        # 节点处理该配体时会缓存受体
+                        self.node_receptors.setdefault(client.node_id, set()).add(receptor_hash)
+                if receptor_hash and switched:
+                    # 同一任务的后续租约本来就不会重新下载受体，只统计节点换到其它任务的情况
+                    affinity_stats.record(receptor_hash in cached_receptors, receptor_size)
+                return self.build_task_response(task_id, ligands, receptor_hash)
+            
+            # 没有待处理配体时，对运行最久的配体进行推测执行
+            speculative = self.lease_speculative(client)
+            if speculative is not None:
+                return speculative
+            
+            dispatch_logger.debug("No pending tasks available")
+            return {'task_id': None}
+        except Exception as e:
+            logger.error(f"Error getting task: {e}")
+            return {'status': 'error'}
+    
+    def build_task_response(self, task_id, ligands, receptor_hash, speculative=False):
+        return {
+            'task_id': task_id,
+            'ligand_id': ligands[0]['ligand_id'],
+            'ligand_file': ligands[0]['ligand_file'],
+            'ligands': [
+                {'ligand_id': ligand['ligand_id'], 'ligand_file': ligand['ligand_file'], 'cost': ligand['cost']}
+                for ligand in ligands
+            ],
+            'receptor_hash': receptor_hash,
+            'params': self.scheduler.get_params(task_id),
+            'speculative': speculative,
+            # 节点据此确定续租间隔
+            'lease_timeout': TASK_TIMEOUT
+        }
+    
+    def lease_speculative(self, client):
+        """把运行时间最长的在途配体重复分配给空闲节点，最先返回的结果生效"""
+        lease = self.leases.speculation_candidate(
+            client.node_id,
+            self.speculation_min_seconds,
+            self.speculation_max_copies,
+            is_valid=lambda task_id: self.scheduler.get_params(task_id) is not None
+        )
+        if lease is None:
+            return None
+        
+        ligand = execute_query(f'''
+            SELECT ligand_id, ligand_file, cost 
+            FROM task_{lease.task_id}_ligands 
+            WHERE ligand_id = %s AND status = 'processing'
+        ''', (lease.ligand_id,), fetch_one=True)
+        if not ligand:
+            return None
+        
+        ligand['cost'] = ligand.get('cost') or 1
+        self.leases.lease(client.node_id, lease.task_id, [ligand], speculative=True)
+        dispatch_logger.info("Speculatively assigning task %s ligand %s (running on %s for %.0fs) to client %s",
+                             lease.task_id, lease.ligand_id, lease.node_id, time.time() - lease.leased_at, client.addr)
+        receptor_hash, _ = self.scheduler.get_receptor(lease.task_id)
+        return self.build_task_response(lease.task_id, [ligand], receptor_hash, speculative=True)
+    
+    def lease_ligands(self, task_id, max_batch, cost_budget):
+        """将待处理配体标记为处理中并返回，没有时返回空列表
+
+        正常阶段按创建顺序分配，并把配体合并成一批（总成本不超过 cost_budget）；
+        剩余配体不多时每批不超过按活跃节点平分的数量；
+        任务尾部（剩余比例不超过 tail_fraction）按成本从高到低逐个分配，
+        让耗时最长的配体最先开始，缩短任务完成前的长尾。
+        """
+        pending, total = self.scheduler.get_progress(task_id)
+        tail = total > 0 and pending <= total * self.tail_fraction
+        if tail:
+            order, max_batch = 'cost DESC', 1
+        else:
+            order = 'created_at ASC'
+            max_batch = min(max_batch, self.leases.fair_batch_limit(pending))
+        
+        for _ in range(3):
+            candidates = execute_query(f'''
+                SELECT ligand_id, ligand_file, cost 
+                FROM task_{task_id}_ligands 
+                WHERE status = 'pending' 
+                ORDER BY {order} LIMIT %s
+            ''', (max_batch,))
+            if not candidates:
+                return []
+            
+            # 第一个配体总是分配，其余配体在成本预算内合并
+            batch, batch_cost = [], 0
+            for ligand in candidates:
+                ligand['cost'] = ligand.get('cost') or 1
+                if batch and batch_cost + ligand['cost'] > cost_budget:
+                    break
+                batch.append(ligand)
+                batch_cost += ligand['cost']
+            
+            # 仅当配体仍为待处理状态时才更新，避免并发请求重复分配；整批在同一事务中提交
+            futures = [
+                self.db_writer.submit(f'''
+                    UPDATE task_{task_id}_ligands 
+                    SET status = 'processing', last_updated = CURRENT_TIMESTAMP 
+                    WHERE ligand_id = %s AND status = 'pending'
+                ''', (ligand['ligand_id'],))
+                for ligand in batch
+            ]
+            leased = [ligand for ligand, updated in zip(batch, self.db_writer.wait(futures)) if updated]
+            if leased:
+                return leased
+        return []
+    
+    def complete_task_if_done(self, task_id):
+        """所有配体都已完成或最终失败时将任务标记为已完成"""
+        remaining = execute_query(f'''
+            SELECT COUNT(*) as count 
+            FROM task_{task_id}_ligands 
+            WHERE status NOT IN ('completed', 'failed')
+        ''', fetch_one=True)
+        if remaining and remaining['count'] == 0:
+            execute_update('UPDATE tasks SET status = %s WHERE id = %s', ('completed', task_id))
+    
+    def sync_scheduler(self):
+        """从数据库刷新调度器中的任务、优先级和待处理配体数"""
+        tasks = execute_query('''
+            SELECT id, status, owner, priority, deadline, receptor_hash, receptor_size,
+            center_x, center_y, center_z,
+            size_x, size_y, size_z,
+            num_modes, energy_range, cpu, exhaustiveness
+            FROM tasks
+            WHERE status IN ('pending', 'processing')
+        ''') or []
+        for task in tasks:
+            if task['id'] not in self.migrated_tasks:
+                migrate_ligand_table(task['id'])
+                self.migrated_tasks.add(task['id'])
+            counts = execute_query(f'''
+                SELECT COUNT(*) as total,
+                SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending
+                FROM task_{task['id']}_ligands
+            ''', fetch_one=True)
+            task['total'] = counts['total'] if counts else 0
+            task['pending'] = int(counts['pending'] or 0) if counts else 0
+            if not task['receptor_hash']:
+                # 旧版本创建的任务没有受体哈希，首次同步时补算
+                receptor_path = os.path.join('tasks', str(task['id']), 'receptor.pdbqt')
+                if os.path.exists(receptor_path):
+                    task['receptor_hash'] = hash_file(receptor_path)
+                    task['receptor_size'] = os.path.getsize(receptor_path)
+                    execute_update(
+                        'UPDATE tasks SET receptor_hash = %s, receptor_size = %s WHERE id = %s',
+                        (task['receptor_hash'], task['receptor_size'], task['id'])
+                    )
+        for task_id in self.scheduler.sync(tasks):
+            task = execute_query('SELECT status FROM tasks WHERE id = %s', (task_id,), fetch_one=True)
+            if task and task['status'] == 'completed':
+                continue
+            if task:
+                # 暂停的任务恢复后立即重新分发被取消的配体，不必等待超时检查
+                execute_update(f'''
+                    UPDATE task_{task_id}_ligands 
+                    SET status = 'pending', last_updated = CURRENT_TIMESTAMP 
+                    WHERE status = 'processing'
+                ''')
+            self.cancel_task(task_id)
+    
+    def _start_scheduler_sync_thread(self):
+        """启动调度器同步线程，新建、暂停和删除的任务在一个同步周期内生效"""
+        def sync_worker():
+            while True:
+                time.sleep(self.scheduler_sync_interval)
+                try:
+                    self.leases.expire(TASK_TIMEOUT)
+                    with SCHEDULER_SYNC_SECONDS.time():
+                        self.sync_scheduler()
+                except Exception as e:
+                    logger.error(f"Error syncing scheduler: {e}")
+        
+        sync_thread = threading.Thread(target=sync_worker)
+        sync_thread.daemon = True
+        sync_thread.start()
+    
+    def handle_submit_result(self, command, client):
+        """记录配体的计算结果
+
+        同一配体可能因推测执行被多个节点计算：最先提交的成功结果生效，
+        其余节点收到取消通知，之后到达的重复结果不再修改数据库。
+        """
+        task_id = command['task_id']
+        ligand_id = command['ligand_id']
+        status = command.get('status', 'completed')  # 新增状态字段
+        
+        try:
+            if task_id not in self.scheduler.tasks and not execute_query(
+                    'SELECT id FROM tasks WHERE id = %s', (task_id,), fetch_one=True):
+                # 任务已被删除，结果不再需要
+                return {'status': 'cancelled'}
+            
+            # 根据提交状态更新，已完成的配体不会被覆盖
+            if status == 'completed':
+                # 节点从 Vina 输出中解析出的结果表，第一行为最佳结合能
+                modes = command.get('modes') or []
+                affinity = modes[0].get('affinity') if modes else None
+                update_sql = '''
+                    UPDATE task_{task_id}_ligands 
+                    SET status = %s, 
+                        output_file = %s, 
+                        affinity = %s, 
+                        last_updated = CURRENT_TIMESTAMP 
+                    WHERE ligand_id = %s AND status != 'completed'
+                '''
+                params = ('completed', os.path.join('results', str(task_id), command['output_file']), affinity, ligand_id)
+                updated = self.db_writer.execute(update_sql.format(task_id=task_id), params)
+                others = self.leases.complete(task_id, ligand_id, client.node_id, success=True)
+                if not updated:
+                    dispatch_logger.debug("Duplicate result for task %s ligand %s from %s", task_id, ligand_id, client.node_id)
+                    return {'status': 'ok', 'duplicate': True}
+                self.cancel_leases(others)
+                return {'status': 'ok'}
+            
+            others = self.leases.complete(task_id, ligand_id, client.node_id, success=False)
+            if others:
+                # 其它节点仍在计算该配体，等待它们的结果
+                return {'status': 'ok'}
+            update_sql = '''
+                UPDATE task_{task_id}_ligands 
+                SET status = 'failed',
+                    retry_count = retry_count + 1,
+                    last_updated = CURRENT_TIMESTAMP 
+                WHERE ligand_id = %s AND status != 'completed'
+            '''
+            self.db_writer.execute(update_sql.format(task_id=task_id), (ligand_id,))
+            return {'status': 'ok'}
+        except Exception as e:
+            logger.error(f"Error updating task status: {e}")
+            return {'status': 'error'}
+    
+    def handle_release(self, command, client):
+        """节点退回已租用但不再计算的配体（例如重启后无法继续），立即重新分发而不必等待超时
+
+        node_id 为租用时的节点标识，节点重启后进程号变化，由节点在命令中给出。
+        """
+        task_id = command['task_id']
+        node_id = command.get('node_id') or client.node_id
+        try:
+            # 推测执行的其它副本仍在计算的配体保持处理中状态
+            ligand_ids = [ligand_id for ligand_id in command.get('ligand_ids') or []
+                          if not self.leases.release(task_id, ligand_id, node_id)]
+            futures = [
+                self.db_writer.submit(f'''
+                    UPDATE task_{task_id}_ligands 
+                    SET status = 'pending', last_updated = CURRENT_TIMESTAMP 
+                    WHERE ligand_id = %s AND status = 'processing'
+                ''', (ligand_id,))
+                for ligand_id in ligand_ids
+            ]
+            released = sum(self.db_writer.wait(futures))
+            if released:
+                self.scheduler.restore(task_id, released)
+                dispatch_logger.info("Client %s released %d ligands of task %s", client.addr, released, task_id)
+            return {'status': 'ok', 'released': released}
+        except Exception as e:
+            logger.error(f"Error releasing ligands: {e}")
+            return {'status': 'error'}
+    
+    def handle_renew(self, command, client):
+        """节点续租仍在排队或计算的配体
+
+        一批配体在节点上依次计算，单个配体也可能超过租约超时时间；节点每隔
+        租约超时时间的三分之一续租一次，超时检查只重置真正失联的节点的配体。
+        node_id 为租用时的节点标识，与 release 相同。
+        """
+        task_id = command['task_id']
+        node_id = command.get('node_id') or client.node_id
+        try:
+            ligand_ids = command.get('ligand_ids') or []
+            futures = [
+                self.db_writer.submit(f'''
+                    UPDATE task_{task_id}_ligands 
+                    SET last_updated = CURRENT_TIMESTAMP 
+                    WHERE ligand_id = %s AND status = 'processing'
+                ''', (ligand_id,))
+                for ligand_id in ligand_ids
+            ]
+            renewed = sum(self.db_writer.wait(futures))
+            self.leases.renew(task_id, ligand_ids, node_id)
+            dispatch_logger.debug("Client %s renewed %d of %d leases of task %s", client.addr, renewed, len(ligand_ids), task_id)
+            return {'status': 'ok', 'renewed': renewed}
+        except Exception as e:
+            logger.error(f"Error renewing leases: {e}")
+            return {'status': 'error'}
+    
+    def cancel_task(self, task_id):
+        """任务被暂停或删除后通知所有节点停止计算并丢弃预取的配体"""
+        released = self.leases.release_task(task_id)
+        with self.clients_lock:
+            node_ids = list(self.clients)
+        notified = sum(self.push(node_id, {'type': 'cancel', 'task_id': task_id}) for node_id in node_ids)
+        logger.info(f"Task {task_id} cancelled: released {len(released)} leases, notified {notified} nodes")
+    
+    def cancel_leases(self, leases):
+        """通知仍在计算已完成配体的节点停止计算"""
+        for lease in leases:
+            if self.push(lease.node_id, {'type': 'cancel', 'task_id': lease.task_id, 'ligand_ids': [lease.ligand_id]}):
+                logger.info(f"Cancelled duplicate of task {lease.task_id} ligand {lease.ligand_id} on node {lease.node_id}")
+    
     def start(self):
+        try:
+            self.sync_scheduler()
+        except Exception as e:
+            logger.error(f"Error syncing scheduler: {e}")
+        self._start_scheduler_sync_thread()
+        
         while True:
             client, addr = self.sock.accept()
             logger.info(f"New connection from {addr}")
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""TaskScheduler under contention: stride shares and earliest deadline first
+
+Run from the repository root:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distribution_server'))
+from scheduler import TaskScheduler
+
+NOW = 1_000_000.0
+DISPATCHES = 8000
+# Largest allowed difference between a task's dispatch share and its stride weight
+TOLERANCE = 0.01
+
+def make_row(task_id, owner, priority=1, deadline=None, pending=10 ** 9):
+    return {
+        'id': task_id, 'status': 'pending', 'owner': owner,
+        'priority': priority, 'deadline': deadline, 'pending': pending
+    }
+
+def dispatch_shares(scheduler, rows, dispatches=DISPATCHES):
+    scheduler.sync(rows, now=NOW)
+    for _ in range(dispatches):
+        scheduler.select(now=NOW)
+    return {task_id: count / dispatches for task_id, count in scheduler.get_shares().items()}
+
+class StrideShareTest(unittest.TestCase):
+    def assertShares(self, shares, expected):
+        self.assertEqual(set(shares), set(expected))
+        for task_id, share in expected.items():
+            self.assertAlmostEqual(shares[task_id], share, delta=TOLERANCE, msg=task_id)
+
+    def test_equal_priorities_share_equally(self):
+        shares = dispatch_shares(TaskScheduler(), [
+            make_row('huge', 'alice'),
+            make_row('small_a', 'bob'),
+            make_row('small_b', 'carol'),
+        ])
+        self.assertShares(shares, {'huge': 1 / 3, 'small_a': 1 / 3, 'small_b': 1 / 3})
+
+    def test_priorities_weight_tasks_of_one_user(self):
+        shares = dispatch_shares(TaskScheduler(), [
+            make_row('p1', 'alice', priority=1),
+            make_row('p2', 'alice', priority=2),
+            make_row('p4', 'alice', priority=4),
+        ])
+        self.assertShares(shares, {'p1': 1 / 7, 'p2': 2 / 7, 'p4': 4 / 7})
+
+    def test_user_shares_split_before_priorities(self):
+        shares = dispatch_shares(TaskScheduler(user_shares={'alice': 3, 'bob': 1}), [
+            make_row('alice_1', 'alice'),
+            make_row('alice_2', 'alice', priority=2),
+            make_row('bob_1', 'bob'),
+        ])
+        self.assertShares(shares, {'alice_1': 0.75 / 3, 'alice_2': 0.75 * 2 / 3, 'bob_1': 0.25})
+
+    def test_task_joining_late_does_not_catch_up(self):
+        scheduler = TaskScheduler()
+        dispatch_shares(scheduler, [make_row('old', 'alice')], dispatches=1000)
+        scheduler.sync([make_row('old', 'alice'), make_row('new', 'bob')], now=NOW)
+        for _ in range(1000):
+            scheduler.select(now=NOW)
+        shares = scheduler.get_shares()
+        self.assertAlmostEqual(shares['new'] / 1000, 0.5, delta=TOLERANCE)
+
+class EarliestDeadlineFirstTest(unittest.TestCase):
+    def test_earliest_deadline_is_dispatched_first(self):
+        scheduler = TaskScheduler(deadline_share=1.0)
+        scheduler.sync([
+            make_row('late', 'bob', deadline=NOW + 1200),
+            make_row('early', 'alice', deadline=NOW + 600),
+            make_row('background', 'carol'),
+        ], now=NOW)
+        self.assertEqual({scheduler.select(now=NOW) for _ in range(100)}, {'early'})
+        scheduler.deactivate('early')
+        self.assertEqual({scheduler.select(now=NOW) for _ in range(100)}, {'late'})
+        scheduler.deactivate('late')
+        self.assertEqual({scheduler.select(now=NOW) for _ in range(100)}, {'background'})
+
+    def test_deadline_tasks_are_limited_to_deadline_share(self):
+        shares = dispatch_shares(TaskScheduler(deadline_share=0.5), [
+            make_row('early', 'alice', deadline=NOW + 600),
+            make_row('late', 'bob', deadline=NOW + 1200),
+            make_row('background', 'carol'),
+        ])
+        # Urgent dispatches are charged to the task's fair share, the rest is split fairly
+        self.assertAlmostEqual(shares['early'], 0.5, delta=TOLERANCE)
+        self.assertAlmostEqual(shares['late'], 0.25, delta=TOLERANCE)
+        self.assertAlmostEqual(shares['background'], 0.25, delta=TOLERANCE)
+
+    def test_deadline_beyond_horizon_is_scheduled_fairly(self):
+        shares = dispatch_shares(TaskScheduler(deadline_horizon=3600, deadline_share=1.0), [
+            make_row('distant', 'alice', deadline=NOW + 7200),
+            make_row('background', 'bob'),
+        ])
+        self.assertAlmostEqual(shares['distant'], 0.5, delta=TOLERANCE)
+        self.assertAlmostEqual(shares['background'], 0.5, delta=TOLERANCE)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,15 +2,37 @@
 
 import os
 import time
+import queue
 import logging
+import threading
+from concurrent.futures import Future
 import mysql.connector
 from mysql.connector import pooling
 from datetime import datetime, timedelta
 from config import DB_CONFIG
+from .metrics import Histogram, Gauge
 
 # 初始化日志
 logger = logging.getLogger('dock_server')
 
+# 数据库耗时统计，按线程累计以便区分命令的数据库时间和总时间
+DB_SECONDS = Histogram('vortexdock_db_seconds', 'Time spent in database calls', ('operation',))
+DB_WRITE_BATCH_SIZE = Histogram('vortexdock_db_write_batch_size', 'Statements per group-committed transaction',
+                                buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+DB_WRITE_QUEUE = Gauge('vortexdock_db_write_queue_depth', 'Statements waiting for the DB writer thread')
+_db_time = threading.local()
+
+def _record_db_time(operation, start):
+    elapsed = time.perf_counter() - start
+    DB_SECONDS.labels(operation).observe(elapsed)
+    _db_time.total = getattr(_db_time, 'total', 0.0) + elapsed
+
+def consume_db_time():
+    """返回并清零当前线程累计的数据库耗时（秒）"""
+    total = getattr(_db_time, 'total', 0.0)
+    _db_time.total = 0.0
+    return total
+
 # 全局数据库连接池
 connection_pool = None
 
@@ -106,9 +128,35 @@ def init_database():
                 num_modes INTEGER NOT NULL,
                 energy_range REAL NOT NULL,
                 cpu INTEGER NOT NULL,
+                exhaustiveness INTEGER NULL,
+                owner TEXT DEFAULT 'default',
+                priority REAL DEFAULT 1,
+                deadline TIMESTAMP NULL,
+                receptor_hash TEXT,
+                receptor_size INTEGER DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS ligand_traces (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT NOT NULL,
+                ligand_id TEXT NOT NULL,
+                node_id TEXT NOT NULL,
+                status TEXT,
+                speculative INTEGER DEFAULT 0,
+                requested_at REAL,
+                leased_at REAL,
+                download_start REAL,
+                download_end REAL,
+                vina_start REAL,
+                vina_end REAL,
+                upload_start REAL,
+                upload_end REAL,
+                acked_at REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
             """
         ]
     else:
@@ -146,11 +194,39 @@ def init_database():
                 num_modes INT NOT NULL,
                 energy_range FLOAT NOT NULL,
                 cpu INT NOT NULL,
+                exhaustiveness INT NULL,
+                owner VARCHAR(255) DEFAULT 'default',
+                priority FLOAT DEFAULT 1,
+                deadline TIMESTAMP NULL,
+                receptor_hash VARCHAR(64),
+                receptor_size BIGINT DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 INDEX idx_status (status),
                 INDEX idx_created_at (created_at)
             )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS ligand_traces (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                task_id VARCHAR(255) NOT NULL,
+                ligand_id VARCHAR(255) NOT NULL,
+                node_id VARCHAR(255) NOT NULL,
+                status VARCHAR(50),
+                speculative TINYINT DEFAULT 0,
+                requested_at DOUBLE,
+                leased_at DOUBLE,
+                download_start DOUBLE,
+                download_end DOUBLE,
+                vina_start DOUBLE,
+                vina_end DOUBLE,
+                upload_start DOUBLE,
+                upload_end DOUBLE,
+                acked_at DOUBLE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                INDEX idx_task_id (task_id),
+                INDEX idx_node_id (node_id)
+            )
             """
         ]
 
@@ -175,6 +251,8 @@ def init_database():
                         ligand_file VARCHAR(255) NOT NULL,
                         status VARCHAR(50) DEFAULT 'pending',
                         retry_count INT DEFAULT 0,
+                        cost FLOAT DEFAULT 1,
+                        affinity FLOAT NULL,
                         output_file VARCHAR(255),
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -183,6 +261,7 @@ def init_database():
                 """)
         
         conn.commit()
+        migrate_tasks_table()
         logger.info("Database tables initialized successfully")
         
     except Exception as e:
@@ -198,6 +277,7 @@ def init_database():
 def execute_query(query, params=None, fetch_one=False):
     """执行查询语句"""
     conn = None
+    start = time.perf_counter()
     try:
         conn = get_db_connection()
         # 根据数据库类型动态设置游标返回类型
@@ -228,10 +308,12 @@ def execute_query(query, params=None, fetch_one=False):
         if conn:
             cursor.close()
             conn.close()
+        _record_db_time('query', start)
 
 def execute_update(query, params=None):
     """执行更新/插入语句"""
     conn = None
+    start = time.perf_counter()
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -249,6 +331,182 @@ def execute_update(query, params=None):
         if conn:
             cursor.close()
             conn.close()
+        _record_db_time('update', start)
+
+def execute_many(query, rows):
+    """在同一个事务中对多行参数执行同一条更新/插入语句，返回影响的总行数"""
+    conn = None
+    start = time.perf_counter()
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        # 动态处理占位符
+        query = query.replace('%s', '?') if DB_CONFIG['type'] == 'sqlite' else query
+        cursor.executemany(query, rows)
+        conn.commit()
+        return cursor.rowcount
+    except Exception as e:
+        logger.error(f"Batch update execution failed: {e}")
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+        _record_db_time('update', start)
+
+class DBWriter:
+    """单线程批量写入：多个线程提交的更新语句合并到同一个事务中提交（group commit）
+
+    队列中第一条语句到达后最多等待 flush_interval 秒或凑满 max_batch 条再提交，
+    调用方通过 Future 获得每条语句影响的行数，Future 完成即表示已持久化。
+    批量事务失败时逐条重新执行，只有出错的语句返回异常。
+    """
+    def __init__(self, flush_interval=0.01, max_batch=256):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        DB_WRITE_QUEUE.set_function(self.queue.qsize)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def submit(self, query, params=None):
+        """提交更新语句，返回以影响行数为结果的 Future"""
+        future = Future()
+        self.queue.put((query, params, future))
+        return future
+    
+    def execute(self, query, params=None, timeout=None):
+        """提交更新语句并等待其所在的事务提交"""
+        return self.wait([self.submit(query, params)], timeout)[0]
+    
+    def wait(self, futures, timeout=None):
+        """等待多个语句提交并返回各自影响的行数，等待时间计入当前线程的数据库耗时"""
+        start = time.perf_counter()
+        try:
+            return [future.result(timeout) for future in futures]
+        finally:
+            _record_db_time('write_wait', start)
+    
+    def close(self):
+        """提交队列中剩余的语句后停止写入线程"""
+        self.queue.put(None)
+        self.thread.join()
+    
+    def _run(self):
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._flush(batch)
+    
+    def _flush(self, batch):
+        DB_WRITE_BATCH_SIZE.observe(len(batch))
+        conn = None
+        start = time.perf_counter()
+        try:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            rowcounts = []
+            for query, params, _ in batch:
+                # 动态处理占位符
+                query = query.replace('%s', '?') if DB_CONFIG['type'] == 'sqlite' else query
+                cursor.execute(query, params or ())
+                rowcounts.append(cursor.rowcount)
+            conn.commit()
+            cursor.close()
+        except Exception as e:
+            logger.warning(f"Batched write of {len(batch)} statements failed, retrying individually: {e}")
+            if conn:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            rowcounts = None
+        finally:
+            if conn:
+                conn.close()
+            _record_db_time('batch_commit', start)
+        
+        if rowcounts is not None:
+            for (_, _, future), rowcount in zip(batch, rowcounts):
+                future.set_result(rowcount)
+            return
+        for query, params, future in batch:
+            try:
+                future.set_result(execute_update(query, params))
+            except Exception as e:
+                future.set_exception(e)
+
+# tasks 表在旧版本之后新增的列
+TASK_COLUMNS = {
+    'sqlite': {
+        'owner': "TEXT DEFAULT 'default'",
+        'priority': 'REAL DEFAULT 1',
+        'deadline': 'TIMESTAMP NULL',
+        'receptor_hash': 'TEXT',
+        'receptor_size': 'INTEGER DEFAULT 0',
+        'exhaustiveness': 'INTEGER NULL'
+    },
+    'mysql': {
+        'owner': "VARCHAR(255) DEFAULT 'default'",
+        'priority': 'FLOAT DEFAULT 1',
+        'deadline': 'TIMESTAMP NULL',
+        'receptor_hash': 'VARCHAR(64)',
+        'receptor_size': 'BIGINT DEFAULT 0',
+        'exhaustiveness': 'INT NULL'
+    }
+}
+
+def get_table_columns(table):
+    """获取表的列名"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT * FROM {table} LIMIT 0")
+        cursor.fetchall()
+        columns = [col[0] for col in cursor.description]
+        cursor.close()
+        return columns
+    finally:
+        conn.close()
+
+def ensure_columns(table, columns):
+    """为已有的表补充缺失的列（兼容旧版本创建的数据库）"""
+    existing = get_table_columns(table)
+    for column, definition in columns.items():
+        if column not in existing:
+            logger.info(f"Adding column {column} to table {table}")
+            execute_update(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# 配体表在旧版本之后新增的列
+LIGAND_COLUMNS = {
+    'retry_count': 'INT DEFAULT 0',
+    'cost': 'FLOAT DEFAULT 1',
+    'affinity': 'FLOAT NULL'
+}
+
+def migrate_tasks_table():
+    """补充 tasks 表的新增列"""
+    ensure_columns('tasks', TASK_COLUMNS['sqlite' if DB_CONFIG['type'] == 'sqlite' else 'mysql'])
+
+def migrate_ligand_table(task_id):
+    """补充任务配体表的新增列"""
+    ensure_columns(f'task_{task_id}_ligands', LIGAND_COLUMNS)
 
 # 初始化连接池和数据库
 if __name__ == '__main__':
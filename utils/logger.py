@@ -1,9 +1,116 @@
 import os
+import copy
+import json
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from datetime import datetime
+from pathlib import PurePath
 
-class Logger:
+def load_log_config():
+    """读取 config.LOG_CONFIG，旧版本的配置文件没有该项时使用默认值"""
+    try:
+        import config
+    except ImportError:
+        return {}
+    return getattr(config, 'LOG_CONFIG', {})
+
+class TextFormatter(logging.Formatter):
+    """文本格式，附加字段以 key=value 的形式追加在消息之后"""
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return text
+
+class JsonFormatter(logging.Formatter):
+    """JSON Lines 格式，每条日志一行，附加字段作为独立的键"""
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# 参数全部为这些类型（或由它们组成的元组，例如客户端地址）时消息才延迟到后台线程格式化
+IMMUTABLE_TYPES = (str, bytes, int, float, complex, bool, type(None), PurePath)
+
+def is_immutable(value):
+    if isinstance(value, IMMUTABLE_TYPES):
+        return True
+    return isinstance(value, (tuple, frozenset)) and all(is_immutable(item) for item in value)
+
+def snapshot_value(value):
+    """复制可变的附加字段值，复制失败时转为字符串"""
+    if is_immutable(value):
+        return value
+    try:
+        return copy.deepcopy(value)
+    except Exception:
+        return str(value)
+
+class DeferredQueueHandler(QueueHandler):
+    """把日志记录放入队列，消息格式化和 I/O 都在后台线程中完成"""
+    def prepare(self, record):
+        args = record.args
+        if args and not all(is_immutable(arg) for arg in (args.values() if isinstance(args, dict) else args)):
+            # 参数可能在后台线程格式化之前被调用方修改，在当前线程中格式化
+            record.msg = record.getMessage()
+            record.args = None
+        fields = getattr(record, 'fields', None)
+        if fields:
+            record.fields = {key: snapshot_value(value) for key, value in fields.items()}
+        if record.exc_info:
+            # 异常堆栈在当前线程中展开，避免后台线程访问已释放的帧
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class ComponentLogger:
+    """日志接口：消息参数惰性格式化，关键字参数作为结构化字段输出
+
+    logger.info("Assigning task %s to %s", task_id, addr, ligands=3)
+    """
+    def __init__(self, logger):
+        self.logger = logger
+
+    def is_enabled_for(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level, message, args, fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        exc_info = fields.pop('exc_info', None)
+        self.logger.log(level, message, *args, exc_info=exc_info, extra={'fields': fields} if fields else None, stacklevel=3)
+
+    def debug(self, message, *args, **fields):
+        """调试信息，用于开发调试"""
+        self._log(logging.DEBUG, message, args, fields)
+
+    def info(self, message, *args, **fields):
+        """一般信息，用于记录正常的操作流程"""
+        self._log(logging.INFO, message, args, fields)
+
+    def warning(self, message, *args, **fields):
+        """警告信息，用于可能的问题或异常情况"""
+        self._log(logging.WARNING, message, args, fields)
+
+    def error(self, message, *args, **fields):
+        """错误信息，用于操作失败或异常情况"""
+        self._log(logging.ERROR, message, args, fields)
+
+    def critical(self, message, *args, **fields):
+        """严重错误，用于影响系统运行的致命错误"""
+        self._log(logging.CRITICAL, message, args, fields)
+
+class Logger(ComponentLogger):
     _instance = None
     _initialized = False
 
@@ -17,11 +124,12 @@ class Logger:
             return
 
         self._initialized = True
-        self.logger = logging.getLogger('dock_server')
-        self.logger.setLevel(logging.DEBUG)
+        config = load_log_config()
+        super().__init__(logging.getLogger('dock_server'))
+        self.logger.setLevel(config.get('level', 'DEBUG'))
 
         # 创建日志目录
-        log_dir = 'logs'
+        log_dir = config.get('log_dir', 'logs')
         os.makedirs(log_dir, exist_ok=True)
 
         # 配置文件处理器
@@ -32,43 +140,48 @@ class Logger:
             backupCount=5,
             encoding='utf-8'
         )
-        file_handler.setLevel(logging.DEBUG)
+        file_handler.setLevel(config.get('file_level', 'DEBUG'))
 
         # 配置控制台处理器
         console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG)
+        console_handler.setLevel(config.get('console_level', 'DEBUG'))
 
         # 设置日志格式
-        formatter = logging.Formatter(
-            '[%(asctime)s] [%(levelname)s] %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
+        if config.get('format', 'text') == 'json':
+            formatter = JsonFormatter()
+        else:
+            formatter = TextFormatter(
+                '[%(asctime)s] [%(levelname)s] %(message)s',
+                datefmt='%Y-%m-%d %H:%M:%S'
+            )
         file_handler.setFormatter(formatter)
         console_handler.setFormatter(formatter)
 
-        # 添加处理器
-        self.logger.addHandler(file_handler)
-        self.logger.addHandler(console_handler)
+        # 各组件可单独设置级别，例如 {'dispatch': 'INFO', 'vina': 'WARNING'}
+        for component, level in config.get('components', {}).items():
+            logging.getLogger(f'dock_server.{component}').setLevel(level)
 
-    def debug(self, message):
-        """调试信息，用于开发调试"""
-        self.logger.debug(message)
-
-    def info(self, message):
-        """一般信息，用于记录正常的操作流程"""
-        self.logger.info(message)
+        # 添加处理器：默认经队列交给后台线程写入，调用方不等待文件和控制台 I/O
+        self.listener = None
+        if config.get('async', True):
+            log_queue = queue.SimpleQueue()
+            self.logger.addHandler(DeferredQueueHandler(log_queue))
+            self.listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+            self.listener.start()
+            atexit.register(self.stop)
+        else:
+            self.logger.addHandler(file_handler)
+            self.logger.addHandler(console_handler)
 
-    def warning(self, message):
-        """警告信息，用于可能的问题或异常情况"""
-        self.logger.warning(message)
+    def get_component(self, name):
+        """返回组件日志，级别由 LOG_CONFIG['components'] 配置"""
+        return ComponentLogger(logging.getLogger(f'dock_server.{name}'))
 
-    def error(self, message):
-        """错误信息，用于操作失败或异常情况"""
-        self.logger.error(message)
-
-    def critical(self, message):
-        """严重错误，用于影响系统运行的致命错误"""
-        self.logger.critical(message)
+    def stop(self):
+        """写完队列中剩余的日志后停止后台线程"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
 
 # 全局日志实例
-logger = Logger()
\ No newline at end of file
+logger = Logger()
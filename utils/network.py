@@ -5,13 +5,18 @@ import ssl
 import json
 import socket
 import queue
+import itertools
 import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from pathlib import Path
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable
 
 from .logger import logger
 
+# Largest frame accepted by FramedSocket.receive_message (bytes)
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
 class SSLContextManager:
     def __init__(self, cert_dir: str = 'certs'):
         self.cert_dir = Path(cert_dir)
@@ -73,6 +78,7 @@ class SSLContextManager:
         context.minimum_version = ssl.TLSVersion.TLSv1_2
         context.maximum_version = ssl.TLSVersion.TLSv1_3
         context.set_ciphers('ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-RSA-AES128-GCM-SHA256')
+        # Reconnecting clients resume with the session tickets OpenSSL issues by default
         return context
     
     def get_client_context(self) -> ssl.SSLContext:
@@ -150,15 +156,25 @@ class ConnectionPool:
             for conn in list(self.active_connections):
                 self._close_connection(conn)
 
-class SecureSocket:
-    def __init__(self, sock: socket.socket, ssl_context: ssl.SSLContext):
-        # Choose the correct wrapping method based on the SSL context type
-        if ssl_context.protocol == ssl.PROTOCOL_TLS_SERVER:
-            self.sock = ssl_context.wrap_socket(sock, server_side=True)
-        else:
-            self.sock = ssl_context.wrap_socket(sock)
-        self._recv_buffer = b''
-        self._send_buffer = b''
+def enable_keepalive(sock: socket.socket, idle: int = 60, interval: int = 10, count: int = 5):
+    """Let the kernel detect a peer that vanished without closing the connection
+
+    A request timeout alone does not tell a slow peer from a dead one; with
+    keepalive a dead connection is closed and its reader reports it.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Linux-specific knobs, other platforms keep their system defaults
+    for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+class FramedSocket:
+    """Length-prefixed JSON messages over a connected stream socket"""
+    def __init__(self, sock: socket.socket, max_frame_size: int = MAX_FRAME_SIZE):
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        # Preallocated buffer for the 4-byte length header
+        self._header_buffer = bytearray(4)
     
     def send_message(self, data: Dict[str, Any]):
         """Send a message, automatically handle encoding and fragmentation"""
@@ -176,6 +192,8 @@ class SecureSocket:
             encoded_data = encode_strings(data)
             message = json.dumps(encoded_data, ensure_ascii=True).encode('utf-8')
             length = len(message)
+            if length > self.max_frame_size:
+                raise ValueError(f"Message of {length} bytes exceeds maximum frame size {self.max_frame_size}")
             header = length.to_bytes(4, byteorder='big')
             self.sock.sendall(header + message)
         except UnicodeEncodeError as e:
@@ -189,14 +207,15 @@ class SecureSocket:
         """Receive a message, automatically handle decoding and fragmentation"""
         try:
             # Read the message length
-            header = self._recv_exactly(4)
-            if not header:
+            if not self._recv_into(memoryview(self._header_buffer)):
                 return None
-            length = int.from_bytes(header, byteorder='big')
+            length = int.from_bytes(self._header_buffer, byteorder='big')
+            if length > self.max_frame_size:
+                raise ConnectionError(f"Frame of {length} bytes exceeds maximum frame size {self.max_frame_size}")
             
             # Read the message content
             message = self._recv_exactly(length)
-            if not message:
+            if message is None:
                 return None
             
             try:
@@ -214,17 +233,23 @@ class SecureSocket:
             logger.error(f"Error receiving message: {e}")
             raise
     
-    def _recv_exactly(self, n: int) -> Optional[bytes]:
-        """Receive exactly the specified number of bytes"""
-        while len(self._recv_buffer) < n:
-            chunk = self.sock.recv(4096)
-            if not chunk:
-                return None
-            self._recv_buffer += chunk
-        
-        result = self._recv_buffer[:n]
-        self._recv_buffer = self._recv_buffer[n:]
-        return result
+    def _recv_exactly(self, n: int) -> Optional[bytearray]:
+        """Receive exactly the specified number of bytes into a buffer sized for the frame"""
+        buffer = bytearray(n)
+        if not self._recv_into(memoryview(buffer)):
+            return None
+        return buffer
+    
+    def _recv_into(self, view: memoryview) -> bool:
+        """Fill the given view from the socket, return False if the peer closed the connection"""
+        received = 0
+        total = len(view)
+        while received < total:
+            count = self.sock.recv_into(view[received:], total - received)
+            if not count:
+                return False
+            received += count
+        return True
     
     def close(self):
         """Close the connection"""
@@ -235,4 +260,144 @@ class SecureSocket:
         try:
             self.sock.close()
         except:
-            pass
\ No newline at end of file
+            pass
+
+class SecureSocket(FramedSocket):
+    """Framed messages over TLS"""
+    def __init__(self, sock: socket.socket, ssl_context: ssl.SSLContext, max_frame_size: int = MAX_FRAME_SIZE,
+                 session: Optional[ssl.SSLSession] = None):
+        # Choose the correct wrapping method based on the SSL context type
+        if ssl_context.protocol == ssl.PROTOCOL_TLS_SERVER:
+            sock = ssl_context.wrap_socket(sock, server_side=True)
+        else:
+            # Offer a previous session for resumption, the server falls back to a full handshake if it is unknown
+            sock = ssl_context.wrap_socket(sock, session=session)
+        super().__init__(sock, max_frame_size)
+    
+    @property
+    def session(self) -> Optional[ssl.SSLSession]:
+        """TLS session to offer on the next connection (available once data has been received)"""
+        return self.sock.session
+    
+    @property
+    def session_reused(self) -> bool:
+        """Whether the handshake resumed an earlier session"""
+        return self.sock.session_reused
+
+class MultiplexedConnection:
+    """Share one framed socket between threads, correlating responses by request_id
+
+    Pushed messages are handled in order on a thread of their own, so a push
+    handler waiting for a lock never keeps the reader from delivering the
+    response another thread is waiting for while holding that lock.
+    """
+    def __init__(self, secure_sock: FramedSocket, push_handler: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.secure_sock = secure_sock
+        self.push_handler = push_handler
+        self.closed = False
+        self._send_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending: Dict[int, Future] = {}
+        self._request_ids = itertools.count(1)
+        
+        self._pushes = queue.Queue()
+        if push_handler:
+            self._push_thread = threading.Thread(target=self._push_loop)
+            self._push_thread.daemon = True
+            self._push_thread.start()
+        self._reader_thread = threading.Thread(target=self._read_loop)
+        self._reader_thread.daemon = True
+        self._reader_thread.start()
+    
+    def request(self, data: Dict[str, Any], timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Send a request and wait for its response, return None if the connection is lost
+
+        Raises TimeoutError if no response arrives within timeout seconds; the
+        connection stays open and a late response is dropped.
+        """
+        future = self.send_request(data)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f"No response to {data.get('type')} within {timeout} seconds") from None
+        finally:
+            with self._pending_lock:
+                self._pending.pop(future.request_id, None)
+    
+    def send_request(self, data: Dict[str, Any]) -> Future:
+        """Send a request without waiting, the returned future resolves to the response"""
+        future = Future()
+        request_id = next(self._request_ids)
+        future.request_id = request_id
+        with self._pending_lock:
+            if self.closed:
+                future.set_result(None)
+                return future
+            self._pending[request_id] = future
+        
+        message = dict(data)
+        message['request_id'] = request_id
+        try:
+            with self._send_lock:
+                self.secure_sock.send_message(message)
+        except Exception:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise
+        return future
+    
+    def _read_loop(self):
+        """Dispatch incoming messages to waiting requests or the push handler"""
+        try:
+            while True:
+                message = self.secure_sock.receive_message()
+                if message is None:
+                    break
+                
+                request_id = message.pop('request_id', None)
+                if request_id is None:
+                    # Unsolicited message pushed by the server
+                    if self.push_handler:
+                        self._pushes.put(message)
+                    else:
+                        logger.debug("Ignoring unsolicited message: %s", message.get('type'))
+                    continue
+                
+                with self._pending_lock:
+                    future = self._pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result(message)
+                else:
+                    logger.debug("Dropping response for unknown request %s", request_id)
+        except Exception as e:
+            logger.debug("Connection reader stopped: %s", e)
+        finally:
+            self._fail_pending()
+            # Pushes already received are still handled, then the push thread exits
+            self._pushes.put(None)
+    
+    def _push_loop(self):
+        """Run the push handler for each pushed message, in arrival order"""
+        while True:
+            message = self._pushes.get()
+            if message is None:
+                return
+            try:
+                self.push_handler(message)
+            except Exception as e:
+                logger.error("Error handling pushed message: %s", e)
+    
+    def _fail_pending(self):
+        """Mark the connection closed and release every waiting request"""
+        with self._pending_lock:
+            self.closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            if not future.done():
+                future.set_result(None)
+    
+    def close(self):
+        """Close the underlying socket, waiting requests resolve to None"""
+        self.secure_sock.close()
+        self._fail_pending()